@@ -0,0 +1,177 @@
+# A small on-disk cache that is safe to use from several spiny processes.
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No file locking on this platform, concurrent writes may lose entries.
+    fcntl = None
+
+# Increase this when the format of the cached data changes, and old caches
+# will be ignored.
+CACHE_VERSION = 1
+
+# Seconds after which entries that were not used are pruned.
+MAX_AGE = 30 * 24 * 60 * 60
+
+# Entries that are used are marked as used at most this often, so the file
+# isn't rewritten each time.
+TOUCH_INTERVAL = 24 * 60 * 60
+
+logger = logging.getLogger('spiny')
+
+_DELETED = object()
+
+
+class FileLock(object):
+    """An exclusive lock on a lock file, held for the duration of a with block"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def atomic_write(path, data):
+    """Writes data to path so that readers see either the old or the new file"""
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+class CacheFile(object):
+    """A versioned JSON cache, divided into sections of key/value pairs
+
+    Reading is lock free, as the file is always replaced atomically. When
+    saving, the file is locked, re-read and only the entries that this
+    process changed are updated, so concurrent spiny processes don't lose
+    each others entries. If nothing changed, the file is not written.
+
+    The time each entry was last set or touched is saved too, so entries
+    that are not used anymore can be pruned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._changes = {}
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._sections, self._times = self._read()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}, {}
+        try:
+            with open(self.path, 'rb') as infile:
+                data = json.loads(infile.read().decode('utf8'))
+        except (OSError, ValueError):
+            logger.log(30, "Could not load info cache from %s" % self.path, exc_info=1)
+            return {}, {}
+
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            logger.log(10, "Ignoring cache %s from another version of spiny" % self.path)
+            return {}, {}
+        return data.get('sections', {}), data.get('times', {})
+
+    def get(self, section, key, default=None):
+        with self._lock:
+            return self._sections.get(section, {}).get(key, default)
+
+    def keys(self, section):
+        with self._lock:
+            return list(self._sections.get(section, {}))
+
+    def set(self, section, key, value):
+        with self._lock:
+            entries = self._sections.setdefault(section, {})
+            if key in entries and entries[key] == value:
+                return
+            entries[key] = value
+            self._changes[(section, key)] = value
+            self._touched[(section, key)] = time.time()
+
+    def delete(self, section, key):
+        with self._lock:
+            entries = self._sections.get(section, {})
+            if key in entries:
+                del entries[key]
+                self._changes[(section, key)] = _DELETED
+
+    def touch(self, section, key):
+        """Marks an entry as used, so it isn't pruned"""
+        with self._lock:
+            now = time.time()
+            used = self._times.get(section, {}).get(key)
+            if used is None or now - used > TOUCH_INTERVAL:
+                self._touched[(section, key)] = now
+
+    def prune(self, section, max_age=MAX_AGE):
+        """Deletes the entries of a section that have not been used for max_age seconds"""
+        oldest = time.time() - max_age
+        for key in self.keys(section):
+            with self._lock:
+                if (section, key) in self._touched:
+                    continue
+                used = self._times[section][key]
+            if used < oldest:
+                self.delete(section, key)
+
+    @property
+    def changed(self):
+        return bool(self._changes or self._touched)
+
+    def save(self):
+        if not self.changed:
+            return
+
+        try:
+            with FileLock(self.path + '.lock'):
+                # Somebody else may have saved since we read the file.
+                sections, times = self._read()
+                with self._lock:
+                    for (section, key), value in self._changes.items():
+                        entries = sections.setdefault(section, {})
+                        if value is _DELETED:
+                            entries.pop(key, None)
+                        else:
+                            entries[key] = value
+                    for (section, key), used in self._touched.items():
+                        times.setdefault(section, {})[key] = used
+                    # Only the times of the entries that are left.
+                    times = dict((section, dict((key, times[section][key]) for key in entries))
+                                 for section, entries in sections.items())
+                    self._changes = {}
+                    self._touched = {}
+                    self._sections = sections
+                    self._times = times
+
+                data = {'version': CACHE_VERSION, 'sections': sections, 'times': times}
+                atomic_write(self.path, json.dumps(data, sort_keys=True).encode('utf8'))
+        except OSError:
+            logger.log(30, "Could not save cache file %s" % self.path, exc_info=1)
@@ -1,145 +1,435 @@
 import logging
 import os
 import os.path
-import pickle
 import re
 import string
 import sys
 
-from distutils.version import LooseVersion
+from concurrent.futures import ThreadPoolExecutor
+
+from spiny import timing
+from spiny.cache import CacheFile
+from spiny.staticdata import get_static_data
 
 if sys.version_info < (3,):
     import subprocess32 as subprocess
+    from scandir import scandir
 else:
     import subprocess
+    from os import scandir
 
 PYTHON_TROVE_RE = re.compile(b'''Programming Language :: Python :: (.*?)( :: (.*?))?['"]''')
-PYPY_VER_RE = re.compile(r'PyPy ([\d\.]*)')
+
+PYTHON_LIB_RE = re.compile(r'python(\d+\.\d+)$')
+FULL_VERSION_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)(?:(?:a|b|rc)\d+)?')
+PATCHLEVEL_RE = re.compile(r'#define\s+PY_VERSION\s+"([^"]+)"')
+# Splits a version like distutils' LooseVersion, which is slow to import.
+VERSION_PART_RE = re.compile(r'(\d+|[a-z]+|\.)')
 
 logger = logging.getLogger('spiny')
 
+# How many interpreters to probe at the same time. Probing is mostly
+# waiting for subprocesses to start, so this can be higher than the CPU count.
+DEFAULT_MAX_PROBES = 8
+
 
 def get_environments(conf):
     if conf.has_option('spiny', 'environments'):
         environments = conf.get('spiny', 'environments').split()
     else:
-        with open('setup.py', 'rb') as setuppy:
-            environments = []
-            for match in PYTHON_TROVE_RE.findall(setuppy.read()):
-                if match[2]:
-                    env = match[2].lower().decode('ascii', 'ignore')
-                    if env == 'cpython':
-                        # That you support CPython is assumed, skip this.
-                        continue
-                else:
-                    env = 'python' + str(match[0].decode('ascii', 'ignore'))
-                environments.append(env)
+        data = get_static_data('.')
+        if data is not None and 'classifiers' in data:
+            # Quote them, to find them like in setup.py.
+            text = ''.join("'%s'" % c for c in data['classifiers']).encode('utf8')
+        elif os.path.isfile('setup.py'):
+            with open('setup.py', 'rb') as setuppy:
+                text = setuppy.read()
+        else:
+            text = b''
+
+        environments = []
+        for match in PYTHON_TROVE_RE.findall(text):
+            if match[2]:
+                env = match[2].lower().decode('ascii', 'ignore')
+                if env in ('cpython', 'only'):
+                    # That you support CPython is assumed, skip this.
+                    continue
+            else:
+                env = 'python' + str(match[0].decode('ascii', 'ignore'))
+            environments.append(env)
 
     # If "Python X" is specified and "Python X.Y" is also specified, skip "Python X"
     return [e for e in environments if not any([x.startswith(e) and len(x) >
                                                 len(e) for x in environments])]
 
 
-def python_info(fullpath, cache):
-    # Figure out the version of the Python exe
-    logger.log(10, 'Getting Python version for %s' % fullpath)
-    if fullpath in cache:
-        mtime = os.stat(fullpath).st_mtime
-        if mtime == cache[fullpath]['mtime']:
-            return cache[fullpath]
-
-    with subprocess.Popen([fullpath, '-V'],
-                          stderr=subprocess.PIPE,
-                          stdout=subprocess.PIPE) as process:
-        process.wait()
-        stderr = process.stderr.read()
-        stdout = process.stdout.read()
+# A script that is run once with each Python to find out everything we need
+# to know about it. It must run under any Python version, so keep it simple.
+PROBE_SCRIPT = """
+import sys
+
+def has_module(name):
+    try:
+        import importlib.util
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, AttributeError):
+        pass
+    try:
+        import imp
+        imp.find_module(name)
+        return True
+    except ImportError:
+        return False
+
+try:
+    import platform
+    implementation = platform.python_implementation()
+except (ImportError, AttributeError):
+    implementation = 'CPython'
+
+if hasattr(sys, 'pypy_version_info'):
+    pypy_version = '.'.join([str(x) for x in sys.pypy_version_info[:3]])
+else:
+    pypy_version = ''
+
+values = [('implementation', implementation),
+          ('version', sys.version.split()[0]),
+          ('version_info', '.'.join([str(x) for x in sys.version_info[:3]])),
+          ('pypy_version', pypy_version),
+          ('prefix', sys.prefix),
+          ('virtualenv', has_module('virtualenv')),
+          ('venv', has_module('venv')),
+          ('ensurepip', has_module('ensurepip')),
+          ('pip', has_module('pip'))]
+for key, value in values:
+    sys.stdout.write('spiny-probe:%s=%s\\n' % (key, value))
+"""
+
+
+def probe_python(fullpath):
+    """Runs the probe script with a Python executable
+
+    Returns a dictionary with information about it, or None if the
+    executable is not a working Python.
+    """
+    logger.log(10, 'Probing Python %s' % fullpath)
+    try:
+        process = subprocess.Popen([fullpath, '-c', PROBE_SCRIPT],
+                                   stderr=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+    except OSError:
+        logger.log(10, 'Could not execute %s' % fullpath, exc_info=1)
+        return None
+
+    with process:
+        stdout, stderr = process.communicate()
         logger.log(10, stderr)
         logger.log(10, stdout)
 
-        # Python 3.4 and Jython prints it on stdout, all others on stderr.
-        if stdout:
-            version_string = stdout
+    payload = {}
+    for line in stdout.decode('utf8', 'replace').splitlines():
+        if not line.startswith('spiny-probe:') or '=' not in line:
+            continue
+        key, value = line[len('spiny-probe:'):].split('=', 1)
+        if value in ('True', 'False'):
+            value = value == 'True'
+        payload[key] = value
+
+    if process.returncode != 0 or 'version_info' not in payload:
+        logger.log(10, '%s is not a working Python' % fullpath)
+        return None
+
+    payload['version_info'] = [int(x) for x in payload['version_info'].split('.')]
+    return payload
+
+
+def _read_pyvenv_cfg(path):
+    values = {}
+    with open(path, 'rt') as cfg:
+        for line in cfg:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                values[key.strip().lower()] = value.strip()
+    return values
+
+
+def _has_module(directories, name):
+    for directory in directories:
+        if (os.path.isfile(os.path.join(directory, name, '__init__.py')) or
+                os.path.isfile(os.path.join(directory, name + '.py'))):
+            return True
+    return False
+
+
+def _stdlib_dir(prefix, execname):
+    """Finds the lib/pythonX.Y directory that belongs to an executable"""
+    libdir = os.path.join(prefix, 'lib')
+    try:
+        names = os.listdir(libdir)
+    except OSError:
+        return None
+
+    if any(name.startswith('pypy') for name in names) or \
+            os.path.isdir(os.path.join(prefix, 'lib_pypy')):
+        # PyPy layouts are not supported, probe it.
+        return None
+
+    versions = [name[6:] for name in names if PYTHON_LIB_RE.match(name)]
+    match = PYTHON_LIB_RE.match(execname)
+    if match:
+        # A versioned name like python3.11 decides which one it is.
+        versions = [v for v in versions if v == match.group(1)]
+    elif execname != 'python':
+        # python3 must be Python 3.X
+        versions = [v for v in versions if 'python' + v.split('.')[0] == execname]
+
+    if len(versions) != 1:
+        # Missing or ambiguous
+        return None
+    stdlib = os.path.join(libdir, 'python' + versions[0])
+    if not os.path.isfile(os.path.join(stdlib, 'os.py')):
+        return None
+    return stdlib
+
+
+def _full_version(prefix, short_version):
+    """Finds the full version from the install layout, or None"""
+    # pyenv and similar installs each version in a directory with its version
+    name = os.path.basename(prefix)
+    if FULL_VERSION_RE.match(name) and name.startswith(short_version + '.'):
+        return name
+
+    # The C headers have the exact version, if they are installed
+    includedir = os.path.join(prefix, 'include')
+    try:
+        names = os.listdir(includedir)
+    except OSError:
+        return None
+    for name in names:
+        if name == 'python' + short_version or name.startswith('python' + short_version + 'm'):
+            try:
+                with open(os.path.join(includedir, name, 'patchlevel.h'), 'rt') as header:
+                    match = PATCHLEVEL_RE.search(header.read())
+            except (IOError, OSError):
+                continue
+            if match and match.group(1).startswith(short_version + '.'):
+                return match.group(1)
+    return None
+
+
+def static_python_info(fullpath):
+    """Finds out the probe information without running the Python
+
+    Looks at pyvenv.cfg, the lib/pythonX.Y layout, the install directory name
+    and the C headers. Returns None if this can't be done reliably, and the
+    Python then needs to be probed.
+    """
+    realpath = os.path.realpath(fullpath)
+    execname = os.path.basename(realpath)
+    if not execname.startswith('python'):
+        return None
+
+    # A virtualenv Python is a link in the virtualenvs bin directory.
+    prefix = os.path.dirname(os.path.dirname(os.path.abspath(fullpath)))
+    cfg_path = os.path.join(prefix, 'pyvenv.cfg')
+    if os.path.isfile(cfg_path):
+        try:
+            cfg = _read_pyvenv_cfg(cfg_path)
+        except (IOError, OSError):
+            return None
+        if cfg.get('implementation', 'CPython') != 'CPython' or \
+                cfg.get('include-system-site-packages', 'false').lower() != 'false':
+            return None
+        version = cfg.get('version_info', cfg.get('version', ''))
+        match = FULL_VERSION_RE.match(version)
+        if not match or 'home' not in cfg:
+            return None
+        version = match.group(0)
+        short_version = '.'.join(version.split('.')[:2])
+        base_prefix = os.path.dirname(cfg['home'])
+        stdlib = os.path.join(base_prefix, 'lib', 'python' + short_version)
+        site_dirs = [os.path.join(prefix, 'lib', 'python' + short_version, 'site-packages')]
+    else:
+        prefix = os.path.dirname(os.path.dirname(realpath))
+        stdlib = _stdlib_dir(prefix, execname)
+        if stdlib is None:
+            return None
+        short_version = os.path.basename(stdlib)[6:]
+        version = _full_version(prefix, short_version)
+        if version is None:
+            return None
+        site_dirs = [os.path.join(stdlib, 'site-packages'),
+                     os.path.join(stdlib, 'dist-packages'),
+                     os.path.join(prefix, 'lib', 'python3', 'dist-packages'),
+                     os.path.join(prefix, 'local', 'lib', 'python' + short_version,
+                                  'dist-packages'),
+                     os.path.expanduser(os.path.join('~', '.local', 'lib',
+                                                     'python' + short_version,
+                                                     'site-packages'))]
+
+    if not os.path.isfile(os.path.join(stdlib, 'os.py')):
+        return None
+
+    logger.log(10, 'Found version %s for %s without running it' % (version, fullpath))
+    return {'implementation': 'CPython',
+            'version': version,
+            'version_info': [int(x) for x in FULL_VERSION_RE.match(version).groups()],
+            'pypy_version': '',
+            'prefix': prefix,
+            'virtualenv': _has_module(site_dirs, 'virtualenv'),
+            'venv': _has_module([stdlib], 'venv'),
+            'ensurepip': _has_module([stdlib], 'ensurepip'),
+            'pip': _has_module(site_dirs, 'pip')}
+
+
+def version_parts(version):
+    """Splits a version into numbers and letters, like '3.7.0b1' into [3, 7, 0, 'b', 1]"""
+    parts = []
+    for part in VERSION_PART_RE.split(version):
+        if not part or part == '.':
+            continue
+        try:
+            parts.append(int(part))
+        except ValueError:
+            parts.append(part)
+    return parts
+
+
+def make_info(fullpath, payload):
+    """Creates the info dictionary for a Python from its probe payload"""
+    implementation = payload['implementation']
+    if implementation == 'PyPy':
+        if payload['version_info'][0] == 3:
+            # This is a Python 3 compatible version:
+            python = 'PyPy3'
         else:
-            version_string = stderr
-
-        version_info = version_string.strip().decode('ascii', 'ignore')
-        parts = version_info.split()
-        python = parts[0]
-        version = parts[1]
-
-        pypy = PYPY_VER_RE.search(version_info)
-        if pypy:
-            if version[0] == '3':
-                # This is a Python 3 compatible version:
-                python = 'PyPy3'
-            else:
-                python = 'PyPy'
-            version = pypy.groups()[0]
+            python = 'PyPy'
+        version = payload['pypy_version']
+    elif implementation == 'CPython':
+        python = 'Python'
+        version = payload['version']
+    else:
+        # Jython, IronPython, etc.
+        python = implementation
+        version = payload['version']
 
     # Return all valid environment names
-    env_version = LooseVersion(version).version
+    env_version = version_parts(version)
     environment = ['%s' % python.lower(),
                    '%s%s' % (python.lower(), env_version[0])]
     for v in env_version[1:]:
         environment.append('%s.%s' % (environment[-1], v))
 
-    info = {'python': python,
+    return {'python': python,
             'version': version,
             'path': fullpath,
             'execname': os.path.split(fullpath)[-1],
             'environments': environment,
-            'mtime': os.stat(fullpath).st_mtime}
+            'implementation': implementation,
+            'version_info': payload['version_info'],
+            'prefix': payload['prefix'],
+            'has_virtualenv': payload['virtualenv'],
+            'has_venv': payload['venv'],
+            'has_ensurepip': payload['ensurepip'],
+            'has_pip': payload['pip']}
+
+
+def stat_key(path):
+    """Returns what identifies a specific version of a file"""
+    realpath = os.path.realpath(path)
+    st = os.stat(realpath)
+    return [realpath, st.st_ino, st.st_size, st.st_mtime]
 
-    cache[fullpath] = info
+
+def python_info(fullpath, cache, static=True):
+    """Returns information about a Python, or None if it isn't a working Python
+
+    If static is true, the information is first looked for in the files of
+    the Python install, and the Python is only run if that fails.
+    """
+    logger.log(10, 'Getting Python version for %s' % fullpath)
+    # The cache is keyed on the path used, as a virtualenv Python is a link to
+    # the base Python, but behaves differently. It's valid as long as the
+    # file it points to is the same.
+    key = stat_key(fullpath)
+    entry = cache.get('pythons', fullpath)
+    if entry is None or entry['stat'] != key:
+        payload = None
+        if static:
+            payload = static_python_info(fullpath)
+        if payload is None:
+            # Not working Pythons are also cached, with a payload of None.
+            payload = probe_python(fullpath)
+        entry = {'stat': key, 'payload': payload}
+        cache.set('pythons', fullpath, entry)
+
+    if entry['payload'] is None:
+        return None
+
+    info = make_info(fullpath, entry['payload'])
+    if 'external' in entry:
+        info['external'] = entry['external']
     return info
 
 
-def list_pythons_on_path(path):
-    """Finds all Python versions in the list of directory paths given"""
-    pythons = {}
-    for p in path.split(os.pathsep):
-        try:
-            files = os.listdir(p)
-        except OSError:
-            # Path does not exist
-            continue
+def is_python_name(filename):
+    """Checks if a filename looks like a Python executable, without any stat calls"""
+    execname = ''.join(x for x in filename.lower()
+                       if x in string.ascii_lowercase)
+    return execname in ('python', 'pypy', 'jython', 'ipyexe')
 
-        for filename in files:
-            execname = ''.join(x for x in filename.lower()
-                               if x in string.ascii_lowercase)
-            if execname not in ('python', 'pypy', 'jython', 'ipyexe'):
-                continue
 
+def list_python_names(directory, cache=None):
+    """Lists the names in a directory that look like Python executables
+
+    The names found are indexed in the cache by the directory mtime, so
+    directories that have not changed are not listed again.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        # Path does not exist
+        return []
+
+    if cache is not None:
+        entry = cache.get('directories', directory)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry['names']
+
+    try:
+        names = []
+        for entry in scandir(directory):
+            if is_python_name(entry.name) and not entry.is_dir():
+                names.append(entry.name)
+    except OSError:
+        # Not a directory, or not readable
+        return []
+
+    names.sort()
+    if cache is not None:
+        cache.set('directories', directory, {'mtime': mtime, 'names': names})
+    return names
+
+
+def list_pythons_on_path(path, cache=None):
+    """Finds all Python versions in the list of directory paths given"""
+    found = set()
+    for p in path.split(os.pathsep):
+        for filename in list_python_names(p, cache):
             # Find the executable
             fullpath = os.path.realpath(os.path.join(p, filename))
-            if not os.access(fullpath, os.X_OK):
-                # Not executable
+            if fullpath in found:
+                # We found this already
                 continue
 
-            if fullpath in [x['path'] for x in pythons.values()]:
-                # We found this already
+            if not os.access(fullpath, os.X_OK):
+                # Not executable
                 continue
 
+            found.add(fullpath)
             yield fullpath
 
 
-def has_virtualenv(exepath):
-    command = [exepath, '-m', 'virtualenv']
-
-    logger.log(10, 'Checking for virtualenv: %s' % ' '.join(command))
-    with subprocess.Popen(command,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE) as process:
-        process.wait()
-        stderr = process.stderr.read()
-        stdout = process.stdout.read()
-        logger.log(10, stderr)
-        logger.log(10, stdout)
-
-        return not (process.returncode == 1 or stderr)
-
-
 def can_use_current_virtualenv(exepath):
     command = [sys.executable, '-m', 'virtualenv', '-p', exepath]
     logger.log(10, 'Trying local virtualenv: %s' % ' '.join(command))
@@ -158,91 +448,166 @@ def can_use_current_virtualenv(exepath):
                     b'ERROR:' in stdout)
 
 
-def get_pythons(conf):
-    # Open cache file, if it exists:
+def supports_venv(info, shared_pip=False):
+    """Checks if the Python can create environments with the stdlib venv module"""
+    if info['implementation'] != 'CPython' or info['version_info'] < [3, 3]:
+        return False
+    # Without a shared pip, venv needs ensurepip to install pip.
+    return info['has_venv'] and (shared_pip or info['has_ensurepip'])
+
+
+def choose_backend(info, preference='auto', shared_pip=False):
+    """Returns the backend to create virtualenvs with, or None if none works
+
+    The backends are 'venv' for the stdlib venv module, 'virtualenv' for the
+    virtualenv module installed for the Python itself, and 'external' for
+    the virtualenv module of the Python running spiny.
+    """
+    if preference in ('auto', 'venv') and supports_venv(info, shared_pip):
+        return 'venv'
+    if preference == 'venv':
+        return None
+
+    if info['has_virtualenv']:
+        return 'virtualenv'
+    # There is no virtualenv module installed for this Python.
+    # Try with the current Python.
+    if 'external' not in info:
+        info['external'] = can_use_current_virtualenv(info['path'])
+    if info['external']:
+        return 'external'
+    return None
+
+
+def map_concurrently(function, items, max_workers):
+    """Calls function on each item in a thread pool, returns the results in order"""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    function = timing.inherit(function)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def get_cache(conf):
+    """Opens the cache file from the configuration"""
     if conf.has_option('spiny', 'cache-file'):
         cache_file = conf.get('spiny', 'cache-file')
     else:
-        cache_file = '~/.cache/spiny/pythons.cache'
+        # Not pythons.cache, where older versions of spiny keep a pickle.
+        cache_file = '~/.cache/spiny/pythons.json'
+    return CacheFile(os.path.expanduser(cache_file))
 
-    cache_file = os.path.expanduser(cache_file)
 
-    cache = {}
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'rb') as infile:
-                cache = pickle.load(infile)
-        except (EOFError, OSError) as e:
-            logger.log(30, "Could not load info cache from %s" % cache_file, exc_info=1)
+def get_pythons(conf):
+    cache = get_cache(conf)
 
-    pythons = {}
+    if conf.has_option('spiny', 'max-probes'):
+        max_probes = int(conf.get('spiny', 'max-probes'))
+    else:
+        max_probes = DEFAULT_MAX_PROBES
 
-    # Make sure we have the Python versions required:
+    # Collect all candidates first, so they can be probed concurrently.
+    # The results are then merged in the same order as they were found, so
+    # the precedence rules do not depend on which probe finishes first.
     if conf.has_section('pythons'):
-        for python, path in conf.items('pythons'):
-            if not os.access(path, os.X_OK):
-                # Not executable
-                raise EnvironmentError('%s is not executable' % path)
+        configured = conf.items('pythons')
+    else:
+        configured = []
+    on_path = list(list_pythons_on_path(os.environ['PATH'], cache))
+
+    candidates = []
+    for path in [path for python, path in configured] + on_path:
+        if path not in candidates and os.access(path, os.X_OK):
+            candidates.append(path)
+    static = not (conf.has_option('spiny', 'static-detection') and
+                  conf.get('spiny', 'static-detection').lower() in
+                  ['false', 'off', '0', 'no'])
+    infos = dict(zip(candidates, map_concurrently(lambda path: python_info(path, cache, static),
+                                                  candidates, max_probes)))
 
-            info = python_info(path, cache)
-            if python not in info['environments']:
-                raise EnvironmentError(
-                    'Executable %s is not the given version %s' % (path, python))
+    pythons = {}
 
-            # Add the other envs for this particular python, if this is a higher version:
-            for env in info['environments']:
-                if env not in pythons or pythons[env]['version'] < info['version']:
-                    pythons[env] = info
+    # Make sure we have the Python versions required:
+    for python, path in configured:
+        if not os.access(path, os.X_OK):
+            # Not executable
+            raise EnvironmentError('%s is not executable' % path)
+
+        info = infos[path]
+        if info is None:
+            raise EnvironmentError('%s is not a working Python' % path)
+        if python not in info['environments']:
+            raise EnvironmentError(
+                'Executable %s is not the given version %s' % (path, python))
+
+        # Add the other envs for this particular python, if this is a higher version:
+        for env in info['environments']:
+            if env not in pythons or pythons[env]['version'] < info['version']:
+                pythons[env] = info
 
     # Add the Python versions in the path for versions that are not specified:
-    path = os.environ['PATH']
-    for fullpath in list_pythons_on_path(path):
-        info = python_info(fullpath, cache)
+    for fullpath in on_path:
+        info = infos[fullpath]
+        if info is None:
+            continue
         for env in info['environments']:
             if env not in pythons:
                 pythons[env] = info
 
+    if conf.has_option('spiny', 'venv-backend'):
+        preference = conf.get('spiny', 'venv-backend').lower()
+    else:
+        preference = 'auto'
+    if preference not in ('auto', 'venv', 'virtualenv'):
+        raise ValueError('venv-backend must be one of auto, venv or virtualenv')
+    shared_pip = (conf.has_option('spiny', 'venv-pip') and
+                  conf.get('spiny', 'venv-pip').lower() == 'shared')
+
     # Check that the specified environments have a functioning virtualenv:
     env_list = get_environments(conf)
+    to_check = []
     for env in env_list:
         if env not in pythons:
             logger.log(40, 'ERROR: Could not find an executable for %s' % env)
             continue
 
-        if 'virtualenv' in pythons[env]:
+        if 'backend' in pythons[env] or any(pythons[env] is x for x in to_check):
             # We have already checked the virtualenv for this.
             continue
 
         if pythons[env]['version'] < u'2.4':
             # Python 2.3 and lower doesn't have virtualenv
-            pythons[env]['virtualenv'] = 'unsupported'
+            pythons[env]['backend'] = 'unsupported'
             continue
 
-        exepath = pythons[env]['path']
-        if not has_virtualenv(exepath):
-            # Something went wrong. Most likely there is no virtualenv module
-            # installed for this Python. Try with the current Python.
-            if not can_use_current_virtualenv(exepath):
-                # That didn't work either.
-                raise EnvironmentError(
-                    "The Python at %s does not have virtualenv installed, and the "
-                    "virtualenv for %s could not install that Python version. "
-                    "To solve this, install virtualenv for %s" % (
-                        exepath, sys.executable, exepath))
-            else:
-                pythons[env]['virtualenv'] = 'external'
-
-        else:
-            pythons[env]['virtualenv'] = 'internal'
-
-    try:
-        cache_dir = os.path.split(cache_file)[0]
-        if not os.path.isdir(cache_dir):
-            os.mkdir(cache_dir)
-
-        with open(cache_file, 'wb') as outfile:
-            cache = pickle.dump(cache, outfile, protocol=2)
-    except OSError as e:
-        logger.log(30, "Could not save Python info cache file %s" % cache_file, exc_info=1)
+        to_check.append(pythons[env])
+
+    checks = map_concurrently(lambda info: choose_backend(info, preference, shared_pip),
+                              to_check, max_probes)
+    for info, result in zip(to_check, checks):
+        exepath = info['path']
+        if result is None and preference == 'venv':
+            raise EnvironmentError(
+                "The Python at %s can not create virtualenvs with venv. "
+                "To solve this, use the virtualenv venv-backend" % exepath)
+        elif result is None:
+            # That didn't work either.
+            raise EnvironmentError(
+                "The Python at %s does not have virtualenv installed, and the "
+                "virtualenv for %s could not install that Python version. "
+                "To solve this, install virtualenv for %s" % (
+                    exepath, sys.executable, exepath))
+        info['backend'] = result
+        if 'external' in info:
+            entry = dict(cache.get('pythons', exepath), external=info['external'])
+            cache.set('pythons', exepath, entry)
+
+    # Forget Pythons that have been removed, and save any new information.
+    for section in ('pythons', 'directories'):
+        for path in cache.keys(section):
+            if not os.path.exists(path):
+                cache.delete(section, path)
+    cache.save()
 
     return pythons
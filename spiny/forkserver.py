@@ -0,0 +1,389 @@
+# A server that runs under the Python of a virtualenv, imports the
+# dependencies once, and forks a child to run each test command, so the
+# commands don't pay for starting Python and importing everything again.
+#
+# The server part is run as a script by the virtualenv Python, so it must
+# work with Python 2 and 3, and not import anything from spiny.
+import json
+import os
+import os.path
+import socket
+import sys
+import time
+import traceback
+
+# Ends the output of a command, followed by the exit code.
+EXIT_MARKER = '\0spiny-exit:'
+
+# The resource limits that are passed on to the commands.
+RLIMITS = ('RLIMIT_AS', 'RLIMIT_CORE', 'RLIMIT_CPU', 'RLIMIT_DATA', 'RLIMIT_FSIZE',
+           'RLIMIT_NOFILE', 'RLIMIT_STACK')
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        # Also True and False.
+        return int(code)
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+def _run_command(args):
+    """Runs the arguments to python, like the python command would"""
+    import runpy
+    if args[0] == '-m':
+        sys.argv = [args[1]] + args[2:]
+        sys.path.insert(0, os.getcwd())
+        runpy.run_module(args[1], run_name='__main__', alter_sys=True)
+    elif args[0] == '-c':
+        sys.argv = ['-c'] + args[2:]
+        sys.path.insert(0, '')
+        exec(compile(args[1], '<string>', 'exec'), {'__name__': '__main__'})
+    else:
+        sys.argv = args
+        sys.path.insert(0, os.path.dirname(os.path.abspath(args[0])))
+        runpy.run_path(args[0], run_name='__main__')
+
+
+def process_state():
+    """The environment, umask and resource limits, for the commands to run with"""
+    umask = os.umask(0)
+    os.umask(umask)
+    limits = {}
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    for name in RLIMITS:
+        if resource is not None and hasattr(resource, name):
+            limits[name] = resource.getrlimit(getattr(resource, name))
+    return {'env': dict(os.environ), 'umask': umask, 'rlimits': limits}
+
+
+def _apply_state(request):
+    """Makes the child look like it was started by the spiny that sent the request"""
+    env = request.get('env')
+    if env is not None:
+        if sys.version_info < (3,):
+            env = dict((k.encode('utf8'), v.encode('utf8')) for k, v in env.items())
+        os.environ.clear()
+        os.environ.update(env)
+    if request.get('umask') is not None:
+        os.umask(request['umask'])
+    if request.get('rlimits'):
+        import resource
+        for name, limit in request['rlimits'].items():
+            if hasattr(resource, name):
+                try:
+                    resource.setrlimit(getattr(resource, name), tuple(limit))
+                except (ValueError, OSError):
+                    # The server can't raise its own hard limit.
+                    pass
+
+
+def _child(conn, request):
+    """Runs a command in the forked child, and never returns"""
+    import signal
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    code = 1
+    conn.sendall(('%spid:%s\n' % (EXIT_MARKER, os.getpid())).encode('ascii'))
+    try:
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        args, cwd = request['args'], request['cwd']
+        if sys.version_info < (3,):
+            # JSON gives unicode, but Python 2 wants bytes.
+            args = [arg.encode('utf8') for arg in args]
+            cwd = cwd.encode('utf8')
+        _apply_state(request)
+        os.chdir(cwd)
+        _run_command(args)
+        code = 0
+    except SystemExit as e:
+        code = _exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    try:
+        # Things like coverage save their data at exit.
+        import atexit
+        if hasattr(atexit, '_run_exitfuncs'):
+            atexit._run_exitfuncs()
+        elif hasattr(sys, 'exitfunc'):
+            sys.exitfunc()
+    except BaseException:
+        traceback.print_exc()
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(('%s%s\n' % (EXIT_MARKER, code)).encode('ascii'))
+    finally:
+        os._exit(0)
+
+
+def peer_uid(sock):
+    """The user id of the process at the other end of a Unix socket, or None if unknown"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    import struct
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid
+
+
+def serve(socket_path, key, timeout, preload):
+    """Imports the preload modules, and runs commands until idle for timeout seconds"""
+    import signal
+    for name in preload:
+        try:
+            __import__(name)
+        except Exception:
+            # Not an importable name, or broken. The tests will tell.
+            pass
+    # The children are not waited for.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    server.settimeout(timeout)
+
+    def stop():
+        # Stop listening first, so a new server can start right away.
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    while True:
+        try:
+            conn, address = server.accept()
+        except socket.timeout:
+            stop()
+            return
+        if peer_uid(conn) not in (None, os.getuid()):
+            # Only the user that started the server may run commands.
+            conn.close()
+            continue
+        conn.settimeout(None)
+        reader = conn.makefile('rb')
+        request = json.loads(reader.readline().decode('utf8'))
+        reader.close()
+        if request.get('key') != key:
+            # The virtualenv changed, a new server must be started.
+            stop()
+            conn.sendall(('%sstale\n' % EXIT_MARKER).encode('ascii'))
+            conn.close()
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            server.close()
+            _child(conn, request)
+        conn.close()
+
+
+def socket_dir():
+    """The directory for the sockets and their locks, only the user may use it"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'spiny')
+    return os.path.expanduser(os.path.join('~', '.cache', 'spiny', 'forkservers'))
+
+
+def make_socket_dir(directory):
+    """Makes the socket directory, and checks that no one else can use it"""
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    # The requests have the environment, and the answers say if the tests passed.
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid():
+        raise OSError('%s is owned by another user' % directory)
+    if stat.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+def socket_path(envdir):
+    """Where the fork server for a virtualenv listens, short enough for a socket"""
+    import hashlib
+    digest = hashlib.sha1(os.path.abspath(envdir).encode('utf8')).hexdigest()[:16]
+    return os.path.join(socket_dir(), 'spiny-%s.sock' % digest)
+
+
+def module_names(requirements):
+    """Guesses the module names of requirements, to preload them"""
+    from spiny.venvs import requirement_name
+    names = []
+    for requirement in requirements:
+        name = requirement_name(requirement)
+        if name is not None:
+            names.append(name.replace('-', '_').lower())
+    return names
+
+
+class RemoteProcess(object):
+    """A command run by the fork server, so it can be terminated"""
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def terminate(self):
+        import signal
+        os.kill(self.pid, signal.SIGTERM)
+
+
+class ForkServer(object):
+    """Runs test commands for a virtualenv through its fork server
+
+    The server is started when needed, and keeps running between runs of
+    spiny until it has been idle for timeout seconds. When the virtualenv,
+    the preloaded modules or the PYTHON* environment variables change, a
+    new server is started. The commands get the environment variables,
+    umask and resource limits of the spiny that runs them, but the
+    preloaded modules were imported with those of the spiny that started
+    the server.
+    """
+
+    def __init__(self, python, envdir, preload, timeout=600):
+        import hashlib
+        self.python = python
+        self.path = socket_path(envdir)
+        self.preload = preload
+        self.timeout = timeout
+        # These change how Python starts, so they can't be changed in the children.
+        startup = sorted((name, value) for name, value in os.environ.items()
+                         if name.startswith('PYTHON'))
+        digest = hashlib.sha1(json.dumps([python, preload, startup]).encode('utf8'))
+        profile_path = os.path.join(envdir, '.spiny-profile')
+        if os.path.isfile(profile_path):
+            with open(profile_path, 'rb') as profile:
+                digest.update(profile.read())
+        self.key = digest.hexdigest()
+
+    def supports(self, args):
+        """Checks if the server can run a command, it must be the Python with a script or -m/-c"""
+        if len(args) < 2 or args[0] != self.python:
+            return False
+        if args[1] in ('-m', '-c'):
+            return len(args) > 2
+        return not args[1].startswith('-')
+
+    def _start(self):
+        import logging
+        if sys.version_info < (3,):
+            import subprocess32 as subprocess
+        else:
+            import subprocess
+        logging.getLogger('spiny').log(10, 'Starting fork server for %s' % self.python)
+        command = [self.python, os.path.abspath(__file__).replace('.pyc', '.py'),
+                   self.path, self.key, str(self.timeout)] + self.preload
+        with open(os.devnull, 'r+b') as null:
+            # A new session, so it isn't stopped with spiny.
+            return subprocess.Popen(command, stdin=null, stdout=null, stderr=null,
+                                    close_fds=True, start_new_session=True)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # Another user's server would get the environment, and could fake the results.
+            if os.stat(self.path).st_uid != os.getuid():
+                raise socket.error('%s is owned by another user' % self.path)
+            sock.connect(self.path)
+            if peer_uid(sock) not in (None, os.getuid()):
+                raise socket.error('The server at %s is run by another user' % self.path)
+        except (socket.error, OSError):
+            sock.close()
+            raise
+        return sock
+
+    def connect(self):
+        """Connects to the server, starting it if it isn't running"""
+        from spiny.cache import FileLock
+        make_socket_dir(os.path.dirname(self.path))
+        with FileLock(self.path + '.lock'):
+            try:
+                return self._connect()
+            except (socket.error, OSError):
+                pass
+
+            process = self._start()
+            # Wait for the server to import everything and listen.
+            while True:
+                try:
+                    return self._connect()
+                except (socket.error, OSError):
+                    if process.poll() is not None:
+                        raise
+                    time.sleep(0.02)
+
+    def run(self, args, prefix, parallel):
+        """Runs a command, and returns the exit code, or None if it couldn't"""
+        import logging
+        from spiny import output, timing
+        logger = logging.getLogger('spiny')
+        if not self.supports(args):
+            return None
+        start = time.time()
+
+        for attempt in range(2):
+            try:
+                sock = self.connect()
+            except (socket.error, OSError):
+                logger.log(10, 'Could not start the fork server for %s' % prefix, exc_info=1)
+                return None
+
+            request = dict(process_state(), key=self.key, args=args[1:], cwd=os.getcwd())
+            sock.sendall((json.dumps(request) + '\n').encode('utf8'))
+            reader = sock.makefile('rb')
+            try:
+                first = reader.readline().decode('utf8', 'replace')
+                if not first.startswith(EXIT_MARKER + 'pid:'):
+                    # A server for an older virtualenv, that has now stopped.
+                    continue
+                process = RemoteProcess(int(first[len(EXIT_MARKER) + 4:]))
+                output.track(process)
+                try:
+                    return self._read(reader, prefix, parallel)
+                finally:
+                    output.untrack(process)
+                    # Not a child of spiny, so there is no resource usage.
+                    timing.command(' '.join(args), time.time() - start)
+            finally:
+                reader.close()
+                sock.close()
+        return None
+
+    def _read(self, reader, prefix, parallel):
+        import logging
+        logger = logging.getLogger('spiny')
+        for line in iter(reader.readline, b''):
+            text = line.decode('utf8', 'replace')
+            if EXIT_MARKER in text:
+                text, code = text.split(EXIT_MARKER, 1)
+            else:
+                code = None
+            if text:
+                if parallel:
+                    logger.log(30, '%s: %s' % (prefix, text.rstrip('\r\n')))
+                else:
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+            if code is not None:
+                return int(code)
+        # The command was killed.
+        return 1
+
+
+if __name__ == '__main__':
+    # Don't let the spiny directory shadow anything.
+    if sys.path and os.path.abspath(sys.path[0]) == os.path.dirname(os.path.abspath(__file__)):
+        del sys.path[0]
+    serve(sys.argv[1], sys.argv[2], float(sys.argv[3]), sys.argv[4:])
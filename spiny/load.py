@@ -0,0 +1,203 @@
+# Finds how much CPU and memory is free, so the environments can be run as
+# many at a time as the machine can take, also on shared machines and in
+# containers with a CPU quota.
+import logging
+import os
+import os.path
+import time
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_CGROUP = '/proc/self/cgroup'
+MEMINFO = '/proc/meminfo'
+
+# cgroup v1 uses a huge number for no memory limit.
+NO_MEMORY_LIMIT = 2 ** 60
+
+logger = logging.getLogger('spiny')
+
+
+def _read(path):
+    try:
+        with open(path, 'rt') as infile:
+            return infile.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_dirs(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """The cgroup v2 directories of this process, from its own up to the root"""
+    path = None
+    for line in (_read(proc_cgroup) or '').splitlines():
+        if line.startswith('0::'):
+            path = line[3:].strip('/')
+    dirs = [root]
+    if path:
+        parts = path.split('/')
+        for index in range(len(parts), 0, -1):
+            dirs.insert(len(dirs) - 1, os.path.join(root, *parts[:index]))
+    return dirs
+
+
+def _cpu_limits(root, proc_cgroup):
+    """The CPU quotas of the cgroups, with the file that has the CPU time used in each"""
+    limits = []
+    for directory in cgroup_dirs(root, proc_cgroup):
+        value = _read(os.path.join(directory, 'cpu.max'))
+        if value is not None and not value.startswith('max'):
+            quota, period = (value.split() + ['100000'])[:2]
+            limits.append((int(quota) / float(period), os.path.join(directory, 'cpu.stat')))
+    # cgroup v1
+    quota = _read(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read(os.path.join(root, 'cpu', 'cpu.cfs_period_us'))
+    if quota is not None and period is not None and int(quota) > 0:
+        limits.append((int(quota) / float(period), os.path.join(root, 'cpu', 'cpuacct.usage')))
+    return limits
+
+
+def cpu_quota(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """The CPU limit of the cgroups, as a number of CPUs, or None if there is none"""
+    limits = _cpu_limits(root, proc_cgroup)
+    if not limits:
+        return None
+    return min(limits)[0]
+
+
+def cpu_time(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP):
+    """The CPU seconds used in the cgroup with the lowest CPU limit, or None if there is none"""
+    limits = _cpu_limits(root, proc_cgroup)
+    if not limits:
+        return None
+    path = min(limits)[1]
+    text = _read(path)
+    if text is None:
+        return None
+    if path.endswith('cpuacct.usage'):
+        # Nanoseconds in cgroup v1.
+        return int(text) / 1e9
+    for line in text.splitlines():
+        if line.startswith('usage_usec '):
+            return int(line.split()[1]) / 1e6
+    return None
+
+
+def cpu_count():
+    """The number of CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def available_cpus():
+    """The number of CPUs that can be used, with the cgroup quota, at least 1"""
+    cpus = cpu_count()
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(1, int(cpus))
+
+
+def load_average():
+    """The load average of the last minute, or None if it isn't known"""
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        # Windows
+        return None
+
+
+def available_memory(root=CGROUP_ROOT, proc_cgroup=PROC_CGROUP, meminfo=MEMINFO):
+    """The bytes of memory that can be used without swapping, or None if it isn't known"""
+    available = []
+    for line in (_read(meminfo) or '').splitlines():
+        if line.startswith('MemAvailable:'):
+            available.append(int(line.split()[1]) * 1024)
+
+    for directory in cgroup_dirs(root, proc_cgroup):
+        limit = _read(os.path.join(directory, 'memory.max'))
+        current = _read(os.path.join(directory, 'memory.current'))
+        if limit is not None and current is not None and limit != 'max':
+            available.append(max(0, int(limit) - int(current)))
+    # cgroup v1
+    limit = _read(os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+    usage = _read(os.path.join(root, 'memory', 'memory.usage_in_bytes'))
+    if limit is not None and usage is not None and int(limit) < NO_MEMORY_LIMIT:
+        available.append(max(0, int(limit) - int(usage)))
+
+    if not available:
+        return None
+    return min(available)
+
+
+def parse_cpu_list(text):
+    """Parses a list of CPUs like '0-3,6' into a set of CPU numbers"""
+    cpus = set()
+    for part in text.replace(' ', ',').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+class Controller(object):
+    """Decides how many environments may run each stage, while they run
+
+    Tests use the CPU, so they are only started while there are CPUs free,
+    counting the load of other processes on the machine, but not the tests
+    that are already running. In a cgroup with a CPU limit, like a container,
+    the CPUs used in the cgroup over the last interval are the load instead,
+    as the load average is for the whole machine. Installing is mostly waiting, so it is not
+    limited by the load. Nothing new is started while less than
+    min_free_memory bytes are free. A stage that has nothing running may
+    always start one job, so the run always gets done.
+    """
+
+    def __init__(self, min_free_memory=512 * 1024 * 1024, interval=1.0):
+        self.min_free_memory = min_free_memory
+        # How often to check if more can be started, in seconds.
+        self.interval = interval
+        self._limits = {}
+        # The last (time, CPU time) of the cgroup, and the CPUs used since.
+        self._sample = None
+        self._cgroup_load = None
+
+    def load(self):
+        """The number of CPUs in use, or None if it isn't known yet"""
+        used = cpu_time()
+        if used is None:
+            # No CPU limit, so all the CPUs on the machine are there to use.
+            return load_average()
+        now = time.time()
+        if self._sample is None:
+            self._sample = (now, used)
+        elif now - self._sample[0] >= max(self.interval, 0.01):
+            self._cgroup_load = (used - self._sample[1]) / (now - self._sample[0])
+            self._sample = (now, used)
+        return self._cgroup_load
+
+    def limit(self, stage, running):
+        """How many jobs of a stage may run now, when running are running"""
+        limit = None
+        if stage == 'test':
+            cpus = available_cpus()
+            load = self.load()
+            if load is None:
+                limit = cpus
+            else:
+                # The tests that are running are part of the load.
+                limit = int(cpus - max(0.0, load - running))
+
+        memory = available_memory()
+        if memory is not None and memory < self.min_free_memory:
+            limit = running
+
+        if limit is not None:
+            limit = max(1, limit)
+            if self._limits.get(stage) != limit:
+                logger.log(20, 'Running at most %s at a time in the %s stage' % (limit, stage))
+            self._limits[stage] = limit
+        return limit
@@ -1,17 +1,14 @@
 import argparse
 import logging
-import multiprocessing
 import os
 import os.path
-import pkg_resources
+import shutil
 import signal
 import sys
 
 if sys.version_info < (3,):
-    import subprocess32 as subprocess
     from ConfigParser import ConfigParser
 else:
-    import subprocess
     from configparser import ConfigParser
 
 if sys.platform == 'win32':
@@ -19,9 +16,9 @@ if sys.platform == 'win32':
 else:
     null = '/dev/null'
 
-from spiny import environment, projectdata
-
-__version__ = pkg_resources.require("spiny")[0].version
+# The other modules are imported where they are used, so --help and
+# --version start fast.
+from spiny import environment, output, projectdata, timing, venvs
 
 logger = logging.getLogger('spiny')
 
@@ -78,7 +75,12 @@ def setup_logging(verbose, quiet):
 
 def run_all_tests(config):
     """Run a list of commands in each virtualenv"""
+    return run_prepared(prepare_tests(config))
+
 
+def prepare_tests(config):
+    """Finds the Pythons and the requirements, and what to run for each environment"""
+    from spiny import load, wheelhouse
     # Get the location of environments.
     if config.has_option('spiny', 'venv-dir'):
         venv_dir = config.get('spiny', 'venv-dir')
@@ -86,9 +88,20 @@ def run_all_tests(config):
         venv_dir = '.venv'
     venv_dir = os.path.abspath(venv_dir)
 
+    # Run the environments on other spiny processes, see spiny.remote.
+    if config.has_option('spiny', 'workers'):
+        workers = config.get('spiny', 'workers').split()
+    else:
+        workers = []
+
     # Get the list of environments to be used:
-    pythons = environment.get_pythons(config)
-    envnames = environment.get_environments(config)
+    with timing.phase('discovery'):
+        if workers:
+            # The workers find their own Pythons.
+            pythons = {}
+        else:
+            pythons = environment.get_pythons(config)
+        envnames = environment.get_environments(config)
     if not envnames:
         print("You must specify which Python environments to run tests under, "
               "either in setup.py or with the --envlist argument.")
@@ -96,21 +109,74 @@ def run_all_tests(config):
 
     # Get the setup commands:
     if config.has_option('spiny', 'setup-commands'):
-        setup_commands = filter(None, config.get('spiny', 'setup-commands').splitlines())
+        setup_commands = list(filter(None, config.get('spiny', 'setup-commands').splitlines()))
     else:
         setup_commands = None
 
     # Get the test commands:
     if config.has_option('spiny', 'test-commands'):
-        test_commands = filter(None, config.get('spiny', 'test-commands').splitlines())
+        test_commands = list(filter(None, config.get('spiny', 'test-commands').splitlines()))
     else:
         test_commands = ['{envpython} setup.py test']
 
+    # Get how to create virtualenvs from templates:
+    options = {}
+    if config.has_option('spiny', 'venv-template'):
+        options['venv-template'] = config.get('spiny', 'venv-template').lower()
+    else:
+        options['venv-template'] = 'copy'
+    if options['venv-template'] not in ('copy', 'hardlink', 'off'):
+        raise ValueError('venv-template must be one of copy, hardlink or off')
+    if config.has_option('spiny', 'template-dir'):
+        options['template-dir'] = config.get('spiny', 'template-dir')
+    else:
+        options['template-dir'] = '~/.cache/spiny/templates'
+    options['shared-pip'] = (config.has_option('spiny', 'venv-pip') and
+                             config.get('spiny', 'venv-pip').lower() == 'shared')
+
+    # Get where to build wheels for the requirements:
+    if (config.has_option('spiny', 'use-wheelhouse') and
+        config.get('spiny', 'use-wheelhouse').lower() in
+        ['false', 'off', '0', 'no']):
+        wheelhouse_dir = None
+    elif config.has_option('spiny', 'wheelhouse-dir'):
+        wheelhouse_dir = config.get('spiny', 'wheelhouse-dir')
+    else:
+        wheelhouse_dir = '~/.cache/spiny/wheelhouse'
+
+    # Stop everything when one environment fails.
+    fail_fast = (config.has_option('spiny', 'fail-fast') and
+                 config.get('spiny', 'fail-fast').lower() in ['true', 'on', '1', 'yes'])
+
+    # Where to write the JSON timing report.
+    if config.has_option('spiny', 'report-file'):
+        report_file = config.get('spiny', 'report-file')
+    else:
+        report_file = None
+
     if config.has_option('spiny', 'max-processes'):
         max_proc = int(config.get('spiny', 'max-processes'))
     else:
         max_proc = None
 
+    # Start fewer environments while the machine is busy or short of memory.
+    adaptive = (config.has_option('spiny', 'adaptive-processes') and
+                config.get('spiny', 'adaptive-processes').lower() in ['true', 'on', '1', 'yes'])
+    if config.has_option('spiny', 'min-free-memory'):
+        min_free_memory = int(config.get('spiny', 'min-free-memory')) * 1024 * 1024
+    else:
+        min_free_memory = 512 * 1024 * 1024
+
+    # Lower the priority of the installs, and pin the stages to CPUs, so the
+    # installs don't slow down the tests.
+    nice = {}
+    if config.has_option('spiny', 'install-nice'):
+        nice['setup'] = int(config.get('spiny', 'install-nice'))
+    cpu_sets = {}
+    for stage, option in (('setup', 'install-cpus'), ('test', 'test-cpus')):
+        if config.has_option('spiny', option):
+            cpu_sets[stage] = load.parse_cpu_list(config.get('spiny', option))
+
     # Get requirements from requirements.txt.
     requirements = []
     if not (config.has_option('spiny', 'use-requirements-txt') and
@@ -118,7 +184,7 @@ def run_all_tests(config):
             ['false', 'off', '0', 'no']):
         if os.path.isfile('requirements.txt'):
             with open('requirements.txt', 'rt') as reqtxt:
-                requirements.extend(reqtxt.readlines())
+                requirements.extend(wheelhouse.clean_requirements(reqtxt.readlines()))
 
     if (config.has_option('spiny', 'use-setup-py') and
         config.get('spiny', 'use-setup-py').lower() in
@@ -128,15 +194,76 @@ def run_all_tests(config):
     else:
         use_setup = True
 
+    # How many independent test commands to run at the same time in each virtualenv.
+    if config.has_option('spiny', 'test-command-processes'):
+        options['test-command-processes'] = int(config.get('spiny', 'test-command-processes'))
+    else:
+        options['test-command-processes'] = 1
+
+    # Split test commands with {tests} in them into shards.
+    if config.has_option('spiny', 'test-shards'):
+        options['test-shards'] = int(config.get('spiny', 'test-shards'))
+    else:
+        options['test-shards'] = 1
+    if config.has_option('spiny', 'shard-list-command'):
+        options['shard-list-command'] = config.get('spiny', 'shard-list-command')
+
+    # Fork the test commands from a Python that has imported the requirements.
+    options['fork-server'] = (
+        hasattr(os, 'fork') and config.has_option('spiny', 'fork-server') and
+        config.get('spiny', 'fork-server').lower() in ['true', 'on', '1', 'yes'])
+    if config.has_option('spiny', 'fork-server-preload'):
+        options['fork-server-preload'] = config.get('spiny', 'fork-server-preload').split()
+    else:
+        options['fork-server-preload'] = []
+    if config.has_option('spiny', 'fork-server-timeout'):
+        options['fork-server-timeout'] = int(config.get('spiny', 'fork-server-timeout'))
+    else:
+        options['fork-server-timeout'] = 600
+
     if config.has_option('spiny', 'changedir'):
         curdir = config.get('spiny', 'changedir')
     else:
         curdir = None
 
+    projectdir = os.path.abspath(os.path.curdir)
+    cache = environment.get_cache(config)
+
+    if workers:
+        # The workers read the project data for their Pythons, and have
+        # their own virtualenvs and wheels.
+        from spiny import remote
+        if config.has_option('spiny', 'worker-key'):
+            key = config.get('spiny', 'worker-key')
+        else:
+            key = os.environ.get('SPINY_WORKER_KEY')
+        jobs = [remote.make_job(envname, setup_commands, test_commands, requirements,
+                                use_setup, curdir, options) for envname in envnames]
+        return {'argslist': [],
+                'jobs': jobs,
+                'workers': workers,
+                'worker-key': key,
+                'project-dir': projectdir,
+                'skips': [],
+                'fail-fast': fail_fast,
+                'venv-dir': venv_dir,
+                'report-file': report_file,
+                'cache': cache}
+
     if not os.path.exists(venv_dir):
         os.mkdir(venv_dir)
 
-    projectdir = os.path.abspath(os.path.curdir)
+    if options['shared-pip']:
+        # Check the version of pip once, the processes that install inherit it.
+        venvs.shared_pip_supported()
+
+    if use_setup:
+        # Get the data from setup.py, running it under all the Pythons at once.
+        with timing.phase('metadata'):
+            project_datas = projectdata.get_all_data(
+                projectdir, dict((envname, pythons[envname]) for envname in envnames
+                                 if envname in pythons),
+                cache, max_proc or load.available_cpus())
 
     executes = []
     skips = []
@@ -144,206 +271,467 @@ def run_all_tests(config):
     for envname in envnames:
         if envname in pythons:
             executes.append(envname)
-
-            # Get requirements from setup.py
-            reqs = requirements[:]
-            if use_setup:
-                project_data = projectdata.get_data('.', pythons[envname]['version'])
-                reqs.extend(project_data.get('install_requires', []))
-                reqs.extend(project_data.get('setup_requires', []))
-                reqs.extend(project_data.get('tests_require', []))
-                reqs.extend(project_data.get('extras_require', {}).get('tests', []))
-                dependency_links = project_data.get('dependency_links', [])
-            else:
-                # Use of setup.py is disabled.
-                dependency_links = []
-
-            arguments = (envname,
-                         pythons[envname],
-                         venv_dir,
-                         setup_commands,
-                         test_commands,
-                         reqs,
-                         dependency_links,
-                         projectdir,
-                         curdir)
-            argslist.append(arguments)
+            argslist.append(environment_args(
+                envname, pythons[envname], venv_dir, setup_commands, test_commands,
+                requirements, project_datas[envname] if use_setup else None,
+                projectdir, curdir, options))
         else:
             skips.append(envname)
 
-    cpus = min(multiprocessing.cpu_count(), len(executes))
+    # The CPUs this process may use, within the CPU quota of a container.
+    cpus = min(load.available_cpus(), len(executes))
     if max_proc:
         cpus = min(cpus, max_proc)
 
-    all_reqs = [args[5] for args in argslist]
-    for req in all_reqs:
-        if req != all_reqs[0]:
-            # There are different requirements for different versions.
-            # Then we can't run the tests in parallell.
-            cpus = 1
-            logger.log(30, "Version dependent requirements detected, "
-                           "not using parallelism.")
-            break
-
-    logger.log(20, "Using %s parallel processes" % cpus)
-    argslist = [args + (cpus > 1,) for args in argslist]
-    pool = multiprocessing.Pool(processes=cpus)
-    results = pool.map(run_tests, argslist)
-    results = dict(zip(executes, results))
-    for envname in skips:
+    # Installing is mostly waiting for the network and disk, and running
+    # tests mostly uses the CPU, so they can have separate limits.
+    if config.has_option('spiny', 'install-processes'):
+        install_proc = min(int(config.get('spiny', 'install-processes')), len(executes))
+    else:
+        install_proc = cpus
+    if config.has_option('spiny', 'test-processes'):
+        test_proc = min(int(config.get('spiny', 'test-processes')), len(executes))
+    else:
+        test_proc = cpus
+    # With one process for each stage, everything runs one at a time.
+    parallel = len(executes) > 1 and (install_proc, test_proc) != (1, 1)
+
+    if wheelhouse_dir is not None:
+        # Build the wheels for all environments once, before installing.
+        jobs = [(args[0], args[1], args[5], args[6]) for args in argslist]
+        with timing.phase('wheels'):
+            wheelhouses = wheelhouse.prepare(wheelhouse_dir, jobs,
+                                             max_proc or load.available_cpus(), parallel)
+        for args in argslist:
+            args[9]['wheelhouse'] = wheelhouses[args[0]]
+
+    logger.log(20, "Using %s install and %s test processes" % (install_proc, test_proc))
+    return {'argslist': [args + (parallel,) for args in argslist],
+            'skips': skips,
+            'install-processes': install_proc,
+            'test-processes': test_proc,
+            'adaptive': adaptive,
+            'min-free-memory': min_free_memory,
+            'nice': nice,
+            'cpu-sets': cpu_sets,
+            'fail-fast': fail_fast,
+            'venv-dir': venv_dir,
+            'report-file': report_file,
+            'cache': cache}
+
+
+def environment_args(envname, envdict, venv_dir, setup_commands, test_commands,
+                     requirements, project_data, projectdir, curdir, options):
+    """The arguments for setting up and testing an environment, except parallel
+
+    The requirements from setup.py are added to requirements, unless
+    project_data is None, when the use of setup.py is disabled.
+    """
+    reqs = requirements[:]
+    if project_data is not None:
+        # Get requirements from setup.py
+        reqs.extend(project_data.get('install_requires', []))
+        reqs.extend(project_data.get('setup_requires', []))
+        reqs.extend(project_data.get('tests_require', []))
+        reqs.extend(project_data.get('extras_require', {}).get('tests', []))
+        dependency_links = project_data.get('dependency_links', [])
+    else:
+        # Use of setup.py is disabled.
+        dependency_links = []
+
+    return (envname,
+            envdict,
+            venv_dir,
+            setup_commands,
+            test_commands,
+            reqs,
+            dependency_links,
+            projectdir,
+            curdir,
+            dict(options))
+
+
+def merge_durations(durations, new, skipped=()):
+    """The earlier durations, with those of the stages that ran this time
+
+    The setup of the skipped environments did not run, as they were already set up.
+    """
+    durations = dict((name, dict(stages)) for name, stages in durations.items())
+    for name, stages in new.items():
+        for stage, duration in stages.items():
+            if stage == 'setup' and name in skipped:
+                continue
+            durations.setdefault(name, {})[stage] = duration
+    return durations
+
+
+def run_prepared(plan):
+    """Sets up the virtualenvs and runs the tests, from prepare_tests()"""
+    from spiny import load, scheduler
+    # Start the environments that took the longest last time first.
+    cache = plan['cache']
+    durations = cache.get('durations', plan['venv-dir'], {})
+    if plan.get('workers'):
+        from spiny import remote
+        pipeline = remote.Coordinator(plan['workers'], plan['worker-key'], durations,
+                                      plan['fail-fast'])
+        results = pipeline.run(plan['jobs'], plan['project-dir'], [plan['venv-dir']])
+    else:
+        controller = None
+        if plan['adaptive']:
+            controller = load.Controller(plan['min-free-memory'])
+        pipeline = scheduler.Pipeline(setup_environment, test_environment,
+                                      plan['install-processes'], plan['test-processes'],
+                                      durations, plan['fail-fast'], controller,
+                                      plan['nice'], plan['cpu-sets'])
+        results = pipeline.run([(args[0], args) for args in plan['argslist']])
+    skipped = [args[0] for args in plan['argslist'] if args[9].get('skip-setup')]
+    durations = merge_durations(durations, pipeline.durations, skipped)
+    cache.set('durations', plan['venv-dir'], durations)
+    # Forget the projects that have not been run for a long time.
+    cache.prune('durations')
+    cache.save()
+
+    # The environments that were set up, and only need to run the tests again.
+    plan['tested'] = [name for name in pipeline.durations if 'test' in pipeline.durations[name]]
+
+    # The phases before the environments were timed in this process.
+    plan['records'] = timing.collect() + pipeline.records
+    if plan['report-file']:
+        timing.write_report(plan['report-file'], plan['records'])
+    for envname in plan['skips']:
         results[envname] = 'Error: Skipped %s' % envname
 
     return results
 
 
+def watch_tests(config_file, overrides):
+    """Runs the tests, and then again each time a file in the project changes"""
+    from spiny import watch
+    plan = prepare_tests(read_config(config_file, overrides))
+    results = run_prepared(plan)
+    print_summary(results, plan['records'])
+
+    watcher = watch.Watcher(os.path.abspath(os.path.curdir), [plan['venv-dir']])
+    logger.log(30, 'Watching for changes, press CTRL-C to stop.')
+    try:
+        while True:
+            changed = watcher.wait()
+            logger.log(20, 'Changed: %s' % ', '.join(changed))
+            if watch.needs_setup(changed) or os.path.abspath(config_file) in changed:
+                # The requirements or the configuration may have changed.
+                logger.log(30, 'Setup files changed, updating the virtualenvs.')
+                plan = prepare_tests(read_config(config_file, overrides))
+            else:
+                for args in plan['argslist']:
+                    args[9]['skip-setup'] = args[0] in plan['tested']
+            results = run_prepared(plan)
+            print_summary(results, plan['records'])
+            # Don't rerun for the files the tests wrote.
+            watcher.reset()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    return 1 if any(results.values()) else 0
+
+
+def environment_paths(args):
+    """Returns the virtualenv directory, its Python, the command variables and curdir"""
+    from spiny import shards
+    (envname, envdict, venv_dir, setup_commands, test_commands,
+     requirements, dependency_links, projectdir, curdir, options, parallel) = args
+
+    exepath = envdict['path']  # Actual Python exe
+    if envdict['backend'] == 'unsupported':
+        # Python 2.3 or earlier (or otherwise)
+        python = envdict['path']
+        envdir = os.path.dirname(os.path.dirname(python))
+    else:
+        envdir = os.path.join(venv_dir, envname)  # virtualenv dir
+        python = os.path.join(envdir, 'bin', envdict['execname'])  # Virtualenv python
+
+    env_parameters = {
+        'basepython': exepath,
+        'envdir': envdir,
+        'envpython': python,
+        'projectdir': projectdir,
+        # A JUnit XML report, test-shards reads the time of each test from it.
+        'junitxml': os.path.join(envdir, shards.JUNIT_FILE),
+    }
+
+    # Expand the current directory
+    if curdir is not None:
+        curdir = curdir.format(**env_parameters)
+    else:
+        curdir = projectdir
+
+    return envdir, python, env_parameters, curdir
+
+
 def run_tests(args):
+    """Sets up the virtualenv and runs the tests in it"""
+    msg = setup_environment(args)
+    if msg:
+        return msg
+    return test_environment(args)
+
+
+def setup_environment(args):
+    """Creates or updates the virtualenv, and installs the requirements"""
+    from spiny import wheelhouse
     try:
         (envname, envdict, venv_dir, setup_commands, test_commands,
-         requirements, dependency_links, projectdir, curdir, parallel) = args
+         requirements, dependency_links, projectdir, curdir, options, parallel) = args
 
-        if parallel:
-            stdout = stderr = subprocess.PIPE
-        else:
-            # Don't redirect if only one process.
-            stdout = stderr = None
-        exepath = envdict['path']  # Actual Python exe
-        if envdict['virtualenv'] == 'unsupported':
-            # Python 2.3 or earlier (or otherwise)
-            python = envdict['path']
-            envdir = os.path.dirname(os.path.dirname(python))
-        else:
-            envdir = os.path.join(venv_dir, envname)  # virtualenv dir
-            python = os.path.join(envdir, 'bin', envdict['execname'])  # Virtualenv python
-
-        env_parameters = {
-            'basepython': exepath,
-            'envdir': envdir,
-            'envpython': python,
-            'projectdir': projectdir,
-        }
-
-        # Expand the current directory
-        if curdir is not None:
-            curdir = curdir.format(**env_parameters)
-        else:
-            curdir = projectdir
+        if options.get('skip-setup'):
+            # Watching for changes, and the virtualenv is already up to date.
+            return None
 
-        # Create a "profile"" of this virtualenv, include name, the python exe and requirements.
-        venv_profile = '\n'.join([envname, exepath, '\n'.join(sorted(requirements))])
-        # Check if there is an existing venv, and in that case read in it's profile:
+        envdir, python, env_parameters, curdir = environment_paths(args)
+
+        # Create a profile of this virtualenv, with the name, the python exe and
+        # requirements, and compare it with the profile of an existing venv.
+        profile = venvs.make_profile(envname, envdict, setup_commands, requirements)
         profile_path = os.path.join(envdir, '.spiny-profile')
-        if os.path.exists(profile_path):
-            with open(profile_path, 'rb') as profile:
-                installed_profile = profile.read()
-        else:
-            installed_profile = ''
-
-        if venv_profile != installed_profile:
-            # We need to install the virtualenv or update the requirements.
-
-            if not setup_commands:
-                if envdict['virtualenv'] == 'internal':
-                    # Internal means use the virtualenv for the relevant Python
-                    venvexe = exepath
-                elif envdict['virtualenv'] == 'external':
-                    # External means use the virtualenv for the current Python
-                    venvexe = sys.executable
-                if envdict['virtualenv'] == 'unsupported':
-                    # No virtualenv
-                    setup_commands = [[]]
+        installed_profile = venvs.read_profile(profile_path)
+
+        with timing.phase('venv', envname):
+            if venvs.needs_rebuild(installed_profile, profile) or not os.path.exists(python):
+                # We need to install the virtualenv.
+
+                if not setup_commands:
+                    command = venvs.setup_command(envdict, options['shared-pip'])
+                    if command is None:
+                        # No virtualenv
+                        setup_commands = []
+                    elif options['venv-template'] != 'off':
+                        # Copy a pristine virtualenv made once per Python, as
+                        # making each virtualenv from scratch is slow.
+                        template = venvs.get_template(options['template-dir'], envdict,
+                                                      command, parallel)
+                        if template is None:
+                            msg = "Installing/updating virtualenv for %s failed!" % envname
+                            logger.log(30, msg)
+                            return msg
+                        logger.log(10, 'Copying virtualenv template %s' % template)
+                        venvs.clone(template, envdir, options['venv-template'])
+                        setup_commands = []
+                    else:
+                        setup_commands = [command + [envdir]]
+
                 else:
-                    setup_commands = [[venvexe, '-m', 'virtualenv', '-v',
-                                       '-p', exepath, envdir]]
+                    setup_commands = [command.format(**env_parameters).split()
+                                      for command in setup_commands]
 
-            else:
-                setup_commands = [command.format(**env_parameters).split() for command in setup_commands]
-
-            logger.log(30, 'Install/update virtualenv for %s' % envname)
-            for command in setup_commands:
-
-                # Switch to curdir, if it exists.
-                if curdir is not None and os.path.isdir(curdir):
-                    os.chdir(curdir)
-
-                logger.log(10, 'Using command: %s' % ' '.join(command))
-                with subprocess.Popen(command,
-                                      stdout=stdout,
-                                      stderr=stderr) as process:
-                    process.wait()
-                    if parallel:
-                        logger.log(30, process.stderr.read())
-                        logger.log(20, process.stdout.read())
-                    if process.returncode != 0:
+                logger.log(30, 'Install/update virtualenv for %s' % envname)
+                for command in setup_commands:
+
+                    # Switch to curdir, if it exists.
+                    if curdir is not None and os.path.isdir(curdir):
+                        os.chdir(curdir)
+
+                    logger.log(10, 'Using command: %s' % ' '.join(command))
+                    returncode, tail = output.run(command, envname, parallel)
+                    if returncode != 0:
                         # This failed somehow
                         msg = "Installing/updating virtualenv for %s failed!" % envname
                         logger.log(30, msg)
                         return msg
 
-            if requirements:
+                to_install, to_uninstall = profile['requirements'], []
+            else:
+                # Only the requirements that changed need to be installed or removed.
+                to_install, to_uninstall = venvs.diff_requirements(
+                    installed_profile['requirements'], profile['requirements'])
+
+        with timing.phase('install', envname):
+            pip_command = venvs.pip_command(envdict, envdir, python, options['shared-pip'])
+            if to_uninstall:
+                # Keep what the other requirements still need.
+                required = venvs.required_by_others(python, to_uninstall)
+                if required:
+                    logger.log(20, 'Keeping %s for %s, other requirements need them' %
+                               (', '.join(sorted(required)), envname))
+                    to_uninstall = [name for name in to_uninstall if name not in required]
+            if to_uninstall:
+                logger.log(30, 'Removing dependencies for %s' % envname)
+                command = pip_command + ['uninstall', '-y', '-q'] + to_uninstall
+
+                logger.log(10, 'Remove dependencies with command: %s' % ' '.join(command))
+                returncode, tail = output.run(command, envname, parallel)
+                if returncode != 0:
+                    msg = "Removing dependencies for %s failed!" % envname
+                    logger.log(30, msg)
+                    return msg
+
+            if to_install:
                 # Install dependencies:
-                pip_path = os.path.join(envdir, 'bin', 'pip')
-                parameters = '-f '.join(dependency_links).split()
+                logger.log(30, 'Install/update dependencies for %s' % envname)
+                if options.get('wheelhouse'):
+                    # Everything is already built, install it from there.
+                    parameters = ['--no-index', '-f', options['wheelhouse']]
+                else:
+                    parameters = wheelhouse.find_links(dependency_links)
                 parameters.append('-q')
                 if envdict['python'] == 'Python' and envdict['version'] < '2.6':
                     # Using 2.5 or worse means no SSL.
                     parameters.append('--insecure')
 
-                command = [pip_path] + parameters + ['install'] + requirements
+                command = pip_command + ['install'] + parameters + to_install
 
                 logger.log(10, 'Install dependencies with command: %s' % ' '.join(command))
-                with subprocess.Popen(command,
-                                      stdout=stdout,
-                                      stderr=stderr) as process:
-                    process.wait()
-                    if parallel:
-                        logger.log(30, process.stderr.read())  # Log stderr only if verbose output.
-                    if process.returncode != 0:
-                        # This failed somehow.
-                        msg = "Installing/updating dependencies for %s failed!" % envname
-                        logger.log(30, msg)
-                        if parallel:
-                            # pip has the error on stdout. Log it on normal level.
-                            logger.log(30, process.stdout.read())
-                        return msg
-                    elif parallel:
-                        # Log successful stdout only if output level is verbse.
-                        logger.log(20, process.stdout.read())
-
+                # pip has the errors on stdout, those are logged at the end if it fails.
+                returncode, tail = output.run(command, envname, parallel)
+                if returncode != 0:
+                    # This failed somehow.
+                    msg = "Installing/updating dependencies for %s failed!" % envname
+                    logger.log(30, msg)
+                    return msg
+
+            broken = False
+            if to_uninstall:
+                command = pip_command + ['check']
+                logger.log(10, 'Check dependencies with command: %s' % ' '.join(command))
+                returncode, tail = output.run(command, envname, parallel)
+                broken = returncode != 0
+
+        if broken:
+            # Something that was removed was still needed, start over.
+            logger.log(30, 'Dependencies of %s are broken, rebuilding the virtualenv' %
+                       envname)
+            shutil.rmtree(envdir)
+            return setup_environment(args)
+
+        if profile != installed_profile:
             # Save the venv information:
-            with open(profile_path, 'wt') as profile:
-                profile.write(venv_profile)
+            venvs.write_profile(profile_path, profile)
 
-        # Run tests:
-        logger.log(30, 'Running tests for %s' % envname)
+        return None
 
-        for command in test_commands:
-            command = command.strip().format(**env_parameters)
-            logger.log(10, 'Using command: %s' % command)
-            with open(null) as nullfile:
-                if parallel:
-                    stdin = nullfile
+    except KeyboardInterrupt:
+        return "Tests interrupted by CTRL-C"
+
+
+def test_environment(args):
+    """Runs the test commands in an installed virtualenv"""
+    from spiny import forkserver, shards
+    try:
+        (envname, envdict, venv_dir, setup_commands, test_commands,
+         requirements, dependency_links, projectdir, curdir, options, parallel) = args
+
+        envdir, python, env_parameters, curdir = environment_paths(args)
+
+        # Switch to curdir, if it exists.
+        if os.path.isdir(curdir):
+            os.chdir(curdir)
+
+        with timing.phase('test', envname):
+            # Run tests:
+            logger.log(30, 'Running tests for %s' % envname)
+
+            # Commands on one line joined with && are run in sequence.
+            groups = [[command.strip().format(tests='{tests}', **env_parameters)
+                       for command in line.split('&&')]
+                      for line in test_commands]
+            if options.get('test-shards', 1) > 1:
+                list_command = options.get('shard-list-command')
+                if list_command:
+                    list_command = list_command.format(**env_parameters)
+                sharder = shards.Sharder(python, envdir, options['test-shards'], list_command)
+            else:
+                sharder = None
+            if options.get('fork-server') and envdict['backend'] != 'unsupported':
+                preload = forkserver.module_names(requirements) + options['fork-server-preload']
+                server = forkserver.ForkServer(python, envdir, preload,
+                                               options['fork-server-timeout'])
+            else:
+                server = None
+            processes = min(options.get('test-command-processes', 1), len(groups))
+            if processes <= 1:
+                failed = run_commands([command for group in groups for command in group],
+                                      envname, parallel, sharder, server)
+                if failed is not None:
+                    msg = "Tests failed for %s!" % envname
+                    return msg
+                return None
+
+            # Each line is independent, and they run at the same time.
+            def run_group(index):
+                return run_commands(groups[index], '%s [%s]' % (envname, index + 1), True,
+                                    sharder, server)
+
+            failures = []
+            results = environment.map_concurrently(run_group, range(len(groups)), processes)
+            for index, failed in enumerate(results):
+                if failed is None:
+                    logger.log(30, '%s [%s] passed: %s' %
+                               (envname, index + 1, ' && '.join(groups[index])))
                 else:
-                    stdin = None  # Don't redirect if only one process.
-                with subprocess.Popen(command.split(),
-                                      stdout=stdout,
-                                      stderr=stderr,
-                                      stdin=stdin) as process:
-                    process.wait()
-                    if parallel:
-                        # Display the outputs
-                        logger.log(30, process.stderr.read().decode())
-                        logger.log(30, process.stdout.read().decode())
-                    if process.returncode != 0:
-                        msg = "Tests failed for %s!" % envname
-                        return msg
+                    logger.log(30, '%s [%s] failed: %s' % (envname, index + 1, failed))
+                    failures.append(failed)
+            if failures:
+                msg = "Tests failed for %s! Failed commands: %s" % (envname, ', '.join(failures))
+                return msg
 
-        return None
+            return None
 
     except KeyboardInterrupt:
         return "Tests interrupted by CTRL-C"
 
 
+def run_commands(commands, prefix, parallel, sharder=None, server=None):
+    """Runs test commands in sequence, and returns the first that failed, or None"""
+    with open(null) as nullfile:
+        if parallel:
+            stdin = nullfile
+        else:
+            stdin = None  # Don't redirect if only one process.
+        for command in commands:
+            logger.log(10, 'Using command: %s' % command)
+            if '{tests}' in command.split() and sharder is not None:
+                # Split the tests between several processes.
+                if not sharder.run(command, prefix, nullfile):
+                    return command
+                continue
+            command = command.replace('{tests}', '')
+            returncode = None
+            if server is not None:
+                # Forked from a Python that has imported everything already.
+                returncode = server.run(command.split(), prefix, parallel)
+            if returncode is None:
+                # Display the outputs
+                returncode, tail = output.run(command.split(), prefix, parallel,
+                                              stdout_level=30, stdin=stdin)
+            if returncode != 0:
+                return command
+    return None
+
+
+def get_version():
+    """The installed version of spiny"""
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # Python 3.7 and earlier, pkg_resources is slow to import.
+        import pkg_resources
+        return pkg_resources.require('spiny')[0].version
+    return version('spiny')
+
+
+class VersionAction(argparse.Action):
+    """Shows the version, which is only looked up when asked for"""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        sys.stdout.write(get_version() + '\n')
+        parser.exit()
+
+
 def main():
+    if sys.argv[1:2] == ['worker']:
+        return worker_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description='Run tests under several Python versions.',
         add_help=False
@@ -357,8 +745,8 @@ def main():
 
     parser.add_argument(
         '--version',
-        action='version',
-        version=__version__,
+        action=VersionAction,
+        nargs=0,
         help='Show the version and exit.')
 
     parser.add_argument(
@@ -390,6 +778,23 @@ def main():
         action='count',
         help='Reduces output to only the run summary, -qq removes also that.')
 
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='Stop all environments as soon as one fails.')
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Run the tests again each time a file in the project changes.')
+
+    parser.add_argument(
+        '--report',
+        action='store',
+        metavar='<filename>',
+        type=str,
+        help='Write the time and resources used by each phase to a JSON file.')
+
     parser.add_argument(
         'configvar',
         action='store',
@@ -405,11 +810,111 @@ def main():
 
     if args.envlist:
         args.configvar.append('spiny:environments=' + args.envlist.replace(',', ' '))
-    return run(args.config, args.configvar)
+    if args.fail_fast:
+        args.configvar.append('spiny:fail-fast=true')
+    if args.report:
+        args.configvar.append('spiny:report-file=' + args.report)
+    return run(args.config, args.configvar, args.watch)
+
+
+def worker_main(argv):
+    """Runs environments for spiny processes that have the workers option"""
+    from spiny import load, remote
+    parser = argparse.ArgumentParser(
+        prog='spiny worker',
+        description='Run the environments that other spiny processes send.')
+
+    parser.add_argument(
+        '-l',
+        '--listen',
+        action='store',
+        default='127.0.0.1:%s' % remote.DEFAULT_PORT,
+        metavar='<host:port>',
+        help='The address to listen on. Defaults to 127.0.0.1:%s.' % remote.DEFAULT_PORT)
+
+    parser.add_argument(
+        '-s',
+        '--slots',
+        action='store',
+        type=int,
+        metavar='<number>',
+        help='How many environments to run at the same time. Defaults to the CPU count.')
+
+    parser.add_argument(
+        '-k',
+        '--key',
+        action='store',
+        default=os.environ.get('SPINY_WORKER_KEY'),
+        metavar='<key>',
+        help='Only run jobs from spiny processes with this worker-key. '
+             'Defaults to $SPINY_WORKER_KEY, and is required.')
+
+    parser.add_argument(
+        '-d',
+        '--dir',
+        action='store',
+        default=remote.DEFAULT_WORKER_DIR,
+        metavar='<directory>',
+        help='Where to keep the projects and virtualenvs. Defaults to %s.' %
+             remote.DEFAULT_WORKER_DIR)
+
+    parser.add_argument(
+        '-c',
+        '--config',
+        action='store',
+        metavar='<filename>',
+        help='A config file with the pythons of this host, in addition to '
+             '~/.config/spiny.cfg.')
+
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='count',
+        help='Increases the output.')
+
+    args = parser.parse_args(argv)
+    if not args.key:
+        # The worker runs whatever it is sent.
+        parser.error('A key is required, with --key or $SPINY_WORKER_KEY')
+    setup_logging(args.verbose, None)
+
+    if 'HOME' in os.environ:
+        home = os.environ['HOME']
+    else:
+        home = '~'
+    config_files = [os.path.join(home, '.config', 'spiny.cfg')]
+    if args.config:
+        config_files.append(os.path.abspath(args.config))
+
+    slots = args.slots
+    if slots is None:
+        slots = load.available_cpus()
+
+    worker = remote.Worker(args.listen, args.dir, slots, args.key, config_files)
+    try:
+        worker.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def print_summary(results, records=None):
+    from spiny import scheduler
+    if records:
+        table = timing.format_table(records)
+        if table:
+            logger.log(30, table)
+    for env in sorted(results):
+        if results.get(env) == scheduler.CANCELLED:
+            logger.log(40, "       Running tests under %s was cancelled." % env)
+        elif results.get(env):
+            logger.log(40, "ERROR: " + results[env])
+        else:
+            logger.log(40, "       Running tests under %s suceeded." % env)
 
 
-def run(config_file, overrides):
-    # Parse the config files
+def read_config(config_file, overrides):
+    """Reads the config files, and sets the section:variable=value overrides"""
     if 'HOME' in os.environ:
         home = os.environ['HOME']
     else:
@@ -430,15 +935,19 @@ def run(config_file, overrides):
         if not config.has_section(section):
             config.add_section(section)
         config.set(section.strip(), option.strip(), value.strip())
+    return config
+
+
+def run(config_file, overrides, watch_mode=False):
+    if watch_mode:
+        return watch_tests(config_file, overrides)
 
-    results = run_all_tests(config)
+    config = read_config(config_file, overrides)
+    plan = prepare_tests(config)
+    results = run_prepared(plan)
 
     # Done
-    for env in sorted(results):
-        if results.get(env):
-            logger.log(40, "ERROR: " + results[env])
-        else:
-            logger.log(40, "       Running tests under %s suceeded." % env)
+    print_summary(results, plan['records'])
 
     return 1 if any(results.values()) else 0
 
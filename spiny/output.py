@@ -0,0 +1,127 @@
+# Runs commands and forwards their output line by line while they run, so a
+# command with a lot of output can't fill the pipes and block.
+import collections
+import errno
+import logging
+import os
+import sys
+import threading
+import time
+
+if sys.version_info < (3,):
+    import subprocess32 as subprocess
+else:
+    import subprocess
+
+from spiny import timing
+
+# How many lines of output to keep for when a command fails.
+TAIL_LINES = 50
+
+logger = logging.getLogger('spiny')
+
+# The commands running in this process, so they can be stopped.
+_processes = set()
+
+
+def track(process):
+    """Terminate process with the commands of this process, it has a terminate() method"""
+    _processes.add(process)
+
+
+def untrack(process):
+    _processes.discard(process)
+
+
+def _wait(process):
+    """Waits for a process, and returns its resource usage, if the OS has wait4()"""
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+    try:
+        pid, status, usage = os.wait4(process.pid, 0)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        # Someone else waited for it already.
+        process.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return usage
+
+
+def terminate_all():
+    """Terminates all the commands that are running in this process"""
+    for process in list(_processes):
+        try:
+            process.terminate()
+        except OSError:
+            # Already finished.
+            pass
+
+
+def _drain(stream, prefix, level, tail, lock):
+    """Logs each line from a stream as it comes, keeping the last lines in tail"""
+    for line in iter(stream.readline, b''):
+        line = line.decode('utf8', 'replace').rstrip('\r\n')
+        with lock:
+            tail.append(line)
+        logger.log(level, '%s: %s' % (prefix, line))
+    stream.close()
+
+
+def run(command, prefix, parallel, stdout_level=20, stderr_level=30, stdin=None,
+        tail_lines=TAIL_LINES):
+    """Runs a command, and returns the return code and the last lines of output
+
+    When running in parallel, stdout and stderr are read at the same time
+    while the command runs, and each line is logged with the prefix, on
+    stdout_level and stderr_level. Only the last tail_lines lines are kept,
+    and if the command fails and they were not shown, they are logged then.
+    Otherwise the command writes directly to the terminal.
+
+    The time the command took, and its CPU time and peak memory use, are
+    recorded for the timing report.
+    """
+    start = time.time()
+    if not parallel:
+        # Don't redirect if only one process.
+        with subprocess.Popen(command, stdin=stdin) as process:
+            track(process)
+            try:
+                usage = _wait(process)
+            finally:
+                untrack(process)
+        timing.command(' '.join(command), time.time() - start, usage)
+        return process.returncode, []
+
+    tail = collections.deque(maxlen=tail_lines)
+    lock = threading.Lock()
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          stdin=stdin) as process:
+        track(process)
+        try:
+            threads = [
+                threading.Thread(target=_drain,
+                                 args=(process.stdout, prefix, stdout_level, tail, lock)),
+                threading.Thread(target=_drain,
+                                 args=(process.stderr, prefix, stderr_level, tail, lock)),
+            ]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+            usage = _wait(process)
+        finally:
+            untrack(process)
+    timing.command(' '.join(command), time.time() - start, usage)
+
+    tail = list(tail)
+    shown = logger.isEnabledFor(min(stdout_level, stderr_level))
+    if process.returncode != 0 and tail and not shown:
+        logger.log(30, '\n'.join(['Last output from %s:' % prefix] + tail))
+    return process.returncode, tail
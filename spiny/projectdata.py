@@ -1,9 +1,29 @@
 # Extracts information from a project that has a distutils setup.py file.
+import hashlib
+import json
 import os
 import sys
 import string
 import logging
 
+if sys.version_info < (3,):
+    try:
+        import subprocess32 as subprocess
+    except ImportError:
+        # When run as a script under a Python 2 without subprocess32.
+        import subprocess
+else:
+    import subprocess
+
+# Marks the line with the data, when get_data is run as a script.
+DATA_MARKER = 'spiny-data:'
+
+# The project data is read from these, when they change the virtualenvs
+# must be updated, not only the tests run.
+SETUP_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml', 'requirements.txt')
+
+logger = logging.getLogger('spiny')
+
 
 def parse_version(version):
     vmap = {'a': 'alpha', 'b': 'beta', 'c': 'candidate'}
@@ -134,6 +154,10 @@ def get_data(path, python_version=None):
     Returns data from a package directory.
     'path' should be an absolute path.
     """
+    if not os.path.isfile(os.path.join(path, 'setup.py')):
+        # Don't import some other setup module from the path.
+        return {}
+
     # Run the imported setup to get the metadata.
     with FakeContext(path):
         with SetupMonkey(python_version) as sm:
@@ -168,8 +192,121 @@ def get_data(path, python_version=None):
 
     return metadata
 
+def get_data_isolated(path, python_version=None, python=None):
+    """
+    Returns data from a package directory, like get_data(), but runs
+    setup.py in a separate process.
+
+    This way the patched Python version, sys.path and imports don't leak
+    between calls, and calls can safely run concurrently. If python is
+    given, setup.py is run with that Python, instead of the one running
+    spiny. Returns None if the data could not be extracted.
+    """
+    path = os.path.abspath(path)
+    # Run as a script, so nothing else from where spiny is installed, like
+    # its setuptools, hides the packages of the Python.
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    command = [python or sys.executable, script, path]
+    if python_version is not None:
+        command.append(python_version)
+    try:
+        process = subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError:
+        # The Python can't be run at all.
+        logger.log(10, 'Could not run %s' % command[0], exc_info=1)
+        return None
+    stdout, stderr = process.communicate()
+    if stderr:
+        logger.log(10, stderr.decode('utf8', 'replace'))
+
+    # setup.py may print things, so look for our line.
+    for line in reversed(stdout.decode('utf8', 'replace').splitlines()):
+        if line.startswith(DATA_MARKER):
+            return json.loads(line[len(DATA_MARKER):])
+    return None
+
+
+def data_key(path, envdict):
+    """A hash of the setup files, the requirements files and the Python, to cache the data with"""
+    # Not imported globally, this module is also run as a script under
+    # Pythons that can't import all of spiny.
+    from spiny.environment import stat_key
+    digest = hashlib.sha1(json.dumps(stat_key(envdict['path'])).encode('utf8'))
+    # setup.py often reads the requirements from files.
+    names = set(SETUP_FILES)
+    names.update(name for name in os.listdir(path)
+                 if name.startswith('requirements') and name.endswith('.txt'))
+    for name in sorted(names):
+        filename = os.path.join(path, name)
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as infile:
+                digest.update(name.encode('utf8') + b'\0' + infile.read())
+    return digest.hexdigest()
+
+
+def get_all_data(path, pythons, cache=None, max_workers=1):
+    """
+    Returns the data from the setup.py for each Python, in a dictionary.
+
+    The data is read from the files without running setup.py if possible,
+    and the requirements are filtered with their environment markers for
+    each Python. Otherwise setup.py is run under each Python itself, at the
+    same time. If that fails, for example if the Python has no setuptools,
+    it is run with the Python running spiny, pretending to be the right
+    version. The data is cached, and only extracted again if setup.py,
+    setup.cfg, pyproject.toml, the requirements files or the Python changes.
+    Data that has not been used for cache.MAX_AGE is removed from the cache.
+    """
+    from spiny.environment import map_concurrently
+    from spiny.staticdata import evaluate_markers, get_static_data
+    path = os.path.abspath(path)
+    static_data = get_static_data(path)
+
+    def extract(envname):
+        return evaluate_markers(run_setup(envname), pythons[envname])
+
+    def run_setup(envname):
+        envdict = pythons[envname]
+        if static_data is not None:
+            return static_data
+
+        key = data_key(path, envdict)
+        if cache is not None:
+            data = cache.get('projectdata', key)
+            if data is not None:
+                cache.touch('projectdata', key)
+                return data
+
+        data = get_data_isolated(path, python=envdict['path'])
+        if data is None:
+            logger.log(10, 'Could not run setup.py under %s, faking the version' % envname)
+            data = get_data_isolated(path, envdict['version'])
+        if data is None:
+            logger.log(30, 'Could not get the project data from %s' % path)
+            return {}
+
+        if cache is not None:
+            cache.set('projectdata', key, data)
+        return data
+
+    envnames = sorted(pythons)
+    data = dict(zip(envnames, map_concurrently(extract, envnames, max_workers)))
+    if cache is not None:
+        # Every change of setup.py gives new keys, forget the old ones.
+        cache.prune('projectdata')
+    return data
+
+
 if __name__ == '__main__':
-    import json
-    import sys
+    # Don't let setup.py import the spiny modules next to this script.
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path = [p for p in sys.path if os.path.abspath(p or os.curdir) != script_dir]
     path = sys.argv[1]
-    print(json.dumps(get_data(path)))
+    if len(sys.argv) > 2:
+        python_version = sys.argv[2]
+    else:
+        python_version = None
+    data = get_data(path, python_version)
+    # Things like cmdclass can't be serialized, and aren't needed.
+    sys.stdout.write('\n' + DATA_MARKER + json.dumps(data, default=repr) + '\n')
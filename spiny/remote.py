@@ -0,0 +1,685 @@
+# Runs environments on spiny worker processes, on this or other hosts.
+#
+# A worker listens on a TCP socket. The coordinator sends it a snapshot of
+# the project, unless it already has it, and then what to run. The worker
+# finds the Python itself, sets up the virtualenv in its own directory, where
+# it is kept between jobs, runs the tests and sends back the output and the
+# result.
+#
+# The messages are JSON, one per line. The workers run whatever commands they
+# are sent, so they only listen on localhost unless told otherwise, and must
+# be given a key. The key itself is never sent, the worker starts each
+# connection with a random challenge, and the request is signed with it.
+import base64
+import binascii
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+import socket
+import sys
+import tarfile
+import threading
+import time
+import traceback
+import zlib
+
+if sys.version_info < (3,):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+from spiny import output, timing
+from spiny.scheduler import CANCELLED
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 8745
+DEFAULT_WORKER_DIR = '~/.cache/spiny/worker'
+SNAPSHOT_MARKER = '.spiny-snapshot'
+# The snapshots a worker keeps, in the directory of each project.
+SNAPSHOT_DIR = '.snapshots'
+# Snapshots that have not been sent for this long are removed.
+SNAPSHOT_MAX_AGE = 24 * 3600
+# How many seconds either side waits for the other, before giving up.
+DEFAULT_TIMEOUT = 10
+# How often a worker tells that a job is still running, in seconds. It must
+# be well below the timeout, as the tests may not print anything for long.
+HEARTBEAT_INTERVAL = 2
+# How long to wait before trying a busy worker again, in seconds.
+BUSY_RETRY = 1
+
+logger = logging.getLogger('spiny')
+
+
+class WorkerLost(Exception):
+    """The connection to a worker closed before the job was done"""
+
+
+class WorkerBusy(Exception):
+    """All the slots of the worker are running jobs, perhaps for someone else"""
+
+
+def parse_address(address, default_host='127.0.0.1'):
+    """Splits host:port, where both are optional"""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = address, ''
+    return host or default_host, int(port or DEFAULT_PORT)
+
+
+def send(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf8'))
+
+
+def read_line(conn):
+    """Reads one line, without reading anything after it"""
+    data = b''
+    while not data.endswith(b'\n'):
+        byte = conn.recv(1)
+        if not byte:
+            raise WorkerLost('The connection was closed')
+        data += byte
+    return data
+
+
+def sign(key, nonce, message):
+    """Proves that the message was made with the key, for this connection only"""
+    return hmac.new((key or '').encode('utf8'), (nonce + message).encode('utf8'),
+                    hashlib.sha256).hexdigest()
+
+
+def _check_name(name, pattern=r'^[\w][\w.-]*$'):
+    if not re.match(pattern, name or ''):
+        raise ValueError('Bad name: %r' % name)
+    return name
+
+
+def snapshot_path(directory, project, digest):
+    """Where a worker keeps a snapshot of a project"""
+    return os.path.join(os.path.expanduser(directory), _check_name(project), SNAPSHOT_DIR,
+                        _check_name(digest, r'^[0-9a-f]+$'))
+
+
+def store_snapshot(directory, project, digest, snapshot):
+    """Keeps a snapshot, and removes the ones of the project that are not used anymore"""
+    from spiny.cache import atomic_write
+    path = snapshot_path(directory, project, digest)
+    snapshot_dir = os.path.dirname(path)
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    atomic_write(path, snapshot)
+    for name in os.listdir(snapshot_dir):
+        other = os.path.join(snapshot_dir, name)
+        try:
+            if time.time() - os.path.getmtime(other) > SNAPSHOT_MAX_AGE:
+                os.remove(other)
+        except OSError:
+            # Removed by another process.
+            pass
+
+
+def _skipped(name):
+    return name in ('__pycache__', SNAPSHOT_MARKER) or name.endswith(('.pyc', '.pyo'))
+
+
+def _inside(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def snapshot_files(projectdir, ignore=()):
+    """Returns the files to send to the workers, with their names in the snapshot
+
+    Hidden files, like .coveragerc, are included, but not hidden directories,
+    like .git or .tox, or the ignored directories. Symbolic links are
+    followed, if they point to something in the project.
+    """
+    projectdir = os.path.realpath(projectdir)
+    ignore = set(os.path.realpath(path) for path in ignore)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(projectdir, followlinks=True):
+        realdir = os.path.realpath(dirpath)
+        for dirname in list(dirnames):
+            target = os.path.realpath(os.path.join(dirpath, dirname))
+            if (dirname.startswith('.') or _skipped(dirname) or
+                    dirname.endswith('.egg-info') or target in ignore or
+                    not _inside(target, projectdir) or _inside(realdir, target)):
+                # Links to outside the project, or to a parent, which would loop.
+                dirnames.remove(dirname)
+        for filename in filenames:
+            if _skipped(filename):
+                continue
+            path = os.path.join(dirpath, filename)
+            target = os.path.realpath(path)
+            if not os.path.isfile(target):
+                # Broken links, sockets and such.
+                continue
+            if not _inside(target, projectdir):
+                logger.log(30, 'Not sending %s to the workers, it links to outside the project' %
+                           path)
+                continue
+            files.append((target, os.path.relpath(path, projectdir)))
+    return sorted(files, key=lambda item: item[1])
+
+
+def make_snapshot(projectdir, ignore=()):
+    """Returns the project files as a compressed tar, and its digest
+
+    Links are stored as the files they link to. Unchanged files give the
+    same digest.
+    """
+    data = io.BytesIO()
+    tar = tarfile.open(fileobj=data, mode='w')
+    try:
+        for path, name in snapshot_files(projectdir, ignore):
+            tar.add(path, name, recursive=False)
+    finally:
+        tar.close()
+    data = data.getvalue()
+    return zlib.compress(data), hashlib.sha1(data).hexdigest()
+
+
+def extract_snapshot(snapshot, digest, directory):
+    """Replaces the files in directory with a snapshot, unless it's the same"""
+    marker = os.path.join(directory, SNAPSHOT_MARKER)
+    if os.path.isfile(marker):
+        with open(marker, 'rt') as infile:
+            if infile.read() == digest:
+                return
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    tar = tarfile.open(fileobj=io.BytesIO(zlib.decompress(snapshot)))
+    try:
+        for member in tar.getmembers():
+            if (not (member.isfile() or member.isdir()) or os.path.isabs(member.name) or
+                    '..' in member.name.split('/')):
+                raise ValueError('Bad file in the snapshot: %s' % member.name)
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(directory, filter='data')
+        else:
+            tar.extractall(directory)
+    finally:
+        tar.close()
+    with open(marker, 'wt') as outfile:
+        outfile.write(digest)
+
+
+def make_job(envname, setup_commands, test_commands, requirements, use_setup, curdir,
+             options):
+    """What a worker needs to set up and test an environment, except the project"""
+    return {'envname': envname,
+            'setup-commands': setup_commands,
+            'test-commands': test_commands,
+            'requirements': requirements,
+            'use-setup': use_setup,
+            'curdir': curdir,
+            'options': options}
+
+
+def project_key(projectdir):
+    """The name of the directory a worker keeps a project in"""
+    digest = hashlib.sha1(('%s:%s' % (socket.gethostname(), projectdir)).encode('utf8'))
+    return '%s-%s' % (os.path.basename(projectdir), digest.hexdigest()[:12])
+
+
+class SocketHandler(logging.Handler):
+    """Sends the log messages of a job to the coordinator"""
+
+    def __init__(self, send_message):
+        logging.Handler.__init__(self)
+        self.send_message = send_message
+
+    def emit(self, record):
+        try:
+            self.send_message({'type': 'log', 'level': record.levelno,
+                               'message': record.getMessage()})
+        except socket.error:
+            # The coordinator is gone, the job is stopped.
+            pass
+
+
+def run_job(job, config_files, directory):
+    """Sets up and tests an environment, returns the result, durations and timing records"""
+    from spiny import environment, main, projectdata, scheduler
+    envname = job['envname']
+    path = snapshot_path(directory, job['project'], job['snapshot-digest'])
+    workdir = os.path.dirname(os.path.dirname(path))
+    projectdir = os.path.join(workdir, 'src-' + envname)
+    venv_dir = os.path.join(workdir, '.venv')
+    if not os.path.isfile(path):
+        return 'Error: The snapshot for %s is gone from worker %s' % (
+            envname, socket.gethostname()), {}, []
+    with open(path, 'rb') as infile:
+        extract_snapshot(infile.read(), job['snapshot-digest'], projectdir)
+    if not os.path.isdir(venv_dir):
+        os.makedirs(venv_dir)
+    os.chdir(projectdir)
+
+    # The Pythons and the cache are the worker's own.
+    config = ConfigParser()
+    config.read(config_files)
+    if not config.has_section('spiny'):
+        config.add_section('spiny')
+    config.set('spiny', 'environments', envname)
+    with timing.phase('discovery'):
+        pythons = environment.get_pythons(config)
+    if envname not in pythons:
+        return 'Error: No Python for %s on worker %s' % (envname, socket.gethostname()), {}, []
+
+    project_data = None
+    if job['use-setup']:
+        cache = environment.get_cache(config)
+        with timing.phase('metadata'):
+            project_data = projectdata.get_all_data(
+                projectdir, {envname: pythons[envname]}, cache)[envname]
+        cache.save()
+
+    args = main.environment_args(envname, pythons[envname], venv_dir, job['setup-commands'],
+                                 job['test-commands'], job['requirements'], project_data,
+                                 projectdir, job['curdir'], job['options'])
+    # Always parallel, so the output is sent to the coordinator.
+    args = args + (True,)
+    records = timing.collect()
+    durations = {}
+    result, durations['setup'], stage_records = scheduler._timed(main.setup_environment, args)
+    records.extend(stage_records)
+    if not result:
+        result, durations['test'], stage_records = scheduler._timed(main.test_environment, args)
+        records.extend(stage_records)
+    return result, durations, records
+
+
+class Worker(object):
+    """Runs the jobs a coordinator sends, at most slots at a time
+
+    Each job is run in a forked process, as it changes directory. The
+    virtualenvs are kept in directory, per project, and reused by later
+    jobs. The configuration files are for finding the Pythons, like the
+    pythons section and the cache-file option. Only coordinators with the
+    key can send jobs, and when all slots are in use, they are told that
+    the worker is busy.
+    """
+
+    def __init__(self, address, directory=DEFAULT_WORKER_DIR, slots=1, key=None,
+                 config_files=(), timeout=DEFAULT_TIMEOUT):
+        if not key:
+            # Anyone who can connect could run anything.
+            raise ValueError('A worker must have a key')
+        self.address = parse_address(address)
+        self.directory = directory
+        self.slots = max(1, slots)
+        self.key = key
+        self.config_files = list(config_files)
+        self.timeout = timeout
+        self.children = set()
+        # The connections that have not sent their request yet.
+        self.clients = {}
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen(16)
+        # The port is chosen by the OS if it's 0.
+        self.address = self.server.getsockname()[:2]
+
+    def _reap(self, block=False):
+        while self.children:
+            pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            if block:
+                return
+
+    def serve(self):
+        """Runs jobs until interrupted"""
+        import select
+        logger.log(30, 'Listening on %s:%s' % self.address)
+        try:
+            while True:
+                ready = select.select([self.server] + list(self.clients), [], [], 1)[0]
+                self._reap()
+                for conn in ready:
+                    if conn is self.server:
+                        self._accept()
+                    else:
+                        self._receive(conn)
+                # A client that sends nothing must not keep its connection.
+                now = time.time()
+                for conn, client in list(self.clients.items()):
+                    if client['deadline'] < now:
+                        logger.log(20, 'Timeout from %s' % client['address'][0])
+                        del self.clients[conn]
+                        conn.close()
+        finally:
+            for conn in self.clients:
+                conn.close()
+            self.server.close()
+
+    def _accept(self):
+        conn, address = self.server.accept()
+        conn.settimeout(self.timeout)
+        nonce = binascii.hexlify(os.urandom(16)).decode('ascii')
+        try:
+            send(conn, {'type': 'challenge', 'nonce': nonce})
+        except socket.error:
+            conn.close()
+            return
+        self.clients[conn] = {'address': address, 'nonce': nonce, 'data': b'',
+                              'deadline': time.time() + self.timeout}
+
+    def _receive(self, conn):
+        # The requests are read as they come, so other clients don't wait.
+        client = self.clients[conn]
+        try:
+            data = conn.recv(65536)
+        except socket.error:
+            data = b''
+        if b'\n' not in data:
+            client['data'] += data
+            client['deadline'] = time.time() + self.timeout
+            if not data:
+                del self.clients[conn]
+                conn.close()
+            return
+        del self.clients[conn]
+        line = client['data'] + data[:data.index(b'\n')]
+        try:
+            self.handle(conn, client['address'], client['nonce'], line)
+        except (socket.error, ValueError, KeyError, TypeError):
+            logger.log(20, 'Bad request from %s' % client['address'][0], exc_info=1)
+        finally:
+            conn.close()
+
+    def handle(self, conn, address, nonce, line):
+        """Checks that a request was signed with the key, and does what it asks"""
+        request = json.loads(line.decode('utf8'))
+        if not isinstance(request, dict):
+            raise ValueError('Not a request')
+        message = u'%s' % request.get('message')
+        given = u'%s' % request.get('signature')
+        if not hmac.compare_digest(given.encode('utf8'),
+                                   sign(self.key, nonce, message).encode('utf8')):
+            logger.log(30, 'Wrong key from %s' % address[0])
+            send(conn, {'type': 'error', 'message': 'Wrong key'})
+            return
+        request = json.loads(message)
+        if request.get('version') != PROTOCOL_VERSION:
+            send(conn, {'type': 'error', 'message': 'Unsupported protocol version'})
+            return
+
+        if request['type'] == 'hello':
+            reply = {'type': 'hello', 'slots': self.slots, 'has-snapshot': False}
+            if request.get('snapshot-digest'):
+                path = snapshot_path(self.directory, request['project'],
+                                     request['snapshot-digest'])
+                if os.path.isfile(path):
+                    # Still in use, so it is not removed.
+                    os.utime(path, None)
+                    reply['has-snapshot'] = True
+            send(conn, reply)
+            return
+
+        if request['type'] == 'snapshot':
+            store_snapshot(self.directory, request['project'], request['snapshot-digest'],
+                           base64.b64decode(request['snapshot'].encode('ascii')))
+            send(conn, {'type': 'stored'})
+            return
+
+        if len(self.children) >= self.slots:
+            send(conn, {'type': 'busy'})
+            return
+
+        logger.log(20, 'Running %s for %s' % (request['job']['envname'], address[0]))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.server.close()
+                for other in self.clients:
+                    other.close()
+                self._child(conn, request['job'])
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        self.children.add(pid)
+
+    def _child(self, conn, job):
+        lock = threading.Lock()
+        # The job can take long, the heartbeats show that it's still running.
+        conn.settimeout(None)
+
+        def send_message(message):
+            with lock:
+                send(conn, message)
+
+        # The log messages of the job go to the coordinator, which shows them.
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(SocketHandler(send_message))
+        logger.setLevel(job.get('log-level', 30))
+
+        def watch_connection():
+            # The coordinator closes the connection to stop the job.
+            try:
+                conn.recv(1)
+            except socket.error:
+                pass
+            output.terminate_all()
+            os._exit(1)
+
+        def heartbeat():
+            while True:
+                time.sleep(HEARTBEAT_INTERVAL)
+                try:
+                    send_message({'type': 'alive'})
+                except socket.error:
+                    return
+
+        for target in (watch_connection, heartbeat):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            result, durations, records = run_job(job, self.config_files, self.directory)
+        except Exception:
+            logger.log(30, traceback.format_exc())
+            result, durations, records = 'Error: %s failed on the worker' % job['envname'], {}, []
+        send_message({'type': 'result', 'result': result, 'durations': durations,
+                      'records': records})
+
+
+class Coordinator(object):
+    """Runs the jobs on workers, as many at a time on each as it has slots
+
+    The jobs expected to take the longest are started first, like with
+    the Pipeline. If a worker can't be reached, its jobs are run by the
+    others, and if it is busy with other jobs, it is tried again a bit
+    later. The durations and timing records of the jobs are kept in the
+    durations and records attributes.
+    """
+
+    def __init__(self, workers, key=None, estimates=None, fail_fast=False,
+                 timeout=DEFAULT_TIMEOUT):
+        self.workers = workers
+        self.key = key
+        if estimates is None:
+            estimates = {}
+        self.estimates = estimates
+        self.fail_fast = fail_fast
+        self.timeout = timeout
+        self.durations = {}
+        self.records = []
+        self._lock = threading.Lock()
+
+    def _request(self, worker, message):
+        conn = socket.create_connection(parse_address(worker), self.timeout)
+        message = json.dumps(dict(message, version=PROTOCOL_VERSION))
+        try:
+            challenge = json.loads(read_line(conn).decode('utf8'))
+            send(conn, {'message': message,
+                        'signature': sign(self.key, challenge['nonce'], message)})
+        except (socket.error, ValueError, KeyError, WorkerLost):
+            conn.close()
+            raise WorkerLost('No challenge from the worker')
+        return conn
+
+    def _messages(self, conn):
+        reader = conn.makefile('rb')
+        try:
+            for line in iter(reader.readline, b''):
+                yield json.loads(line.decode('utf8'))
+        finally:
+            reader.close()
+
+    def _ask(self, worker, message):
+        conn = self._request(worker, message)
+        try:
+            return next(self._messages(conn), {})
+        finally:
+            conn.close()
+
+    def register(self, project=None, snapshot=None, digest=None):
+        """Asks each worker how many jobs it runs at a time, returns a dict of them
+
+        If a snapshot of the project is given, it is sent to the workers that
+        don't have it yet.
+        """
+        slots = {}
+        for worker in self.workers:
+            try:
+                reply = self._ask(worker, {'type': 'hello', 'project': project,
+                                           'snapshot-digest': digest})
+                if reply.get('type') == 'hello' and snapshot is not None and \
+                        not reply.get('has-snapshot'):
+                    stored = self._ask(worker, {
+                        'type': 'snapshot', 'project': project, 'snapshot-digest': digest,
+                        'snapshot': base64.b64encode(snapshot).decode('ascii')})
+                    if stored.get('type') != 'stored':
+                        reply = stored
+            except (socket.error, ValueError, WorkerLost) as e:
+                logger.log(30, 'Could not reach worker %s: %s' % (worker, e))
+                continue
+            if reply.get('type') != 'hello':
+                logger.log(30, 'Worker %s refused: %s' % (worker, reply.get('message')))
+                continue
+            slots[worker] = reply['slots']
+        return slots
+
+    def _run_job(self, worker, job, running):
+        conn = self._request(worker, {'type': 'job', 'job': job})
+        with self._lock:
+            running[job['envname']] = conn
+        try:
+            for message in self._messages(conn):
+                if message['type'] == 'log':
+                    logger.log(message['level'], message['message'])
+                elif message['type'] == 'result':
+                    return message['result'], message['durations'], message['records']
+                elif message['type'] == 'busy':
+                    raise WorkerBusy('All slots are in use')
+                elif message['type'] == 'error':
+                    msg = 'Error: Worker %s refused %s: %s' % (worker, job['envname'],
+                                                               message['message'])
+                    return msg, {}, []
+            raise WorkerLost('The worker stopped')
+        finally:
+            with self._lock:
+                running.pop(job['envname'], None)
+            conn.close()
+
+    def run(self, jobs, projectdir, ignore=()):
+        """Runs the jobs, with a snapshot of projectdir, and returns a dict with the results"""
+        results = {}
+        snapshot, digest = make_snapshot(projectdir, ignore)
+        project = project_key(projectdir)
+        slots = self.register(project, snapshot, digest)
+        extra = {'project': project,
+                 'snapshot-digest': digest,
+                 'log-level': logger.getEffectiveLevel()}
+
+        pending = sorted(jobs, key=lambda job: -sum(
+            self.estimates.get(job['envname'], {}).values()))
+        alive = set(slots)
+        running = {}
+        state = {'stopped': False, 'active': 0}
+        condition = threading.Condition(self._lock)
+
+        def work(worker):
+            while True:
+                with condition:
+                    # A job may come back if another worker is lost.
+                    while (not pending and state['active'] and not state['stopped'] and
+                           worker in alive):
+                        condition.wait()
+                    if state['stopped'] or worker not in alive or not pending:
+                        return
+                    job = pending.pop(0)
+                    state['active'] += 1
+                name = job['envname']
+                logger.log(20, 'Running %s on worker %s' % (name, worker))
+                try:
+                    result, durations, records = self._run_job(worker, dict(job, **extra),
+                                                               running)
+                except WorkerBusy:
+                    with condition:
+                        state['active'] -= 1
+                        pending.insert(0, job)
+                        condition.notify_all()
+                    # Running jobs for someone else, try again soon.
+                    time.sleep(BUSY_RETRY)
+                    continue
+                except (socket.error, ValueError, WorkerLost) as e:
+                    with condition:
+                        state['active'] -= 1
+                        condition.notify_all()
+                        if state['stopped']:
+                            results[name] = CANCELLED
+                            return
+                        logger.log(30, 'Lost worker %s: %s' % (worker, e))
+                        alive.discard(worker)
+                        # Let another worker try.
+                        pending.insert(0, job)
+                    return
+
+                with condition:
+                    state['active'] -= 1
+                    condition.notify_all()
+                    results[name] = result
+                    self.durations[name] = durations
+                    self.records.extend(records)
+                    if result and self.fail_fast and not state['stopped']:
+                        # Cancel everything else.
+                        logger.log(30, 'Stopping, as %s failed' % name)
+                        state['stopped'] = True
+                        for other in pending:
+                            results[other['envname']] = CANCELLED
+                        del pending[:]
+                        for conn in running.values():
+                            try:
+                                conn.shutdown(socket.SHUT_RDWR)
+                            except socket.error:
+                                pass
+
+        threads = [threading.Thread(target=work, args=(worker,))
+                   for worker in sorted(slots) for index in range(slots[worker])]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for job in pending:
+            results[job['envname']] = 'Error: No worker could run %s' % job['envname']
+        return results
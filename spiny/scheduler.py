@@ -0,0 +1,195 @@
+# Runs the setup and the test stages of the environments in separate pools.
+import logging
+import os
+import signal
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from spiny import output, timing
+
+# The result of the jobs that were cancelled with fail_fast.
+CANCELLED = 'cancelled'
+
+logger = logging.getLogger('spiny')
+
+
+def _terminate_worker(signum, frame):
+    # Stop the commands the worker is running, not only the worker.
+    output.terminate_all()
+    os._exit(1)
+
+
+def _stop_when_set(stop):
+    stop.wait()
+    _terminate_worker(None, None)
+
+
+def _init_worker(nice=0, cpus=None, stop=None):
+    signal.signal(signal.SIGTERM, _terminate_worker)
+    # The commands the worker runs inherit these.
+    if nice:
+        os.nice(nice)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    if stop is not None:
+        # The executor has no way to stop running jobs, so the workers
+        # stop themselves when the stop event is set.
+        thread = threading.Thread(target=_stop_when_set, args=(stop,))
+        thread.daemon = True
+        thread.start()
+
+
+def _timed(function, args):
+    """Calls function with args in a worker, and returns the result, the time taken
+    and the timing records"""
+    # Forget the records the worker was forked with.
+    timing.collect()
+    start = time.time()
+    result = function(args)
+    return result, time.time() - start, timing.collect()
+
+
+class Pipeline(object):
+    """Runs a setup stage and a test stage for each job, with separate limits
+
+    The test stage of a job is started as soon as its setup stage is done,
+    while other jobs are still being set up. Both stages are called with the
+    job arguments, and return None on success or an error message. If the
+    setup fails, the test stage is not run.
+
+    The jobs that are expected to take the longest, from the durations of
+    earlier runs, are started first, so a slow environment doesn't start
+    last and hold up the whole run. The durations of this run are stored
+    in the durations attribute, and the timing records of the stages in
+    the records attribute.
+
+    With fail_fast, the running jobs are stopped and the rest are not
+    started as soon as one job fails, and their result is CANCELLED.
+
+    With a controller, like spiny.load.Controller, each stage runs at most
+    as many jobs as the controller allows, which is checked again every
+    controller.interval seconds while the jobs run. The processes of a stage
+    can be given a nice value and a set of CPUs to run on, with the nice
+    and cpu_sets dicts, keyed on the stage. These are not used when both
+    stages have one process, as then everything runs one at a time.
+    """
+
+    def __init__(self, setup, test, setup_processes, test_processes, estimates=None,
+                 fail_fast=False, controller=None, nice=None, cpu_sets=None):
+        self.setup = setup
+        self.test = test
+        self.setup_processes = max(1, setup_processes)
+        self.test_processes = max(1, test_processes)
+        if estimates is None:
+            estimates = {}
+        self.estimates = estimates
+        self.fail_fast = fail_fast
+        self.controller = controller
+        self.nice = nice or {}
+        self.cpu_sets = cpu_sets or {}
+        self.durations = {}
+        self.records = []
+
+    def estimate(self, name, stage):
+        """The expected duration of a stage, from earlier runs"""
+        if stage in self.estimates.get(name, {}):
+            return self.estimates[name][stage]
+        # Never run, guess it takes the average time.
+        known = [e[stage] for e in self.estimates.values() if stage in e]
+        if known:
+            return sum(known) / len(known)
+        return 0.0
+
+    def run(self, jobs):
+        """Runs a list of (name, args) jobs, and returns a dict with the results"""
+        # Imports multiprocessing, which is slow.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        results = {}
+        if not jobs:
+            return results
+
+        # Set to stop all the workers and their commands, with fail_fast.
+        stop = multiprocessing.Event()
+        if (self.setup_processes, self.test_processes) == (1, 1):
+            # Run everything one at a time.
+            setup_pool = test_pool = ProcessPoolExecutor(max_workers=1,
+                                                         initializer=_init_worker,
+                                                         initargs=(0, None, stop))
+        else:
+            setup_pool = ProcessPoolExecutor(
+                max_workers=self.setup_processes, initializer=_init_worker,
+                initargs=(self.nice.get('setup', 0), self.cpu_sets.get('setup'), stop))
+            test_pool = ProcessPoolExecutor(
+                max_workers=self.test_processes, initializer=_init_worker,
+                initargs=(self.nice.get('test', 0), self.cpu_sets.get('test'), stop))
+
+        # Longest total time first, the sort is stable so unknown jobs keep
+        # their order.
+        pending = {
+            'setup': sorted(jobs, key=lambda job: -(self.estimate(job[0], 'setup') +
+                                                    self.estimate(job[0], 'test'))),
+            'test': [],
+        }
+        pools = {'setup': (setup_pool, self.setup, self.setup_processes),
+                 'test': (test_pool, self.test, self.test_processes)}
+        running = {}
+
+        def fill():
+            # Tests first, those environments are closer to being done.
+            for stage in ('test', 'setup'):
+                pool, function, limit = pools[stage]
+                active = len([1 for s, n, a in running.values() if s == stage])
+                if self.controller is not None and pending[stage]:
+                    allowed = self.controller.limit(stage, active)
+                    if allowed is not None:
+                        limit = min(limit, allowed)
+                while pending[stage]:
+                    if test_pool is setup_pool and running:
+                        return
+                    if active >= limit:
+                        break
+                    active += 1
+                    name, args = pending[stage].pop(0)
+                    running[pool.submit(_timed, function, args)] = (stage, name, args)
+
+        # With a controller, check now and then if more can be started.
+        timeout = self.controller.interval if self.controller is not None else None
+        try:
+            fill()
+            while running:
+                done, not_done = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                failed = []
+                for future in done:
+                    stage, name, args = running.pop(future)
+                    result, duration, records = future.result()
+                    self.durations.setdefault(name, {})[stage] = duration
+                    self.records.extend(records)
+                    if stage == 'setup' and not result:
+                        logger.log(10, 'Setup of %s done, starting the tests' % name)
+                        pending['test'].append((name, args))
+                        pending['test'].sort(key=lambda job: -self.estimate(job[0], 'test'))
+                    else:
+                        results[name] = result
+                        if result:
+                            failed.append(name)
+
+                if failed and self.fail_fast:
+                    # Cancel everything else.
+                    logger.log(30, 'Stopping, as %s failed' % ', '.join(failed))
+                    for stage, name, args in running.values():
+                        results[name] = CANCELLED
+                    for name, args in pending['setup'] + pending['test']:
+                        results[name] = CANCELLED
+                    running.clear()
+                    stop.set()
+                    break
+                fill()
+        finally:
+            setup_pool.shutdown()
+            if test_pool is not setup_pool:
+                test_pool.shutdown()
+
+        return results
@@ -0,0 +1,192 @@
+# Splits the tests of one test command into shards that run at the same time
+# in the same virtualenv.
+import json
+import logging
+import os
+import os.path
+import sys
+
+from spiny import output
+from spiny.cache import atomic_write
+from spiny.environment import map_concurrently
+
+if sys.version_info < (3,):
+    import subprocess32 as subprocess
+else:
+    import subprocess
+
+# Where the time each test took is recorded, in the virtualenv.
+DURATIONS_FILE = '.spiny-test-times'
+
+# The {junitxml} variable of the test commands, in the virtualenv. Each shard
+# writes its own report, with the shard number added to the name.
+JUNIT_FILE = '.spiny-junit.xml'
+
+# Lists the test ids found by unittest discovery, one per line. This runs
+# under the Python of the virtualenv, so it must work with Python 2 too.
+LIST_SCRIPT = '''
+import sys, unittest
+def walk(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for sub in walk(test):
+                yield sub
+        else:
+            yield test
+for test in walk(unittest.defaultTestLoader.discover('.')):
+    print(test.id())
+'''
+
+logger = logging.getLogger('spiny')
+
+
+def read_durations(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'rt') as infile:
+            durations = json.load(infile)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(durations, dict):
+        return {}
+    return durations
+
+
+def normal_id(test_id):
+    """Makes pytest ids like 'tests/test_a.py::TestA::test_b' look like unittest ids"""
+    test_id = test_id.replace('::', '.').replace('.py.', '.')
+    return test_id.replace('/', '.').replace(os.sep, '.')
+
+
+def read_junit(path):
+    """Returns the time each test in a JUnit XML report took, by normal_id()"""
+    from xml.etree import ElementTree
+    times = {}
+    try:
+        tree = ElementTree.parse(path)
+    except (IOError, OSError, ElementTree.ParseError):
+        return times
+    for testcase in tree.iter('testcase'):
+        name = testcase.get('name')
+        if not name or testcase.get('time') is None:
+            continue
+        if testcase.get('classname'):
+            name = '%s.%s' % (testcase.get('classname'), name)
+        try:
+            times[normal_id(name)] = float(testcase.get('time'))
+        except ValueError:
+            continue
+    return times
+
+
+def split(tests, count, durations):
+    """Splits the tests into count shards, of about the same total duration
+
+    Tests without a recorded duration are expected to take the average time.
+    The longest tests are placed first, each in the shard with the least
+    total time so far. The tests keep their order within a shard.
+    """
+    known = [durations[test] for test in tests if test in durations]
+    if known:
+        default = sum(known) / len(known)
+    else:
+        default = 1.0
+
+    shards = [[] for i in range(min(count, len(tests)))]
+    totals = [0.0] * len(shards)
+    order = sorted(range(len(tests)), key=lambda i: -durations.get(tests[i], default))
+    for index in order:
+        shard = totals.index(min(totals))
+        shards[shard].append(index)
+        totals[shard] += durations.get(tests[index], default)
+    return [[tests[index] for index in sorted(shard)] for shard in shards]
+
+
+class Sharder(object):
+    """Runs test commands with a {tests} variable in shards
+
+    The tests are listed once per virtualenv, with the list command or with
+    unittest discovery, and each shard runs the command with its test ids in
+    place of {tests}. If the command writes a JUnit XML report to the
+    {junitxml} variable, like pytest --junitxml={junitxml} does, the time
+    each test took is recorded, so the next run can balance the shards by
+    time. Otherwise the shards are balanced by the number of tests.
+    """
+
+    def __init__(self, python, envdir, count, list_command=None):
+        self.python = python
+        self.count = count
+        self.list_command = list_command
+        self.durations_path = os.path.join(envdir, DURATIONS_FILE)
+        self.junit_path = os.path.join(envdir, JUNIT_FILE)
+        self._tests = None
+
+    def list_tests(self):
+        """Returns the test ids, or an empty list if they could not be listed"""
+        if self._tests is not None:
+            return self._tests
+
+        if self.list_command:
+            command = self.list_command.split()
+        else:
+            command = [self.python, '-c', LIST_SCRIPT]
+        logger.log(10, 'Listing tests with command: %s' % ' '.join(command))
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+            out, err = process.communicate()
+        if err:
+            logger.log(20, err.decode('utf8', 'replace'))
+        tests = [line.strip() for line in out.decode('utf8', 'replace').splitlines()
+                 if line.strip()]
+        if process.returncode != 0 or [t for t in tests if t.startswith('unittest.loader.')]:
+            # Listing failed, or some test modules could not be imported.
+            tests = []
+        self._tests = tests
+        return tests
+
+    def run(self, command, prefix, stdin=None):
+        """Runs the command in shards, and returns if all of them succeeded"""
+        tests = self.list_tests()
+        if not tests:
+            logger.log(30, 'Could not list the tests for %s, running them in one go' % prefix)
+            returncode, tail = output.run(command.replace('{tests}', '').split(), prefix, True,
+                                          stdout_level=30, stdin=stdin)
+            return returncode == 0
+
+        durations = read_durations(self.durations_path)
+        shards = split(tests, self.count, durations)
+        logger.log(20, 'Running %s tests in %s shards for %s' % (len(tests), len(shards), prefix))
+
+        def run_shard(index):
+            report = '%s.%s' % (self.junit_path, index + 1)
+            words = [word.replace(self.junit_path, report) for word in command.split()]
+            position = words.index('{tests}')
+            words[position:position + 1] = shards[index]
+            name = '%s [shard %s/%s]' % (prefix, index + 1, len(shards))
+            returncode, tail = output.run(words, name, True, stdout_level=30, stdin=stdin)
+            times = {}
+            if os.path.exists(report):
+                times = read_junit(report)
+                os.remove(report)
+            return returncode, times
+
+        results = map_concurrently(run_shard, range(len(shards)), len(shards))
+
+        times = {}
+        for returncode, shard_times in results:
+            times.update(shard_times)
+        durations = dict((test, durations[test]) for test in tests if test in durations)
+        durations.update((test, times[normal_id(test)]) for test in tests
+                         if normal_id(test) in times)
+        try:
+            data = json.dumps(durations, indent=0, sort_keys=True)
+            atomic_write(self.durations_path, data.encode('utf8'))
+        except (IOError, OSError):
+            logger.log(10, 'Could not write test durations to %s' % self.durations_path,
+                       exc_info=1)
+
+        failed = [index + 1 for index, (returncode, times) in enumerate(results)
+                  if returncode != 0]
+        if failed:
+            logger.log(30, 'Shards %s failed for %s' % (', '.join(str(i) for i in failed), prefix))
+        return not failed
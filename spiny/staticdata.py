@@ -0,0 +1,253 @@
+# Reads the project data from setup.cfg, pyproject.toml and setup.py without
+# running anything, and evaluates the environment markers of requirements.
+import ast
+import logging
+import os
+import os.path
+import sys
+
+if sys.version_info < (3,):
+    from ConfigParser import Error as ConfigError, RawConfigParser
+else:
+    from configparser import Error as ConfigError, RawConfigParser
+
+# The setup() arguments spiny uses, these must be literals.
+SETUP_KEYWORDS = ('name', 'classifiers', 'install_requires', 'setup_requires',
+                  'tests_require', 'extras_require', 'dependency_links')
+
+REQUIREMENT_KEYWORDS = ('install_requires', 'setup_requires', 'tests_require')
+
+logger = logging.getLogger('spiny')
+
+
+class NotStatic(Exception):
+    """The data can only be found by running setup.py"""
+
+
+# The optional libraries are slow to import, so they are imported when needed.
+
+def load_tomllib():
+    """Returns the TOML parser module, or None if there is none"""
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            # pyproject.toml can't be read, setup.py will be used.
+            return None
+    return tomllib
+
+
+def load_markers():
+    """Returns the packaging.markers module, or None if it isn't installed"""
+    try:
+        from packaging import markers
+    except ImportError:
+        # Requirements with markers are passed on to pip as they are.
+        return None
+    return markers
+
+
+def _cfg_list(value, comma=False):
+    result = []
+    for line in value.splitlines():
+        if comma:
+            items = line.split(',')
+        else:
+            items = [line]
+        for item in items:
+            item = item.strip()
+            if item and not item.startswith('#'):
+                result.append(item)
+    return result
+
+
+def _cfg_value(config, section, option):
+    value = config.get(section, option)
+    if value.strip().startswith(('file:', 'attr:')):
+        raise NotStatic('%s uses a directive in setup.cfg' % option)
+    return value
+
+
+def read_setup_cfg(path):
+    """Returns the data from the [metadata] and [options] of a setup.cfg"""
+    config = RawConfigParser()
+    config.read(path)
+    data = {}
+    if config.has_option('metadata', 'name'):
+        data['name'] = _cfg_value(config, 'metadata', 'name').strip()
+    if config.has_option('metadata', 'classifiers'):
+        data['classifiers'] = _cfg_list(_cfg_value(config, 'metadata', 'classifiers'), True)
+    for option in REQUIREMENT_KEYWORDS + ('dependency_links',):
+        if config.has_option('options', option):
+            data[option] = _cfg_list(_cfg_value(config, 'options', option))
+    if config.has_section('options.extras_require'):
+        data['extras_require'] = dict(
+            (extra, _cfg_list(_cfg_value(config, 'options.extras_require', extra)))
+            for extra in config.options('options.extras_require'))
+    return data
+
+
+def read_pyproject(path):
+    """Returns the data from the PEP 621 [project] table of a pyproject.toml"""
+    tomllib = load_tomllib()
+    if tomllib is None:
+        raise NotStatic('No TOML parser installed')
+    with open(path, 'rb') as infile:
+        project = tomllib.load(infile).get('project', {})
+
+    data = {}
+    if 'name' in project:
+        data['name'] = project['name']
+    if 'classifiers' in project:
+        data['classifiers'] = project['classifiers']
+    if 'dependencies' in project:
+        data['install_requires'] = project['dependencies']
+    if 'optional-dependencies' in project:
+        data['extras_require'] = project['optional-dependencies']
+    return data
+
+
+def read_setup_py(path):
+    """Returns the arguments of the setup() call in a setup.py, if they are literals"""
+    with open(path, 'rb') as infile:
+        tree = ast.parse(infile.read(), path)
+
+    calls = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            if ((isinstance(func, ast.Name) and func.id == 'setup') or
+                    (isinstance(func, ast.Attribute) and func.attr == 'setup')):
+                calls.append(node)
+    if len(calls) != 1:
+        raise NotStatic('Found %s setup() calls in setup.py' % len(calls))
+
+    data = {}
+    for keyword in calls[0].keywords:
+        if keyword.arg is None:
+            raise NotStatic('setup() is called with **kwargs')
+        if keyword.arg not in SETUP_KEYWORDS:
+            continue
+        try:
+            data[keyword.arg] = ast.literal_eval(keyword.value)
+        except (ValueError, TypeError):
+            raise NotStatic('%s is not a literal in setup.py' % keyword.arg)
+    if getattr(calls[0], 'kwargs', None) is not None:
+        # Python 2 has the **kwargs separately.
+        raise NotStatic('setup() is called with **kwargs')
+    return data
+
+
+def get_static_data(path):
+    """
+    Returns the project data without running setup.py, or None if it can't.
+
+    The data is read from pyproject.toml, then setup.cfg and then the
+    setup() call in setup.py, with later files overriding earlier ones, like
+    setuptools does.
+    """
+    readers = [('pyproject.toml', read_pyproject),
+               ('setup.cfg', read_setup_cfg),
+               ('setup.py', read_setup_py)]
+    data = {}
+    found = False
+    for name, reader in readers:
+        filename = os.path.join(path, name)
+        if not os.path.isfile(filename):
+            continue
+        try:
+            data.update(reader(filename))
+        except NotStatic as e:
+            logger.log(10, 'Running setup.py, as %s' % e)
+            return None
+        except (SyntaxError, ValueError, ConfigError) as e:
+            logger.log(10, 'Could not read %s: %s' % (filename, e))
+            return None
+        found = True
+
+    if not found:
+        return None
+    return data
+
+
+def marker_environment(envdict):
+    """The values of the PEP 508 marker variables for a Python"""
+    version_info = envdict['version_info']
+    environment = load_markers().default_environment()
+    full_version = '%s.%s.%s' % tuple(version_info[:3])
+    environment.update({
+        'python_version': '%s.%s' % tuple(version_info[:2]),
+        'python_full_version': full_version,
+        'implementation_name': envdict['implementation'].lower(),
+        'platform_python_implementation': envdict['implementation'],
+        # PyPy has its own version.
+        'implementation_version': envdict['version'] if envdict['python'].startswith('PyPy')
+        else full_version,
+    })
+    return environment
+
+
+def evaluate_markers(data, envdict):
+    """
+    Returns the project data with only the requirements for a Python.
+
+    Requirements whose markers don't match are removed, and the markers of
+    the others stripped. Extras with a marker, like 'tests:python_version<"3"'
+    are merged with the extra if the marker matches. Without the packaging
+    library, the requirements are left for pip to evaluate.
+    """
+    def lines(requirements):
+        if isinstance(requirements, str):
+            return requirements.splitlines()
+        return requirements
+
+    # Only import packaging if there are markers to evaluate.
+    all_requirements = [r for keyword in REQUIREMENT_KEYWORDS for r in lines(data.get(keyword, []))]
+    for requirements in data.get('extras_require', {}).values():
+        all_requirements.extend(lines(requirements))
+    if (any(';' in r for r in all_requirements) or
+            any(':' in extra for extra in data.get('extras_require', {}))):
+        markers = load_markers()
+        if markers is None:
+            return data
+        environment = marker_environment(envdict)
+
+    def matches(marker):
+        try:
+            return markers.Marker(marker).evaluate(environment)
+        except markers.InvalidMarker:
+            logger.log(10, 'Invalid marker %s' % marker)
+            return True
+
+    def evaluate(requirements):
+        result = []
+        for requirement in lines(requirements):
+            if ';' in requirement:
+                requirement, marker = requirement.split(';', 1)
+                if not matches(marker.strip()):
+                    continue
+            result.append(requirement.strip())
+        return result
+
+    data = dict(data)
+    for keyword in REQUIREMENT_KEYWORDS:
+        if keyword in data:
+            data[keyword] = evaluate(data[keyword])
+
+    extras = {}
+    for extra, requirements in data.get('extras_require', {}).items():
+        if ':' in extra:
+            extra, marker = extra.split(':', 1)
+            if not matches(marker):
+                continue
+        requirements = evaluate(requirements)
+        if extra:
+            extras.setdefault(extra, []).extend(requirements)
+        else:
+            # Conditional requirements, the old way.
+            data['install_requires'] = list(data.get('install_requires', [])) + requirements
+    if 'extras_require' in data:
+        data['extras_require'] = extras
+    return data
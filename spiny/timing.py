@@ -0,0 +1,192 @@
+# Records how long each phase of a run takes, and the CPU time and memory
+# used by the commands, for the report at the end.
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # No resource usage on Windows, only the times are recorded.
+    resource = None
+
+from spiny.cache import atomic_write
+
+# The phases, in the order they are shown.
+GLOBAL_PHASES = ('discovery', 'metadata', 'wheels')
+ENV_PHASES = ('venv', 'install', 'test')
+
+REPORT_VERSION = 1
+
+logger = logging.getLogger('spiny')
+
+_records = []
+_lock = threading.Lock()
+# The phases that are running in each thread, innermost last.
+_local = threading.local()
+
+
+def _phases():
+    try:
+        return _local.phases
+    except AttributeError:
+        _local.phases = []
+        return _local.phases
+
+
+def inherit(function):
+    """Wraps function, so its commands belong to the current phase in other threads too"""
+    outer = _phases()[-1:]
+
+    def wrapper(*args, **kwargs):
+        phases = _phases()
+        phases.extend(outer)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            del phases[len(phases) - len(outer):]
+    return wrapper
+
+
+def _maxrss_kb(maxrss):
+    if sys.platform == 'darwin':
+        # Bytes on OS X, kilobytes elsewhere.
+        return maxrss // 1024
+    return maxrss
+
+
+def children_usage():
+    """The CPU time and peak RSS of the finished child processes so far"""
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, _maxrss_kb(usage.ru_maxrss)
+
+
+def add(record):
+    with _lock:
+        _records.append(record)
+
+
+def collect():
+    """Returns the records so far, and forgets them"""
+    with _lock:
+        records = _records[:]
+        del _records[:]
+    return records
+
+
+def command(command, wall, usage=None):
+    """Records a command, with the rusage from wait4() if there is one"""
+    phases = _phases()
+    if phases:
+        env, phase = phases[-1].env, phases[-1].name
+    else:
+        env = phase = None
+    record = {'env': env, 'phase': phase, 'command': command, 'wall': wall,
+              'cpu': None, 'maxrss': None}
+    if usage is not None:
+        record['cpu'] = usage.ru_utime + usage.ru_stime
+        record['maxrss'] = _maxrss_kb(usage.ru_maxrss)
+    add(record)
+
+
+class phase(object):
+    """Records the time a phase takes, with the CPU time of its commands"""
+
+    def __init__(self, name, env=None):
+        self.name = name
+        self.env = env
+
+    def __enter__(self):
+        self._start = time.time()
+        self._cpu, self._maxrss = children_usage()
+        _phases().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _phases().remove(self)
+        cpu, maxrss = children_usage()
+        record = {'env': self.env, 'phase': self.name, 'command': None,
+                  'wall': time.time() - self._start, 'cpu': None, 'maxrss': None}
+        if cpu is not None:
+            record['cpu'] = cpu - self._cpu
+            if maxrss > self._maxrss:
+                # Only known if a child in this phase was the biggest so far.
+                record['maxrss'] = maxrss
+        with _lock:
+            # The commands of the phase know their peak RSS exactly.
+            for other in _records:
+                if (other['command'] is not None and other['env'] == self.env and
+                        other['phase'] == self.name and other['maxrss'] is not None):
+                    record['maxrss'] = max(record['maxrss'] or 0, other['maxrss'])
+            _records.append(record)
+
+
+def summarize(records):
+    """Sums up the phases, for each environment and for the whole run"""
+    summary = {'phases': {}, 'environments': {}}
+    for record in records:
+        if record['command'] is not None:
+            continue
+        if record['env'] is None:
+            phases = summary['phases']
+        else:
+            phases = summary['environments'].setdefault(record['env'], {})
+        total = phases.setdefault(record['phase'], {'wall': 0.0, 'cpu': None, 'maxrss': None})
+        total['wall'] += record['wall']
+        if record['cpu'] is not None:
+            total['cpu'] = (total['cpu'] or 0.0) + record['cpu']
+        if record['maxrss'] is not None:
+            total['maxrss'] = max(total['maxrss'] or 0, record['maxrss'])
+    return summary
+
+
+def write_report(path, records):
+    """Writes the records and their summary as JSON"""
+    report = {'version': REPORT_VERSION, 'records': records}
+    report.update(summarize(records))
+    path = os.path.abspath(os.path.expanduser(path))
+    try:
+        atomic_write(path, json.dumps(report, indent=1, sort_keys=True).encode('utf8'))
+    except (IOError, OSError):
+        logger.log(30, 'Could not write the report to %s' % path, exc_info=1)
+
+
+def _seconds(value):
+    return '%.1fs' % value
+
+
+def format_table(records):
+    """A compact table of the time and resources used by each environment"""
+    summary = summarize(records)
+    if not summary['environments']:
+        return ''
+    header = ['Environment', 'Venv', 'Install', 'Tests', 'CPU', 'Peak RSS']
+    rows = []
+    for env in sorted(summary['environments']):
+        phases = summary['environments'][env]
+        row = [env]
+        for name in ENV_PHASES:
+            row.append(_seconds(phases[name]['wall']) if name in phases else '-')
+        cpu = [p['cpu'] for p in phases.values() if p['cpu'] is not None]
+        row.append(_seconds(sum(cpu)) if cpu else '-')
+        maxrss = [p['maxrss'] for p in phases.values() if p['maxrss'] is not None]
+        row.append('%.0f MB' % (max(maxrss) / 1024.0) if maxrss else '-')
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = []
+    for row in [header] + rows:
+        cells = [row[0].ljust(widths[0])] + [c.rjust(w) for c, w in zip(row[1:], widths[1:])]
+        lines.append('  '.join(cells))
+
+    phases = summary['phases']
+    totals = ['%s %s' % (name, _seconds(phases[name]['wall']))
+              for name in GLOBAL_PHASES if name in phases]
+    if totals:
+        lines.append('Before the environments: ' + ', '.join(totals))
+    return '\n'.join(lines)
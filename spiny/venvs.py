@@ -0,0 +1,305 @@
+# Creates virtualenvs, with the backend chosen for each Python, and by
+# cloning a pristine template virtualenv per Python.
+import hashlib
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+import sys
+
+if sys.version_info < (3,):
+    import subprocess32 as subprocess
+else:
+    import subprocess
+
+from spiny import output
+from spiny.cache import FileLock, atomic_write
+from spiny.environment import stat_key
+
+# Written into a template when it's completely built.
+TEMPLATE_MARKER = '.spiny-template'
+
+# Increase this when the format of the .spiny-profile changes.
+PROFILE_VERSION = 1
+
+REQUIREMENT_NAME_RE = re.compile(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+
+# The first pip with the --python option.
+SHARED_PIP_VERSION = (22, 3)
+
+# Run by the Python of a virtualenv, prints the names in sys.argv that the
+# other installed projects require.
+REQUIRED_SCRIPT = r"""
+import re
+import sys
+
+def name(requirement):
+    name = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)', requirement).group(1)
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+try:
+    from importlib import metadata
+    dists = [(d.metadata['Name'], d.requires or []) for d in metadata.distributions()]
+except ImportError:
+    import pkg_resources
+    dists = [(d.project_name, [str(r) for r in d.requires()])
+             for d in pkg_resources.working_set]
+names = set(sys.argv[1:])
+required = set()
+for dist, requires in dists:
+    if dist and name(dist) not in names:
+        # Not the requirements of extras, those may not be installed.
+        required.update(name(r) for r in requires if not re.search(r'\bextra\s*==', r))
+print(' '.join(sorted(names & required)))
+"""
+
+logger = logging.getLogger('spiny')
+
+# The version of the pip of the Python running spiny, when it's known.
+_pip_version = None
+
+
+def shared_pip_supported():
+    """Checks if the pip of the Python running spiny can install into other Pythons"""
+    global _pip_version
+    if _pip_version is None:
+        from spiny.environment import version_parts
+        try:
+            version = subprocess.check_output([sys.executable, '-m', 'pip', '--version'],
+                                              stderr=subprocess.STDOUT)
+            # pip 23.2.1 from /usr/lib/python3/site-packages/pip (python 3.11)
+            _pip_version = tuple(version_parts(version.decode('utf8').split()[1]))
+        except (OSError, IndexError, subprocess.CalledProcessError):
+            _pip_version = ()
+        if _pip_version < SHARED_PIP_VERSION:
+            logger.log(30, 'The shared pip needs pip %s or later for %s, using the pip of '
+                       'each virtualenv' % ('.'.join(map(str, SHARED_PIP_VERSION)),
+                                            sys.executable))
+    return _pip_version >= SHARED_PIP_VERSION
+
+
+def venv_command(envdict, shared_pip):
+    # The stdlib venv module of the Python itself.
+    command = [envdict['path'], '-m', 'venv']
+    if shared_pip and shared_pip_supported():
+        # Packages are installed with the pip of the Python running spiny.
+        command.append('--without-pip')
+    return command
+
+
+def virtualenv_command(envdict, shared_pip):
+    # The virtualenv module installed for the Python itself.
+    return [envdict['path'], '-m', 'virtualenv', '-v', '-p', envdict['path']]
+
+
+def external_command(envdict, shared_pip):
+    # The virtualenv module of the Python running spiny.
+    return [sys.executable, '-m', 'virtualenv', '-v', '-p', envdict['path']]
+
+
+BACKENDS = {
+    'venv': venv_command,
+    'virtualenv': virtualenv_command,
+    'external': external_command,
+}
+
+
+def setup_command(envdict, shared_pip=False):
+    """The command that creates a virtualenv for a Python, with its backend
+
+    The virtualenv directory should be appended to the command. Returns None
+    for Pythons that do not support virtualenvs.
+    """
+    if envdict['backend'] not in BACKENDS:
+        return None
+    return BACKENDS[envdict['backend']](envdict, shared_pip)
+
+
+def pip_command(envdict, envdir, envpython, shared_pip=False):
+    """The command to run pip for a virtualenv"""
+    if shared_pip and envdict['backend'] == 'venv' and shared_pip_supported():
+        return [sys.executable, '-m', 'pip', '--python', envpython]
+    return [os.path.join(envdir, 'bin', 'pip')]
+
+
+def template_path(template_dir, envdict, command):
+    """The template directory for a Python and the command that creates it"""
+    # The template must be rebuilt if the Python or the command changes.
+    key = json.dumps([stat_key(envdict['path']), command])
+    digest = hashlib.sha1(key.encode('utf8')).hexdigest()[:16]
+    name = '%s-%s-%s' % (envdict['execname'], envdict['version'], digest)
+    return os.path.join(os.path.abspath(os.path.expanduser(template_dir)), name)
+
+
+def get_template(template_dir, envdict, command, parallel):
+    """Returns the path to a template virtualenv, building it if needed
+
+    The command is the virtualenv creation command, without the target
+    directory. Returns None if the template could not be built.
+    """
+    path = template_path(template_dir, envdict, command)
+    with FileLock(path + '.lock'):
+        if os.path.isfile(os.path.join(path, TEMPLATE_MARKER)):
+            return path
+
+        if os.path.exists(path):
+            # A half built template, from an interrupted run.
+            shutil.rmtree(path)
+
+        logger.log(20, 'Building virtualenv template for %s' % envdict['path'])
+        command = command + [path]
+        logger.log(10, 'Using command: %s' % ' '.join(command))
+        returncode, tail = output.run(command, envdict['path'], parallel)
+        if returncode != 0:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            return None
+
+        with open(os.path.join(path, TEMPLATE_MARKER), 'wt') as marker:
+            marker.write(' '.join(command))
+    return path
+
+
+def _fix_file(path, old, new):
+    """Replaces the template path in a text file, without touching the original"""
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    if old not in data or b'\0' in data:
+        # Not changed, or a binary.
+        return
+    mode = os.stat(path).st_mode
+    # Write a new file, as a hardlinked file must not be changed in place.
+    atomic_write(path, data.replace(old, new))
+    os.chmod(path, mode)
+
+
+def clone(template, envdir, mode='copy'):
+    """Creates a virtualenv in envdir from a template
+
+    With the 'hardlink' mode the files are hardlinked instead of copied,
+    which is faster, but means the files are shared with the template.
+    """
+    if os.path.exists(envdir):
+        shutil.rmtree(envdir)
+
+    if mode == 'hardlink':
+        copy_function = os.link
+    else:
+        copy_function = shutil.copy2
+    shutil.copytree(template, envdir, symlinks=True, copy_function=copy_function)
+    os.remove(os.path.join(envdir, TEMPLATE_MARKER))
+
+    # The scripts and the config have the template path in them.
+    old = os.path.abspath(template).encode(sys.getfilesystemencoding())
+    new = os.path.abspath(envdir).encode(sys.getfilesystemencoding())
+    to_fix = [os.path.join(envdir, 'pyvenv.cfg')]
+    for directory in ('bin', 'Scripts'):
+        directory = os.path.join(envdir, directory)
+        if os.path.isdir(directory):
+            to_fix.extend(os.path.join(directory, name) for name in os.listdir(directory))
+
+    for path in to_fix:
+        if os.path.islink(path):
+            target = os.readlink(path)
+            if target.startswith(template):
+                os.remove(path)
+                os.symlink(envdir + target[len(template):], path)
+        elif os.path.isfile(path):
+            _fix_file(path, old, new)
+
+
+def make_profile(envname, envdict, setup_commands, requirements):
+    """Creates a profile of a virtualenv, to know when it needs updating"""
+    return {'version': PROFILE_VERSION,
+            'envname': envname,
+            'python': stat_key(envdict['path']),
+            'backend': envdict['backend'],
+            'setup-commands': setup_commands,
+            'requirements': sorted(set(requirements))}
+
+
+def read_profile(path):
+    """Reads the profile of an existing virtualenv, or returns None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rt') as infile:
+            profile = json.load(infile)
+    except (IOError, OSError, ValueError):
+        # Unreadable, or from an older version of spiny.
+        return None
+    if not isinstance(profile, dict) or profile.get('version') != PROFILE_VERSION:
+        return None
+    return profile
+
+
+def write_profile(path, profile):
+    atomic_write(path, json.dumps(profile, indent=1, sort_keys=True).encode('utf8'))
+
+
+def needs_rebuild(installed, profile):
+    """Checks if the virtualenv must be made from scratch
+
+    This is needed when the Python or how the virtualenv is made changes,
+    but not when only the requirements change.
+    """
+    if installed is None:
+        return True
+    for key in ('envname', 'python', 'backend', 'setup-commands'):
+        if installed.get(key) != profile[key]:
+            return True
+    return False
+
+
+def requirement_name(requirement):
+    """The project name of a requirement, like 'zope.interface' for 'zope.interface>=4'"""
+    match = REQUIREMENT_NAME_RE.match(requirement)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def canonical_name(name):
+    """Normalizes a project name, so 'Foo_Bar' and 'foo-bar' are the same"""
+    try:
+        from packaging.utils import canonicalize_name
+    except ImportError:
+        # The same as PEP 503.
+        return re.sub(r'[-_.]+', '-', name).lower()
+    return str(canonicalize_name(name))
+
+
+def diff_requirements(installed, wanted):
+    """Returns the requirements to install, and the project names to uninstall"""
+    to_install = [r for r in wanted if r not in installed]
+    wanted_names = set(canonical_name(requirement_name(r)) for r in wanted
+                       if requirement_name(r) is not None)
+    to_uninstall = []
+    for requirement in installed:
+        name = requirement_name(requirement)
+        if requirement in wanted or name is None:
+            continue
+        name = canonical_name(name)
+        if name not in wanted_names and name not in to_uninstall:
+            to_uninstall.append(name)
+    return to_install, to_uninstall
+
+
+def required_by_others(envpython, names):
+    """Returns the names that other projects installed in a virtualenv require
+
+    Those must not be uninstalled, even if they are no longer requirements
+    themselves. Returns None if it can't be found out.
+    """
+    try:
+        process = subprocess.Popen([envpython, '-c', REQUIRED_SCRIPT] + list(names),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        logger.log(10, stderr.decode('utf8', 'replace'))
+        return None
+    return set(stdout.decode('utf8').split())
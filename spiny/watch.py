@@ -0,0 +1,217 @@
+# Watches the project for changes, to rerun the tests.
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import select
+import struct
+import sys
+import time
+
+from spiny.projectdata import SETUP_FILES
+
+# Changes to these while the tests run are taken to be edits, other files are
+# taken to be written by the tests.
+SOURCE_SUFFIXES = ('.py', '.pyx', '.pxd')
+
+# inotify event masks, from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+
+# struct inotify_event, without the name that follows it.
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+logger = logging.getLogger('spiny')
+
+
+def _ignored(name):
+    return name.startswith('.') or name == '__pycache__' or name.endswith('.egg-info')
+
+
+def snapshot(root, ignore=()):
+    """Returns the mtime and size of each file, and the list of directories"""
+    ignore = set(os.path.abspath(path) for path in ignore)
+    files = {}
+    directories = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not _ignored(d) and
+                       os.path.abspath(os.path.join(dirpath, d)) not in ignore]
+        directories.append(dirpath)
+        for filename in filenames:
+            if _ignored(filename) or filename.endswith(('.pyc', '.pyo')):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Deleted while walking.
+                continue
+            files[path] = (st.st_mtime, st.st_size)
+    return files, directories
+
+
+def changed_files(old, new):
+    """Returns the files that were added, removed or changed between two snapshots"""
+    return sorted(path for path in set(old) | set(new) if old.get(path) != new.get(path))
+
+
+def needs_setup(changed):
+    """Checks if the changed files mean the virtualenvs must be updated"""
+    return any(os.path.basename(path) in SETUP_FILES for path in changed)
+
+
+def is_source(path):
+    return path.endswith(SOURCE_SUFFIXES) or os.path.basename(path) in SETUP_FILES
+
+
+def digest(path):
+    """A hash of the contents of a file, or None if it doesn't exist"""
+    try:
+        with open(path, 'rb') as infile:
+            return hashlib.sha1(infile.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+class Inotify(object):
+    """Waits for changes in directories with inotify, on Linux"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # The watch descriptor of each watched directory, and the other way.
+        self._watched = {}
+        self._directories = {}
+
+    def watch(self, directories):
+        """Watches the directories that are not already watched, and stops watching the rest"""
+        for directory in set(self._watched) - set(directories):
+            # Deleted, or now ignored.
+            wd = self._watched.pop(directory)
+            self._directories.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+        for directory in directories:
+            if directory in self._watched:
+                continue
+            wd = self._libc.inotify_add_watch(
+                self.fd, directory.encode(sys.getfilesystemencoding()), WATCH_MASK)
+            if wd >= 0:
+                self._watched[directory] = wd
+                self._directories[wd] = directory
+
+    def _forget(self, wd):
+        # The directory was deleted, so the kernel removed the watch. If it is
+        # made again, like by a git checkout, it must be watched again.
+        directory = self._directories.pop(wd, None)
+        if directory is not None and self._watched.get(directory) == wd:
+            del self._watched[directory]
+
+    def wait(self, timeout=None):
+        """Waits until something changes, or the timeout passes"""
+        readable, writable, errors = select.select([self.fd], [], [], timeout)
+        # Empty the queue, the changes are found by comparing snapshots.
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset + EVENT_SIZE <= len(data):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT, data, offset)
+                if mask & IN_IGNORED:
+                    self._forget(wd)
+                offset += EVENT_SIZE + length
+        return bool(readable)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Waits for files in a directory tree to change
+
+    Uses inotify on Linux, and otherwise checks the files every interval
+    seconds. Hidden files and directories, __pycache__ and the ignored
+    directories are not watched.
+    """
+
+    def __init__(self, root, ignore=(), interval=1.0, use_inotify=True):
+        self.root = root
+        self.ignore = ignore
+        self.interval = interval
+        self._inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError):
+                logger.log(10, 'No inotify, checking for changes every %s seconds' % interval)
+        self._pending = []
+        # The contents of the Python files that changed during the last run.
+        self._written = {}
+        self._files = self._scan()
+
+    def _scan(self):
+        files, directories = snapshot(self.root, self.ignore)
+        if self._inotify is not None:
+            # New directories need watches too.
+            self._inotify.watch(directories)
+        return files
+
+    def reset(self):
+        """Forgets the changes made by the tests, after the tests have run
+
+        The files are compared with when the run started. Changes to Python
+        and setup files are kept, and returned by the next wait(), as they
+        were edited while the tests ran. Other files are taken to be written
+        by the tests. So are Python files that got the same contents as
+        during the run before, so tests that write them don't rerun forever.
+        """
+        files = self._scan()
+        changed = [path for path in changed_files(self._files, files) if is_source(path)]
+        digests = dict((path, digest(path)) for path in changed)
+        self._pending = [path for path in changed
+                         if path not in self._written or digests[path] != self._written[path]]
+        self._written = digests
+        self._files = files
+
+    def wait(self):
+        """Waits until files change, and returns the changed files"""
+        if self._pending:
+            changed, self._pending = self._pending, []
+            return changed
+        while True:
+            if self._inotify is not None:
+                self._inotify.wait()
+                # Editors often write several files, wait for them to finish.
+                time.sleep(0.2)
+            else:
+                time.sleep(self.interval)
+
+            files = self._scan()
+            changed = changed_files(self._files, files)
+            self._files = files
+            if changed:
+                return changed
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
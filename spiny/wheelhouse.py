@@ -0,0 +1,148 @@
+# A local wheelhouse, so requirements are downloaded and built only once per
+# Python version, and then installed from local files.
+import json
+import logging
+import os
+import os.path
+import re
+import time
+
+from spiny import output
+from spiny.cache import FileLock, atomic_write
+from spiny.environment import map_concurrently
+
+# Lists the requirements that have been built into a wheelhouse directory,
+# and when they were built.
+MANIFEST = '.spiny-wheels'
+
+# Seconds until requirements that are not pinned to a version are resolved
+# again, to get new releases.
+UNPINNED_MAX_AGE = 24 * 60 * 60
+
+# A requirement for exactly one version, like 'six==1.16.0; python_version < "3"'.
+PINNED_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*(\[[^\]]*\])?\s*===?\s*[^\s,;*]+\s*(;.*)?$')
+
+logger = logging.getLogger('spiny')
+
+
+def clean_requirements(requirements):
+    """Strips requirements and removes empty lines and comments"""
+    result = []
+    for requirement in requirements:
+        requirement = requirement.strip()
+        if requirement and not requirement.startswith('#'):
+            result.append(requirement)
+    return result
+
+
+def usable(requirements):
+    """Checks if the requirements can be installed from a wheelhouse
+
+    Options, URLs and local paths are installed the normal way.
+    """
+    for requirement in clean_requirements(requirements):
+        if (requirement.startswith(('-', '.', '/')) or '://' in requirement or
+                os.path.exists(requirement)):
+            return False
+    return True
+
+
+def pinned(requirement):
+    """Checks if a requirement is for one version only, so it never needs resolving again"""
+    return PINNED_RE.match(requirement) is not None
+
+
+def find_links(dependency_links):
+    """The pip arguments to look for packages in the dependency links"""
+    arguments = []
+    for link in dependency_links:
+        arguments.extend(['-f', link])
+    return arguments
+
+
+def read_manifest(path):
+    """Returns when each requirement in a wheelhouse was built"""
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'rt') as manifest:
+        return json.load(manifest)
+
+
+def abi_dir(wheelhouse_dir, envdict):
+    """The wheelhouse directory for the implementation and language version of a Python"""
+    name = '%s-%s.%s' % ((envdict['implementation'].lower(),) +
+                         tuple(envdict['version_info'][:2]))
+    if envdict['implementation'] != 'CPython':
+        # The version is PyPy's own, its ABI changes with it.
+        name += '-' + '.'.join(envdict['version'].split('.')[:2])
+    return os.path.join(os.path.abspath(os.path.expanduser(wheelhouse_dir)), name)
+
+
+def build(wheelhouse_dir, envdict, requirements, dependency_links, parallel):
+    """Builds wheels for the requirements that are not already built
+
+    Requirements that are not pinned to one version are built again when
+    they are older than UNPINNED_MAX_AGE, so pip resolves them again and
+    new releases are used.
+
+    Returns the directory with the wheels, or None if they could not be built.
+    """
+    directory = abi_dir(wheelhouse_dir, envdict)
+    manifest_path = os.path.join(directory, MANIFEST)
+    requirements = clean_requirements(requirements)
+    with FileLock(directory + '.lock'):
+        built = read_manifest(manifest_path)
+        now = time.time()
+        missing = [r for r in requirements if r not in built or
+                   (not pinned(r) and now - built[r] > UNPINNED_MAX_AGE)]
+        if not missing:
+            return directory
+
+        logger.log(20, 'Building wheels for %s' % envdict['path'])
+        command = [envdict['path'], '-m', 'pip', 'wheel', '-q', '-w', directory,
+                   '-f', directory] + find_links(dependency_links) + missing
+        logger.log(10, 'Using command: %s' % ' '.join(command))
+        returncode, tail = output.run(command, envdict['path'], parallel)
+        if returncode != 0:
+            return None
+
+        built.update((requirement, now) for requirement in missing)
+        data = json.dumps(built, indent=0, sort_keys=True)
+        atomic_write(manifest_path, data.encode('utf8'))
+    return directory
+
+
+def prepare(wheelhouse_dir, jobs, max_workers, parallel):
+    """Builds the wheels for all environments, in parallel
+
+    jobs is a list of (envname, envdict, requirements, dependency_links).
+    Returns a dictionary with the wheelhouse directory for each environment,
+    or None for environments that should install the normal way.
+    """
+    result = {}
+    groups = []
+    for envname, envdict, requirements, dependency_links in jobs:
+        result[envname] = None
+        if not requirements or not envdict.get('has_pip') or not usable(requirements):
+            continue
+
+        # Environments with the same Python version and requirements are built once.
+        key = (abi_dir(wheelhouse_dir, envdict), sorted(clean_requirements(requirements)))
+        for group in groups:
+            if group[0] == key:
+                group[1].append(envname)
+                break
+        else:
+            groups.append((key, [envname], envdict, requirements, dependency_links))
+
+    def build_group(group):
+        key, envnames, envdict, requirements, dependency_links = group
+        return build(wheelhouse_dir, envdict, requirements, dependency_links, parallel)
+
+    for group, directory in zip(groups, map_concurrently(build_group, groups, max_workers)):
+        if directory is None:
+            logger.log(30, 'Could not build wheels for %s, installing '
+                           'from the index instead.' % ', '.join(group[1]))
+        for envname in group[1]:
+            result[envname] = directory
+    return result
@@ -0,0 +1,302 @@
+"""Benchmarks of the time spiny itself spends, apart from the commands it runs
+
+Run it from the root of the project with ``python -m tests.benchmark``. The
+scenarios are built in a temporary directory, with a PATH of hundreds of
+directories and dozens of fake Pythons, which are small shell scripts that
+answer the probe and pretend to be pip. Nothing is downloaded, so it runs
+offline, and the numbers of two commits can be compared with --output and
+--compare. It needs a Unix with /bin/sh.
+
+For each scenario the median of the repeats is shown, of the wall time, the
+CPU time of spiny itself and the CPU time of the processes it ran. The
+startup scenario runs ``spiny --version`` in a new process, so all its time
+is in the child, and it is compared with STARTUP_BUDGET. The exit code is 1
+if it took longer.
+"""
+import argparse
+import json
+import logging
+import os
+import os.path
+import platform
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from spiny import main, timing, venvs
+from spiny.environment import get_pythons
+from .utils import make_conf
+
+STUB = """#!/bin/sh
+if [ "$1" = "-c" ]; then
+    printf 'spiny-probe:implementation=CPython\\n'
+    printf 'spiny-probe:version=%(version)s\\n'
+    printf 'spiny-probe:version_info=%(version)s\\n'
+    printf 'spiny-probe:pypy_version=\\n'
+    printf 'spiny-probe:prefix=%(prefix)s\\n'
+    printf 'spiny-probe:virtualenv=False\\n'
+    printf 'spiny-probe:venv=True\\n'
+    printf 'spiny-probe:ensurepip=True\\n'
+    printf 'spiny-probe:pip=True\\n'
+fi
+exit 0
+"""
+
+SETUP_PY = """from setuptools import setup
+
+setup(name='benchmarked',
+      install_requires=['dinsdale', 'piranha'],
+      tests_require=['spiny-test-helper'])
+"""
+
+SCENARIOS = ('startup', 'discovery-cold', 'discovery-warm', 'prepare', 'setup-uptodate',
+             'setup-changed')
+
+DEFAULT_PATH_ENTRIES = 300
+DEFAULT_STUBS = 40
+DEFAULT_REPEAT = 5
+
+# Seconds that starting spiny may take, including starting Python.
+STARTUP_BUDGET = 0.25
+# How many times the budget a slow or busy machine, like a CI runner, may take.
+CI_TOLERANCE = 4
+
+
+def write_stub(path, version, prefix):
+    with open(path, 'wt') as outfile:
+        outfile.write(STUB % {'version': version, 'prefix': prefix})
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+class Sandbox(object):
+    """A temporary PATH with fake Pythons, a project and a spiny configuration"""
+
+    def __init__(self, path_entries=DEFAULT_PATH_ENTRIES, stubs=DEFAULT_STUBS):
+        self.path_entries = path_entries
+        self.stubs = stubs
+
+    def __enter__(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_path = os.environ['PATH']
+        self.old_home = os.environ.get('HOME')
+        self.old_cwd = os.getcwd()
+        try:
+            self._build()
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def _build(self):
+        bindir = os.path.join(self.tempdir, 'path')
+        directories = []
+        for index in range(self.path_entries):
+            directory = os.path.join(bindir, str(index))
+            os.makedirs(directory)
+            # Most directories have other executables, not Pythons.
+            for name in ('tool%s' % index, 'helper%s-config' % index):
+                open(os.path.join(directory, name), 'w').close()
+            directories.append(directory)
+
+        self.envnames = []
+        step = max(1, self.path_entries // max(1, self.stubs))
+        for index in range(self.stubs):
+            minor = index + 3
+            directory = directories[(index * step) % self.path_entries]
+            prefix = os.path.join(self.tempdir, 'prefix', str(minor))
+            write_stub(os.path.join(directory, 'python3.%s' % minor), '3.%s.0' % minor, prefix)
+            self.envnames.append('python3.%s' % minor)
+
+        self.project = os.path.join(self.tempdir, 'project')
+        os.mkdir(self.project)
+        with open(os.path.join(self.project, 'setup.py'), 'wt') as outfile:
+            outfile.write(SETUP_PY)
+
+        self.cache_file = os.path.join(self.tempdir, 'pythons.json')
+        self.venv_dir = os.path.join(self.tempdir, 'venvs')
+        self.conf = make_conf()
+        self.conf.set('spiny', 'environments', ' '.join(self.envnames))
+        self.conf.set('spiny', 'cache-file', self.cache_file)
+        self.conf.set('spiny', 'venv-dir', self.venv_dir)
+        self.conf.set('spiny', 'use-wheelhouse', 'false')
+
+        os.environ['PATH'] = os.pathsep.join(directories)
+        os.environ['HOME'] = self.tempdir
+        os.chdir(self.project)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.chdir(self.old_cwd)
+        os.environ['PATH'] = self.old_path
+        if self.old_home is None:
+            os.environ.pop('HOME', None)
+        else:
+            os.environ['HOME'] = self.old_home
+        shutil.rmtree(self.tempdir)
+
+    def clear_cache(self):
+        if os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+    def make_venvs(self, argslist, changed=False):
+        """Makes fake virtualenvs that are up to date, or miss a requirement"""
+        for args in argslist:
+            envdir, python, env_parameters, curdir = main.environment_paths(args)
+            bindir = os.path.dirname(python)
+            if not os.path.isdir(bindir):
+                os.makedirs(bindir)
+            for path in (python, os.path.join(bindir, 'pip')):
+                write_stub(path, args[1]['version'], envdir)
+            requirements = args[5]
+            if changed:
+                requirements = requirements[1:]
+            profile = venvs.make_profile(args[0], args[1], args[3], requirements)
+            venvs.write_profile(os.path.join(envdir, '.spiny-profile'), profile)
+
+
+def usage():
+    """The wall time, and the CPU time of this process and of its children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time(), own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(function, repeat, before=None):
+    """Calls function repeat times, and returns the median times"""
+    samples = []
+    for index in range(repeat):
+        if before is not None:
+            before()
+        start = usage()
+        function()
+        end = usage()
+        samples.append([e - s for s, e in zip(start, end)])
+    return dict(zip(('wall', 'cpu', 'children'),
+                    [median([sample[i] for sample in samples]) for i in range(3)]))
+
+
+def run_scenarios(names=SCENARIOS, repeat=DEFAULT_REPEAT, path_entries=DEFAULT_PATH_ENTRIES,
+                  stubs=DEFAULT_STUBS):
+    """Runs the scenarios, and returns a dict with the median times of each"""
+    results = {}
+    if 'startup' in names:
+        command = [sys.executable, '-m', 'spiny.main', '--version']
+        results['startup'] = measure(lambda: subprocess.check_output(command), repeat)
+
+    with Sandbox(path_entries, stubs) as sandbox:
+        conf = sandbox.conf
+
+        if 'discovery-cold' in names:
+            results['discovery-cold'] = measure(lambda: get_pythons(conf), repeat,
+                                                sandbox.clear_cache)
+
+        # Everything after this has the Pythons in the cache.
+        get_pythons(conf)
+        if 'discovery-warm' in names:
+            results['discovery-warm'] = measure(lambda: get_pythons(conf), repeat)
+
+        if 'prepare' in names:
+            results['prepare'] = measure(lambda: main.prepare_tests(conf), repeat)
+
+        # The output of the fake pip is logged, not written to the terminal.
+        argslist = [args[:10] + (True,) for args in main.prepare_tests(conf)['argslist']]
+
+        def setup_all():
+            for args in argslist:
+                message = main.setup_environment(args)
+                if message:
+                    raise RuntimeError(message)
+
+        if 'setup-uptodate' in names:
+            sandbox.make_venvs(argslist)
+            results['setup-uptodate'] = measure(setup_all, repeat)
+
+        if 'setup-changed' in names:
+            results['setup-changed'] = measure(
+                setup_all, repeat, lambda: sandbox.make_venvs(argslist, changed=True))
+
+    # Forget what the phases recorded.
+    timing.collect()
+    return results
+
+
+def format_results(results, baseline=None):
+    lines = ['%-16s %9s %10s %10s' % ('Scenario', 'Wall', 'spiny CPU', 'Child CPU')]
+    for name in SCENARIOS:
+        if name not in results:
+            continue
+        result = results[name]
+        line = '%-16s %8.3fs %9.3fs %9.3fs' % (name, result['wall'], result['cpu'],
+                                               result['children'])
+        if baseline and name in baseline and baseline[name]['cpu'] > 0:
+            change = (result['cpu'] - baseline[name]['cpu']) / baseline[name]['cpu']
+            line += '  %+.0f%% spiny CPU' % (change * 100)
+        lines.append(line)
+    if over_budget(results):
+        lines.append('Starting spiny took longer than the budget of %ss' % STARTUP_BUDGET)
+    return '\n'.join(lines)
+
+
+def over_budget(results, tolerance=1):
+    """Checks if starting spiny took longer than the budget, times the tolerance"""
+    return 'startup' in results and results['startup']['wall'] > STARTUP_BUDGET * tolerance
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks spiny's own overhead.")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='How many times to run each scenario, the median is shown.')
+    parser.add_argument('--path-entries', type=int, default=DEFAULT_PATH_ENTRIES,
+                        help='How many directories to put on the PATH.')
+    parser.add_argument('--stubs', type=int, default=DEFAULT_STUBS,
+                        help='How many fake Pythons to put on the PATH.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='A scenario to run, defaults to all of them.')
+    parser.add_argument('--output', metavar='<filename>',
+                        help='Save the results as JSON, to compare with later.')
+    parser.add_argument('--compare', metavar='<filename>',
+                        help='Compare with the results saved by an earlier run.')
+    args = parser.parse_args(argv)
+
+    # Don't show the errors of the fake pip and such.
+    logging.getLogger('spiny').setLevel(100)
+
+    settings = {'repeat': args.repeat, 'path-entries': args.path_entries,
+                'stubs': args.stubs, 'python': platform.python_version(),
+                'platform': sys.platform}
+    results = run_scenarios(args.scenario or SCENARIOS, args.repeat, args.path_entries,
+                            args.stubs)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'rt') as infile:
+            saved = json.load(infile)
+        if saved['settings'] != settings:
+            print('The settings differ from %s, the numbers are not comparable: %s' %
+                  (args.compare, saved['settings']))
+        baseline = saved['results']
+
+    print(format_results(results, baseline))
+
+    if args.output:
+        with open(args.output, 'wt') as outfile:
+            json.dump({'settings': settings, 'results': results}, outfile, indent=1,
+                      sort_keys=True)
+    # So it can fail a build.
+    return 1 if over_budget(results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
@@ -0,0 +1,29 @@
+import sys
+import unittest
+
+from . import benchmark
+
+
+@unittest.skipIf(sys.platform == 'win32', 'The fake Pythons are shell scripts')
+class TestBenchmark(unittest.TestCase):
+
+    def test_scenarios(self):
+        # Small and once, only to check that the scenarios still work.
+        results = benchmark.run_scenarios(repeat=1, path_entries=20, stubs=5)
+        self.assertEqual(sorted(results), sorted(benchmark.SCENARIOS))
+        for result in results.values():
+            self.assertEqual(sorted(result), ['children', 'cpu', 'wall'])
+        # Only the cold discovery and changed virtualenvs run anything.
+        self.assertTrue(results['discovery-cold']['children'] > 0)
+        self.assertTrue(results['setup-changed']['children'] > 0)
+
+        table = benchmark.format_results(results, results).splitlines()
+        self.assertEqual(table[0].split()[0], 'Scenario')
+        rows = [line.split()[0] for line in table[1:]]
+        self.assertEqual(rows[:len(benchmark.SCENARIOS)], list(benchmark.SCENARIOS))
+
+    def test_startup_budget(self):
+        # With room for slow and busy machines, it's only to catch big slowdowns.
+        results = benchmark.run_scenarios(['startup'], repeat=3, path_entries=1, stubs=1)
+        self.assertFalse(benchmark.over_budget(results, benchmark.CI_TOLERANCE),
+                         'Starting spiny took %.3fs' % results['startup']['wall'])
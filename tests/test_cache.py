@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from spiny import cache
+
+
+class TestCacheFile(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.test_dir, 'sub', 'test.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_roundtrip(self):
+        cachefile = cache.CacheFile(self.cache_file)
+        cachefile.set('pythons', '/usr/bin/python', {'payload': None})
+        cachefile.save()
+
+        cachefile = cache.CacheFile(self.cache_file)
+        self.assertEqual(cachefile.get('pythons', '/usr/bin/python'), {'payload': None})
+        self.assertEqual(cachefile.keys('pythons'), ['/usr/bin/python'])
+
+    def test_no_rewrite_when_unchanged(self):
+        cachefile = cache.CacheFile(self.cache_file)
+        cachefile.set('pythons', 'a', 1)
+        cachefile.save()
+
+        os.utime(self.cache_file, (0, 0))
+        cachefile = cache.CacheFile(self.cache_file)
+        cachefile.set('pythons', 'a', 1)
+        self.assertFalse(cachefile.changed)
+        cachefile.save()
+        self.assertEqual(os.stat(self.cache_file).st_mtime, 0)
+
+    def test_concurrent_writers_merge(self):
+        first = cache.CacheFile(self.cache_file)
+        second = cache.CacheFile(self.cache_file)
+        first.set('pythons', 'a', 1)
+        second.set('pythons', 'b', 2)
+        first.save()
+        second.save()
+
+        cachefile = cache.CacheFile(self.cache_file)
+        self.assertEqual(cachefile.get('pythons', 'a'), 1)
+        self.assertEqual(cachefile.get('pythons', 'b'), 2)
+
+        second.delete('pythons', 'b')
+        second.save()
+        cachefile = cache.CacheFile(self.cache_file)
+        self.assertEqual(cachefile.keys('pythons'), ['a'])
+
+    def test_prune(self):
+        cachefile = cache.CacheFile(self.cache_file)
+        for key in ('used', 'touched', 'unused'):
+            cachefile.set('durations', key, 1)
+        cachefile.save()
+
+        # Pretend the entries were last used 40 days ago.
+        with open(self.cache_file, 'rt') as infile:
+            data = json.load(infile)
+        for key in data['times']['durations']:
+            data['times']['durations'][key] = time.time() - 40 * 24 * 60 * 60
+        with open(self.cache_file, 'wt') as outfile:
+            json.dump(data, outfile)
+
+        cachefile = cache.CacheFile(self.cache_file)
+        cachefile.set('durations', 'used', 2)
+        cachefile.touch('durations', 'touched')
+        cachefile.prune('durations')
+        cachefile.save()
+        cachefile = cache.CacheFile(self.cache_file)
+        self.assertEqual(sorted(cachefile.keys('durations')), ['touched', 'used'])
+
+    def test_other_version_ignored(self):
+        os.mkdir(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'wt') as outfile:
+            json.dump({'version': -1, 'sections': {'pythons': {'a': 1}}}, outfile)
+        self.assertIsNone(cache.CacheFile(self.cache_file).get('pythons', 'a'))
+
+        # Old pickled caches are also ignored
+        with open(self.cache_file, 'wb') as outfile:
+            outfile.write(b'\x80\x02}q\x00.')
+        self.assertIsNone(cache.CacheFile(self.cache_file).get('pythons', 'a'))
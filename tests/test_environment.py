@@ -1,9 +1,11 @@
 import os
 import sys
+import time
 import unittest
 
 from spiny import environment
 from spiny import main
+from spiny.cache import CacheFile
 from .utils import TestEnvironment
 from .utils import make_conf
 
@@ -87,6 +89,134 @@ class TestEnvironmentChecks(unittest.TestCase):
 
         self.assertNotIn('python4', pythons)
 
+    def test_concurrent_probing(self):
+        conf = make_conf()
+        conf.set('spiny', 'environments', '')
+        conf.set('spiny', 'max-probes', '1')
+        serial = environment.get_pythons(conf)
+        conf.set('spiny', 'max-probes', '8')
+        concurrent = environment.get_pythons(conf)
+        self.assertEqual(serial, concurrent)
+
+    def test_map_concurrently_keeps_order(self):
+        def slow(x):
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+        self.assertEqual(environment.map_concurrently(slow, range(5), 5),
+                         [0, 2, 4, 6, 8])
+        self.assertEqual(environment.map_concurrently(slow, range(5), 1),
+                         [0, 2, 4, 6, 8])
+
+    def test_probe_python(self):
+        payload = environment.probe_python(sys.executable)
+        self.assertEqual(payload['version_info'], list(sys.version_info[:3]))
+        self.assertEqual(payload['prefix'], sys.prefix)
+        self.assertTrue(payload['pip'] in (True, False))
+
+        info = environment.make_info(sys.executable, payload)
+        self.assertIn('python%s.%s' % sys.version_info[:2], info['environments'])
+
+    def test_probe_not_python(self):
+        with TestEnvironment([]) as env:
+            fake = os.path.join(env.test_dir, 'python9')
+            with open(fake, 'wt') as script:
+                script.write('#!/bin/sh\necho Python 9.0\n')
+            os.chmod(fake, 0o755)
+            self.assertIsNone(environment.probe_python(fake))
+            self.assertNotIn('python9', environment.get_pythons(make_conf()))
+
+            # The failure is cached, so it's not run again.
+            cache_file = os.path.join(env.test_dir, '.cache', 'spiny', 'pythons.json')
+            entry = CacheFile(cache_file).get('pythons', os.path.realpath(fake))
+            self.assertIsNone(entry['payload'])
+
+    def test_python_names_index(self):
+        with TestEnvironment([]) as env:
+            cachefile = CacheFile(os.path.join(env.test_dir, 'test.cache'))
+            for name in ('python3.9', 'pypy', 'python3-config', 'pythonista'):
+                with open(os.path.join(env.test_dir, name), 'wb'):
+                    pass
+            os.mkdir(os.path.join(env.test_dir, 'python'))
+
+            names = environment.list_python_names(env.test_dir, cachefile)
+            self.assertEqual(names, ['pypy', 'python3.9'])
+
+            # Unchanged directories are not listed again
+            entry = cachefile.get('directories', env.test_dir)
+            cachefile.set('directories', env.test_dir, dict(entry, names=['jython']))
+            self.assertEqual(environment.list_python_names(env.test_dir, cachefile),
+                             ['jython'])
+
+            # But changed directories are
+            with open(os.path.join(env.test_dir, 'python2'), 'wb'):
+                pass
+            os.utime(env.test_dir, (0, 0))
+            self.assertEqual(environment.list_python_names(env.test_dir, cachefile),
+                             ['pypy', 'python2', 'python3.9'])
+
+    def test_static_python_info(self):
+        payload = environment.static_python_info(sys.executable)
+        if payload is not None:
+            self.assertEqual(payload, environment.probe_python(sys.executable))
+
+        with TestEnvironment([]) as env:
+            def touch(*parts):
+                path = os.path.join(env.test_dir, *parts)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb'):
+                    pass
+                return path
+
+            # A pyenv style install
+            exe = touch('3.9.1', 'bin', 'python3.9')
+            touch('3.9.1', 'lib', 'python3.9', 'os.py')
+            touch('3.9.1', 'lib', 'python3.9', 'venv', '__init__.py')
+            touch('3.9.1', 'lib', 'python3.9', 'site-packages', 'pip', '__init__.py')
+            payload = environment.static_python_info(exe)
+            self.assertEqual(payload['version'], '3.9.1')
+            self.assertEqual(payload['version_info'], [3, 9, 1])
+            self.assertTrue(payload['venv'])
+            self.assertTrue(payload['pip'])
+            self.assertFalse(payload['virtualenv'])
+
+            # An unversioned name with several versions installed is ambiguous
+            exe = touch('3.9.1', 'bin', 'python')
+            touch('3.9.1', 'lib', 'python3.8', 'os.py')
+            self.assertIsNone(environment.static_python_info(exe))
+
+            # The version comes from the headers, if the directory doesn't tell
+            exe = touch('usr', 'bin', 'python3.9')
+            touch('usr', 'lib', 'python3.9', 'os.py')
+            self.assertIsNone(environment.static_python_info(exe))
+            header = touch('usr', 'include', 'python3.9', 'patchlevel.h')
+            with open(header, 'wt') as outfile:
+                outfile.write('#define PY_VERSION      "3.9.2rc1"\n')
+            self.assertEqual(environment.static_python_info(exe)['version'], '3.9.2rc1')
+
+    def test_choose_backend(self):
+        info = {'path': sys.executable, 'implementation': 'CPython',
+                'version_info': [3, 6, 0], 'has_venv': True, 'has_ensurepip': True,
+                'has_virtualenv': True}
+        self.assertEqual(environment.choose_backend(info), 'venv')
+        self.assertEqual(environment.choose_backend(info, 'virtualenv'), 'virtualenv')
+
+        # No ensurepip means venv can only be used with a shared pip
+        info['has_ensurepip'] = False
+        self.assertEqual(environment.choose_backend(info), 'virtualenv')
+        self.assertEqual(environment.choose_backend(info, shared_pip=True), 'venv')
+
+        # Python 2 has no venv
+        info = dict(info, version_info=[2, 7, 18], has_venv=False)
+        self.assertEqual(environment.choose_backend(info), 'virtualenv')
+        self.assertIsNone(environment.choose_backend(info, 'venv'))
+
+        # If the current Pythons virtualenv can be used, it's external.
+        info = dict(info, has_virtualenv=False, external=True)
+        self.assertEqual(environment.choose_backend(info), 'external')
+        info['external'] = False
+        self.assertIsNone(environment.choose_backend(info))
+
     # This is not currently useful
     # The idea here is to make a test that exersizes the case when a Python install
     # does not have a virtualenv installed, and can't be installed with the
@@ -0,0 +1,122 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from spiny import forkserver
+
+SCRIPT = """
+import sys
+import slow_module
+print('Imported %s' % slow_module.__name__)
+sys.exit(int(sys.argv[1]))
+"""
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'Needs fork')
+class TestForkServer(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.envdir = os.path.join(self.test_dir, 'env')
+        os.mkdir(self.envdir)
+        # A module that takes long to import.
+        with open(os.path.join(self.test_dir, 'slow_module.py'), 'wt') as outfile:
+            outfile.write('import time\ntime.sleep(1)\n')
+        with open(os.path.join(self.test_dir, 'script.py'), 'wt') as outfile:
+            outfile.write(SCRIPT)
+        self.run_dir = os.path.abspath(os.curdir)
+        os.chdir(self.test_dir)
+        self.old_pythonpath = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = self.test_dir
+
+    def tearDown(self):
+        if self.old_pythonpath is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self.old_pythonpath
+        os.chdir(self.run_dir)
+        # Stop the server, by asking with another key.
+        server = forkserver.ForkServer(sys.executable, self.envdir, [], 1)
+        server.key = 'stop'
+        try:
+            server._connect().sendall(b'{"key": "stop"}\n')
+        except Exception:
+            pass
+        shutil.rmtree(self.test_dir)
+
+    def test_supports(self):
+        server = forkserver.ForkServer(sys.executable, self.envdir, [])
+        self.assertTrue(server.supports([sys.executable, '-m', 'unittest']))
+        self.assertTrue(server.supports([sys.executable, 'setup.py', 'test']))
+        self.assertFalse(server.supports([sys.executable, '-W', 'error', 'setup.py']))
+        self.assertFalse(server.supports(['nosetests']))
+
+    def test_run(self):
+        server = forkserver.ForkServer(sys.executable, self.envdir, ['slow_module'], 10)
+        self.assertEqual(server.run([sys.executable, 'script.py', '0'], 'env', True), 0)
+
+        # The module is already imported, so this is fast.
+        start = time.time()
+        self.assertEqual(server.run([sys.executable, 'script.py', '3'], 'env', True), 3)
+        self.assertEqual(server.run([sys.executable, '-c', 'import slow_module'], 'env', True), 0)
+        self.assertLess(time.time() - start, 0.9)
+
+        # When the virtualenv changes, a new server is started.
+        with open(os.path.join(self.envdir, '.spiny-profile'), 'wt') as profile:
+            profile.write('{}')
+        server = forkserver.ForkServer(sys.executable, self.envdir, [], 10)
+        start = time.time()
+        self.assertEqual(server.run([sys.executable, 'script.py', '0'], 'env', True), 0)
+        self.assertGreater(time.time() - start, 0.9)
+
+    def test_environment(self):
+        server = forkserver.ForkServer(sys.executable, self.envdir, [], 10)
+        script = 'import os, sys; sys.exit(int(os.environ.get("SPINY_TEST_CODE", 0)))'
+        self.assertEqual(server.run([sys.executable, '-c', script], 'env', True), 0)
+        # The same server runs the command with the new environment.
+        os.environ['SPINY_TEST_CODE'] = '7'
+        try:
+            self.assertEqual(server.run([sys.executable, '-c', script], 'env', True), 7)
+        finally:
+            del os.environ['SPINY_TEST_CODE']
+        self.assertEqual(server.run([sys.executable, '-c', script], 'env', True), 0)
+
+        old_umask = os.umask(0o077)
+        try:
+            script = 'import os, sys; sys.exit(os.umask(0))'
+            self.assertEqual(server.run([sys.executable, '-c', script], 'env', True), 0o077)
+        finally:
+            os.umask(old_umask)
+
+    def test_private_socket(self):
+        old_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        os.environ['XDG_RUNTIME_DIR'] = self.test_dir
+        try:
+            server = forkserver.ForkServer(sys.executable, self.envdir, [], 10)
+        finally:
+            if old_runtime_dir is None:
+                del os.environ['XDG_RUNTIME_DIR']
+            else:
+                os.environ['XDG_RUNTIME_DIR'] = old_runtime_dir
+        socket_dir = os.path.join(self.test_dir, 'spiny')
+        self.assertEqual(os.path.dirname(server.path), socket_dir)
+        self.assertEqual(server.run([sys.executable, '-c', 'pass'], 'env', True), 0)
+        self.assertEqual(os.stat(socket_dir).st_mode & 0o777, 0o700)
+        server._connect().sendall(b'{"key": "stop"}\n')
+
+        if os.getuid() == 0:
+            # A socket made by another user is not used.
+            while os.path.exists(server.path):
+                time.sleep(0.02)
+            other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                other.bind(server.path)
+                other.listen(1)
+                os.chown(server.path, 65534, -1)
+                self.assertRaises(socket.error, server._connect)
+            finally:
+                other.close()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from spiny import load
+
+
+class TestLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.proc_cgroup = os.path.join(self.test_dir, 'cgroup')
+        self.meminfo = os.path.join(self.test_dir, 'meminfo')
+        self.root = os.path.join(self.test_dir, 'sys')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, path, text):
+        path = os.path.join(self.test_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wt') as outfile:
+            outfile.write(text)
+
+    def test_cgroup_v2(self):
+        self.write('cgroup', '0::/ci/job1\n')
+        self.assertEqual(load.cgroup_dirs(self.root, self.proc_cgroup),
+                         [os.path.join(self.root, 'ci', 'job1'),
+                          os.path.join(self.root, 'ci'),
+                          self.root])
+        self.assertEqual(load.cpu_quota(self.root, self.proc_cgroup), None)
+
+        # The lowest limit of the cgroup and its parents is used.
+        self.write('sys/cpu.max', 'max 100000\n')
+        self.write('sys/ci/cpu.max', '400000 100000\n')
+        self.write('sys/ci/job1/cpu.max', '150000 100000\n')
+        self.assertEqual(load.cpu_quota(self.root, self.proc_cgroup), 1.5)
+
+        # The CPU time used is from the cgroup with the lowest limit.
+        self.assertEqual(load.cpu_time(self.root, self.proc_cgroup), None)
+        self.write('sys/ci/cpu.stat', 'usage_usec 9000000\n')
+        self.write('sys/ci/job1/cpu.stat', 'usage_usec 2500000\nuser_usec 2000000\n')
+        self.assertEqual(load.cpu_time(self.root, self.proc_cgroup), 2.5)
+
+        self.write('meminfo', 'MemTotal:       16000000 kB\n'
+                              'MemAvailable:    8000000 kB\n')
+        self.assertEqual(load.available_memory(self.root, self.proc_cgroup, self.meminfo),
+                         8000000 * 1024)
+        self.write('sys/ci/memory.max', '1000000000\n')
+        self.write('sys/ci/memory.current', '400000000\n')
+        self.write('sys/ci/job1/memory.max', 'max\n')
+        self.write('sys/ci/job1/memory.current', '300000000\n')
+        self.assertEqual(load.available_memory(self.root, self.proc_cgroup, self.meminfo),
+                         600000000)
+
+    def test_cgroup_v1(self):
+        self.write('cgroup', '4:cpu,cpuacct:/docker/abc\n')
+        self.write('sys/cpu/cpu.cfs_quota_us', '-1\n')
+        self.write('sys/cpu/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(load.cpu_quota(self.root, self.proc_cgroup), None)
+        self.write('sys/cpu/cpuacct.usage', '1500000000\n')
+        self.assertEqual(load.cpu_time(self.root, self.proc_cgroup), None)
+        self.write('sys/cpu/cpu.cfs_quota_us', '200000\n')
+        self.assertEqual(load.cpu_quota(self.root, self.proc_cgroup), 2.0)
+        self.assertEqual(load.cpu_time(self.root, self.proc_cgroup), 1.5)
+
+        self.assertEqual(load.available_memory(self.root, self.proc_cgroup, self.meminfo),
+                         None)
+        self.write('sys/memory/memory.limit_in_bytes', '9223372036854771712\n')
+        self.write('sys/memory/memory.usage_in_bytes', '100\n')
+        self.assertEqual(load.available_memory(self.root, self.proc_cgroup, self.meminfo),
+                         None)
+        self.write('sys/memory/memory.limit_in_bytes', '1000\n')
+        self.assertEqual(load.available_memory(self.root, self.proc_cgroup, self.meminfo),
+                         900)
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(load.parse_cpu_list('0-3,6'), set([0, 1, 2, 3, 6]))
+        self.assertEqual(load.parse_cpu_list('1 2'), set([1, 2]))
+
+    def test_available_cpus(self):
+        self.assertTrue(1 <= load.available_cpus() <= load.cpu_count())
+
+
+class TestController(unittest.TestCase):
+
+    def setUp(self):
+        self.functions = (load.available_cpus, load.load_average, load.available_memory,
+                          load.cpu_time)
+        self.cpus = 4
+        self.load = 0.0
+        self.memory = 8 * 1024 ** 3
+        load.available_cpus = lambda: self.cpus
+        load.load_average = lambda: self.load
+        load.available_memory = lambda: self.memory
+        load.cpu_time = lambda: None
+
+    def tearDown(self):
+        (load.available_cpus, load.load_average, load.available_memory,
+         load.cpu_time) = self.functions
+
+    def test_limit(self):
+        controller = load.Controller()
+        self.assertEqual(controller.limit('test', 0), 4)
+        self.assertEqual(controller.limit('setup', 0), None)
+
+        # Three tests running make a load of three, which doesn't count.
+        self.load = 3.0
+        self.assertEqual(controller.limit('test', 3), 4)
+        # Other processes use two of the CPUs.
+        self.load = 5.0
+        self.assertEqual(controller.limit('test', 3), 2)
+        # A stage can always run one.
+        self.load = 20.0
+        self.assertEqual(controller.limit('test', 0), 1)
+
+        # Nothing new is started when the memory is short.
+        self.load = 0.0
+        self.memory = 100 * 1024 ** 2
+        self.assertEqual(controller.limit('test', 2), 2)
+        self.assertEqual(controller.limit('setup', 1), 1)
+        self.assertEqual(controller.limit('setup', 0), 1)
+
+        self.load = None
+        self.memory = None
+        self.assertEqual(controller.limit('test', 0), 4)
+        self.assertEqual(controller.limit('setup', 0), None)
+
+    def test_cgroup_limit(self):
+        # The cgroup uses two and a half CPUs, while the machine is busy.
+        self.load = 20.0
+        load.cpu_time = lambda: time.time() * 2.5
+        controller = load.Controller(interval=0.05)
+        # Not known until an interval has passed.
+        self.assertEqual(controller.limit('test', 0), 4)
+        time.sleep(0.1)
+        self.assertEqual(controller.limit('test', 0), 1)
+        # Two of them are spiny's own tests.
+        self.assertEqual(controller.limit('test', 2), 3)
@@ -3,9 +3,11 @@ import shutil
 import tempfile
 import subprocess
 import sys
+import time
 import unittest
 
 import spiny.main
+import spiny.watch
 
 
 class TestMainBase(unittest.TestCase):
@@ -50,3 +52,143 @@ class TestDual(TestMainBase):
         self.assertTrue(os.path.isdir(venv_dir),
                         "The .venv directory was not created")
         self.assertListEqual(['python2', 'python3'], sorted(os.listdir(venv_dir)))
+
+
+class TestTestCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.abspath(os.curdir)
+        for name, code in (('passes.py', 'import time; time.sleep(1)'),
+                           ('fails.py', 'import sys, time; time.sleep(1); sys.exit(1)')):
+            with open(os.path.join(self.test_dir, name), 'wt') as outfile:
+                outfile.write(code)
+        spiny.main.setup_logging(0, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+        os.chdir(self.run_dir)
+
+    def run_commands(self, test_commands, processes):
+        envdict = {'path': sys.executable, 'backend': 'unsupported'}
+        options = {'test-command-processes': processes}
+        args = ('python', envdict, None, None, test_commands, [], [],
+                self.test_dir, None, options, False)
+        return spiny.main.test_environment(args)
+
+    def test_in_sequence(self):
+        result = self.run_commands(['{envpython} fails.py', '{envpython} passes.py'], 1)
+        self.assertEqual(result, 'Tests failed for python!')
+
+    def test_independent(self):
+        start = time.time()
+        result = self.run_commands(['{envpython} fails.py',
+                                    '{envpython} passes.py && {envpython} fails.py',
+                                    '{envpython} passes.py'], 3)
+        # The lines ran at the same time, the && commands one after another.
+        self.assertLess(time.time() - start, 2.9)
+        self.assertEqual(result, 'Tests failed for python! Failed commands: '
+                                 '%s fails.py, %s fails.py' % (sys.executable, sys.executable))
+
+
+class TestDurations(unittest.TestCase):
+
+    def test_merge(self):
+        durations = {'py27': {'setup': 20.0, 'test': 5.0}, 'py36': {'setup': 30.0, 'test': 6.0}}
+        new = {'py27': {'test': 4.0}, 'py36': {'setup': 0.01, 'test': 7.0},
+               'py37': {'setup': 25.0}}
+        merged = spiny.main.merge_durations(durations, new, ['py36'])
+        self.assertEqual(merged, {'py27': {'setup': 20.0, 'test': 4.0},
+                                  'py36': {'setup': 30.0, 'test': 7.0},
+                                  'py37': {'setup': 25.0}})
+        # The cached durations are not changed in place.
+        self.assertEqual(durations['py27'], {'setup': 20.0, 'test': 5.0})
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.abspath(os.curdir)
+        os.chdir(self.test_dir)
+        self.write_config('python2.7')
+        self.saved = {}
+        for module, name in ((spiny.main, 'prepare_tests'), (spiny.main, 'run_prepared'),
+                             (spiny.main, 'print_summary'), (spiny.watch, 'Watcher')):
+            self.saved[module, name] = getattr(module, name)
+
+    def tearDown(self):
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+        os.chdir(self.run_dir)
+        shutil.rmtree(self.test_dir)
+
+    def write_config(self, environments):
+        with open('setup.cfg', 'wt') as outfile:
+            outfile.write('[spiny]\nenvironments = %s\n' % environments)
+
+    def test_config_changed(self):
+        environments = []
+        changes = [[os.path.abspath('setup.cfg')]]
+        test = self
+
+        def prepare_tests(config):
+            environments.append(config.get('spiny', 'environments'))
+            return {'argslist': [], 'records': [], 'venv-dir': '.venv'}
+
+        class Watcher(object):
+
+            def __init__(self, root, ignore):
+                pass
+
+            def wait(self):
+                if not changes:
+                    raise KeyboardInterrupt()
+                test.write_config('python3.6')
+                return changes.pop(0)
+
+            def reset(self):
+                pass
+
+            def close(self):
+                pass
+
+        spiny.main.prepare_tests = prepare_tests
+        spiny.main.run_prepared = lambda plan: {}
+        spiny.main.print_summary = lambda results, records: None
+        spiny.watch.Watcher = Watcher
+        self.assertEqual(spiny.main.watch_tests('spiny.cfg', ['spiny:venv-dir=.venv']), 0)
+        # The changed setup.cfg was read again.
+        self.assertEqual(environments, ['python2.7', 'python3.6'])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_no_slow_imports(self):
+        # --version and --help should not import what only a run needs.
+        script = ('import sys\n'
+                  'sys.argv = ["spiny", "%s"]\n'
+                  'import spiny.main\n'
+                  'try:\n'
+                  '    spiny.main.main()\n'
+                  'except SystemExit:\n'
+                  '    pass\n'
+                  'sys.stderr.write(" ".join(sorted(sys.modules)))\n')
+        for argument in ('--version', '--help'):
+            process = subprocess.Popen([sys.executable, '-c', script % argument],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+            modules = set(stderr.decode('ascii').split())
+            for slow in ('pkg_resources', 'setuptools', 'distutils', 'multiprocessing',
+                         'packaging', 'tomllib', 'ctypes'):
+                self.assertNotIn(slow, modules)
+            # Nor spiny's own modules that only some runs use.
+            for lazy in ('forkserver', 'load', 'remote', 'scheduler', 'shards', 'watch',
+                         'wheelhouse'):
+                self.assertNotIn('spiny.' + lazy, modules)
+        self.assertEqual(stdout.decode('ascii').split('\n')[0], 'usage: spiny [-h] [--version] '
+                         '[-c <filename>] [-e <environments>] [-v] [-q]')
+
+    def test_version(self):
+        output = subprocess.check_output([sys.executable, '-m', 'spiny.main', '--version'])
+        self.assertEqual(output.decode('ascii').strip(), spiny.main.get_version())
@@ -0,0 +1,54 @@
+import logging
+import sys
+import unittest
+
+from spiny import output
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+class TestOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('spiny')
+        self.level = self.logger.level
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def test_large_output(self):
+        # More than fits in a pipe buffer, on both stdout and stderr.
+        script = ('import sys\n'
+                  'for i in range(20000):\n'
+                  '    sys.stdout.write("out %d\\n" % i)\n'
+                  '    sys.stderr.write("err %d\\n" % i)\n')
+        self.logger.setLevel(10)
+        returncode, tail = output.run([sys.executable, '-c', script], 'env', True,
+                                      tail_lines=10)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(len(tail), 10)
+
+        messages = [message for level, message in self.handler.records]
+        self.assertIn('env: out 19999', messages)
+        self.assertIn('env: err 19999', messages)
+        self.assertIn((30, 'env: err 0'), self.handler.records)
+        self.assertIn((20, 'env: out 0'), self.handler.records)
+
+    def test_tail_logged_on_failure(self):
+        script = 'import sys; print("the problem"); sys.exit(1)'
+        self.logger.setLevel(30)
+        returncode, tail = output.run([sys.executable, '-c', script], 'env', True)
+        self.assertEqual(returncode, 1)
+        self.assertEqual(tail, ['the problem'])
+        self.assertEqual(self.handler.records, [(30, 'Last output from env:\nthe problem')])
@@ -0,0 +1,118 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from spiny import projectdata
+from spiny.cache import CacheFile
+
+from .utils import TestEnvironment
+
+SETUP_PY = """
+import sys
+from setuptools import setup
+
+print('Some output from setup.py')
+if sys.version_info[0] == 2:
+    requires = ['mock']
+else:
+    requires = []
+
+setup(name='dinsdale', install_requires=requires, cmdclass={'test': object})
+"""
+
+
+class TestProjectData(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.test_dir, 'setup.py'), 'wt') as setuppy:
+            setuppy.write(SETUP_PY)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_get_data_isolated(self):
+        data = projectdata.get_data_isolated(self.test_dir, '2.7.18')
+        self.assertEqual(data['name'], 'dinsdale')
+        self.assertEqual(data['install_requires'], ['mock'])
+
+        data = projectdata.get_data_isolated(self.test_dir, '3.6.1')
+        self.assertEqual(data['install_requires'], [])
+        self.assertNotIn('setup', sys.modules)
+
+    def test_isolated_from_spiny(self):
+        # The modules of spiny can't be imported by setup.py.
+        with open(os.path.join(self.test_dir, 'setup.py'), 'wt') as setuppy:
+            setuppy.write('from setuptools import setup\n'
+                          'try:\n'
+                          '    import environment\n'
+                          '    name = "leaked"\n'
+                          'except ImportError:\n'
+                          '    name = "dinsdale"\n'
+                          'setup(name=name)\n')
+        data = projectdata.get_data_isolated(self.test_dir, python=sys.executable)
+        self.assertEqual(data['name'], 'dinsdale')
+
+    def test_data_key(self):
+        envdict = {'path': sys.executable}
+        key = projectdata.data_key(self.test_dir, envdict)
+        for name in ('pyproject.toml', 'requirements-dev.txt'):
+            with open(os.path.join(self.test_dir, name), 'wt') as outfile:
+                outfile.write('changed')
+            new_key = projectdata.data_key(self.test_dir, envdict)
+            self.assertNotEqual(new_key, key)
+            key = new_key
+        with open(os.path.join(self.test_dir, 'README.rst'), 'wt') as outfile:
+            outfile.write('not part of the key')
+        self.assertEqual(projectdata.data_key(self.test_dir, envdict), key)
+
+    def test_broken_python(self):
+        missing = os.path.join(self.test_dir, 'missing-python')
+        self.assertIsNone(projectdata.get_data_isolated(self.test_dir, python=missing))
+
+        # A Python that fails, and a setup.py that fails under every Python.
+        broken = os.path.join(self.test_dir, 'broken-python')
+        with open(broken, 'wt') as script:
+            script.write('#!/bin/sh\nexit 1\n')
+        os.chmod(broken, 0o755)
+        with open(os.path.join(self.test_dir, 'setup.py'), 'wt') as setuppy:
+            setuppy.write('raise RuntimeError("Broken")\n')
+        pythons = {'broken': {'path': broken, 'python': 'Python', 'implementation': 'CPython',
+                              'version': '3.6.1', 'version_info': [3, 6, 1, 'final', 0]}}
+        self.assertEqual(projectdata.get_all_data(self.test_dir, pythons), {'broken': {}})
+
+    def test_no_setup_py(self):
+        os.remove(os.path.join(self.test_dir, 'setup.py'))
+        self.assertEqual(projectdata.get_data_isolated(self.test_dir), {})
+
+    def test_get_all_data(self):
+        with TestEnvironment(['python2.7', 'python3']) as env:
+            pythons = {'python2.7': env.pythons['python2.7'], 'python3': env.pythons['python3']}
+            cachefile = CacheFile(os.path.join(self.test_dir, 'test.cache'))
+            data = projectdata.get_all_data(self.test_dir, pythons, cachefile, 2)
+            # setup.py was run under each Python.
+            self.assertEqual(data['python2.7']['install_requires'], ['mock'])
+            self.assertEqual(data['python3']['install_requires'], [])
+
+            # The second time, the data comes from the cache.
+            cachefile.set('projectdata', projectdata.data_key(self.test_dir, pythons['python3']),
+                          {'name': 'cached'})
+            data = projectdata.get_all_data(self.test_dir, pythons, cachefile, 2)
+            self.assertEqual(data['python3'], {'name': 'cached'})
+
+            # Until setup.py changes.
+            with open(os.path.join(self.test_dir, 'setup.py'), 'at') as setuppy:
+                setuppy.write('\n# Changed\n')
+            data = projectdata.get_all_data(self.test_dir, pythons, cachefile, 2)
+            self.assertEqual(data['python3']['name'], 'dinsdale')
+
+            # Data that hasn't been used for long is removed.
+            cachefile.save()
+            cachefile._times['projectdata']['stale'] = 0
+            cachefile._sections['projectdata']['stale'] = {'name': 'stale'}
+            projectdata.get_all_data(self.test_dir, pythons, cachefile, 2)
+            self.assertNotIn('stale', cachefile.keys('projectdata'))
+            self.assertIn(projectdata.data_key(self.test_dir, pythons['python3']),
+                          cachefile.keys('projectdata'))
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import spiny.main
+from spiny import remote
+from . import utils
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, path, text):
+        path = os.path.join(self.test_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wt') as outfile:
+            outfile.write(text)
+
+    def test_snapshot(self):
+        self.write('project/setup.py', 'setup()')
+        self.write('project/dinsdale/__init__.py', 'x = 1')
+        self.write('project/.git/config', 'not sent')
+        self.write('project/venvs/python3/bin/python', 'not sent')
+        project = os.path.join(self.test_dir, 'project')
+        ignore = [os.path.join(project, 'venvs')]
+
+        snapshot, digest = remote.make_snapshot(project, ignore)
+        self.assertEqual(remote.make_snapshot(project, ignore), (snapshot, digest))
+
+        target = os.path.join(self.test_dir, 'target')
+        remote.extract_snapshot(snapshot, digest, target)
+        self.assertEqual(sorted(os.listdir(target)),
+                         [remote.SNAPSHOT_MARKER, 'dinsdale', 'setup.py'])
+        with open(os.path.join(target, 'dinsdale', '__init__.py'), 'rt') as infile:
+            self.assertEqual(infile.read(), 'x = 1')
+
+        # The same snapshot is not extracted again, a changed one replaces it all.
+        self.write('target/build.log', 'kept')
+        remote.extract_snapshot(snapshot, digest, target)
+        self.assertTrue(os.path.exists(os.path.join(target, 'build.log')))
+        self.write('project/dinsdale/__init__.py', 'x = 2')
+        snapshot, new_digest = remote.make_snapshot(project, ignore)
+        self.assertNotEqual(new_digest, digest)
+        remote.extract_snapshot(snapshot, new_digest, target)
+        self.assertFalse(os.path.exists(os.path.join(target, 'build.log')))
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'Needs symbolic links')
+    def test_links_and_hidden_files(self):
+        self.write('project/setup.py', 'setup()')
+        self.write('project/docs/README.rst', 'Dinsdale')
+        self.write('project/.coveragerc', '[run]')
+        self.write('project/.tox/python3/bin/python', 'not sent')
+        self.write('outside.txt', 'not sent')
+        project = os.path.join(self.test_dir, 'project')
+        os.symlink(os.path.join('docs', 'README.rst'), os.path.join(project, 'README.rst'))
+        os.symlink('docs', os.path.join(project, 'documentation'))
+        os.symlink(os.path.join(self.test_dir, 'outside.txt'),
+                   os.path.join(project, 'outside.txt'))
+        os.symlink('missing', os.path.join(project, 'broken'))
+
+        snapshot, digest = remote.make_snapshot(project)
+        target = os.path.join(self.test_dir, 'target')
+        remote.extract_snapshot(snapshot, digest, target)
+        self.assertEqual(sorted(os.listdir(target)),
+                         ['.coveragerc', remote.SNAPSHOT_MARKER, 'README.rst', 'docs',
+                          'documentation', 'setup.py'])
+        for path in ('README.rst', os.path.join('documentation', 'README.rst')):
+            self.assertFalse(os.path.islink(os.path.join(target, path)))
+            with open(os.path.join(target, path), 'rt') as infile:
+                self.assertEqual(infile.read(), 'Dinsdale')
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'The workers fork')
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = os.path.abspath(os.curdir)
+        self.workers = []
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('spiny')
+        self.level = self.logger.level
+        self.logger.addHandler(self.handler)
+        # The output of the tests is logged on level 30.
+        self.logger.setLevel(30)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+        for process in self.workers:
+            process.terminate()
+            process.wait()
+            process.stderr.close()
+        os.chdir(self.run_dir)
+
+    def start_worker(self, directory):
+        process = subprocess.Popen([sys.executable, '-m', 'spiny.main', 'worker',
+                                    '--listen', '127.0.0.1:0', '--slots', '1',
+                                    '--key', 'secret', '--dir', directory],
+                                   stderr=subprocess.PIPE)
+        self.workers.append(process)
+        # Listening on host:port
+        return process.stderr.readline().decode('ascii').split()[-1]
+
+    def test_two_workers(self):
+        with utils.TestEnvironment(['python2', 'python3']) as env:
+            workers = [self.start_worker(os.path.join(env.test_dir, name))
+                       for name in ('worker1', 'worker2')]
+            project = os.path.join(env.test_dir, 'dinsdale')
+            shutil.copytree(os.path.join(self.run_dir, 'tests', 'package'), project)
+            os.chdir(project)
+
+            conf = utils.make_conf()
+            conf.set('spiny', 'environments', 'python2 python3')
+            conf.set('spiny', 'workers', ' '.join(workers))
+            conf.set('spiny', 'worker-key', 'secret')
+            conf.set('spiny', 'use-setup-py', 'false')
+            # No virtualenvs, to be quick.
+            conf.set('spiny', 'setup-commands',
+                     "{basepython} -c __import__('os').makedirs('{envdir}')")
+            conf.set('spiny', 'test-commands', '{basepython} -c print(12345)')
+            results = spiny.main.run_all_tests(conf)
+            self.assertEqual(results, {'python2': None, 'python3': None})
+            self.assertIn('python2: 12345', self.handler.messages)
+            self.assertIn('python3: 12345', self.handler.messages)
+
+            # Each worker ran one environment, in its own directory.
+            envs = []
+            for name in ('worker1', 'worker2'):
+                projects = os.listdir(os.path.join(env.test_dir, name))
+                self.assertEqual(len(projects), 1)
+                envs.extend(os.listdir(os.path.join(env.test_dir, name, projects[0])))
+            self.assertEqual(sorted(envs), ['.snapshots', '.snapshots', '.venv', '.venv',
+                                            'src-python2', 'src-python3'])
+
+            # The workers keep the snapshot, so it isn't sent again.
+            project_key = remote.project_key(os.getcwd())
+            snapshots = os.listdir(os.path.join(env.test_dir, 'worker1', project_key,
+                                                remote.SNAPSHOT_DIR))
+            self.assertEqual(len(snapshots), 1)
+            coordinator = remote.Coordinator(workers, 'secret')
+            reply = coordinator._ask(workers[0], {'type': 'hello', 'project': project_key,
+                                                  'snapshot-digest': snapshots[0]})
+            self.assertTrue(reply['has-snapshot'])
+
+            conf.set('spiny', 'worker-key', 'wrong')
+            results = spiny.main.run_all_tests(conf)
+            self.assertEqual(results, {'python2': 'Error: No worker could run python2',
+                                       'python3': 'Error: No worker could run python3'})
+
+    def test_key_required(self):
+        self.assertRaises(ValueError, remote.Worker, '127.0.0.1:0')
+        env = dict(os.environ)
+        env.pop('SPINY_WORKER_KEY', None)
+        process = subprocess.Popen([sys.executable, '-m', 'spiny.main', 'worker',
+                                    '--listen', '127.0.0.1:0'],
+                                   env=env, stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+        self.assertEqual(process.returncode, 2)
+        self.assertIn(b'A key is required', stderr)
+
+    def test_idle_clients(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        worker = self.start_worker(directory)
+        # A client that connects and sends nothing doesn't hold up the others.
+        idle = socket.create_connection(remote.parse_address(worker))
+        self.addCleanup(idle.close)
+        start = time.time()
+        self.assertEqual(remote.Coordinator([worker], 'secret', timeout=5).register(),
+                         {worker: 1})
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(remote.Coordinator([worker], 'wrong', timeout=5).register(), {})
+
+    def test_busy(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        worker = remote.Worker('127.0.0.1:0', directory, 1, 'secret')
+        self.addCleanup(worker.server.close)
+        # A job that uses the only slot.
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(60)
+            os._exit(0)
+        worker.children.add(pid)
+        ours, theirs = socket.socketpair()
+        try:
+            message = json.dumps({'type': 'job', 'job': {'envname': 'python3'},
+                                  'version': remote.PROTOCOL_VERSION})
+            line = json.dumps({'message': message,
+                               'signature': remote.sign('secret', 'nonce', message)})
+            worker.handle(theirs, ('127.0.0.1', 0), 'nonce', line.encode('utf8'))
+            self.assertEqual(json.loads(remote.read_line(ours).decode('utf8')),
+                             {'type': 'busy'})
+        finally:
+            ours.close()
+            theirs.close()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from spiny import output, scheduler
+
+setup_time_file = os.path.join(tempfile.gettempdir(), 'spiny-fail-fast-%s' % os.getpid())
+
+
+def setup_stage(args):
+    name, setup_time = args
+    if name == 'command':
+        # The command creates a file if it isn't stopped.
+        script = 'import time; time.sleep(%s); open(%r, "w")' % (setup_time, setup_time_file)
+        output.run([sys.executable, '-c', script], name, False)
+        return None
+    time.sleep(setup_time)
+    if name == 'broken':
+        return 'Setup failed for %s' % name
+    return None
+
+
+def run_stage(args):
+    # Return when the test started, to check the order things happened in.
+    return time.time()
+
+
+class OneAtATime(object):
+    """A controller that allows only one setup at a time"""
+
+    interval = 0.1
+
+    def __init__(self):
+        self.calls = []
+
+    def limit(self, stage, running):
+        self.calls.append((stage, running))
+        if stage == 'setup':
+            return 1
+        return None
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_results(self):
+        pipeline = scheduler.Pipeline(setup_stage, run_stage, 2, 2)
+        results = pipeline.run([('works', ('works', 0)), ('broken', ('broken', 0))])
+        self.assertEqual(results['broken'], 'Setup failed for broken')
+        self.assertTrue(isinstance(results['works'], float))
+
+        self.assertEqual(pipeline.run([]), {})
+
+    def test_tests_start_when_setup_is_done(self):
+        pipeline = scheduler.Pipeline(setup_stage, run_stage, 2, 1)
+        start = time.time()
+        results = pipeline.run([('fast', ('fast', 0)), ('slow', ('slow', 1))])
+        # The fast environment was tested while the slow was still set up.
+        self.assertLess(results['fast'] - start, 0.8)
+        self.assertGreater(results['slow'] - start, 0.9)
+
+    def test_longest_first(self):
+        estimates = {'slow': {'setup': 1.0, 'test': 10.0},
+                     'fast': {'setup': 1.0, 'test': 1.0}}
+        pipeline = scheduler.Pipeline(setup_stage, run_stage, 1, 1, estimates)
+        self.assertEqual(pipeline.estimate('new', 'test'), 5.5)
+        results = pipeline.run([('fast', ('fast', 0)), ('slow', ('slow', 0))])
+        # The slow environment is started first, even if listed last.
+        self.assertLess(results['slow'], results['fast'])
+        self.assertEqual(sorted(pipeline.durations), ['fast', 'slow'])
+        self.assertEqual(sorted(pipeline.durations['slow']), ['setup', 'test'])
+
+    def test_one_at_a_time(self):
+        pipeline = scheduler.Pipeline(setup_stage, run_stage, 1, 1)
+        results = pipeline.run([('slow', ('slow', 0.5)), ('fast', ('fast', 0))])
+        # Everything runs in order, so the slow environment is tested first.
+        self.assertLess(results['slow'], results['fast'])
+
+    def test_fail_fast(self):
+        pipeline = scheduler.Pipeline(setup_stage, run_stage, 2, 1, fail_fast=True)
+        start = time.time()
+        results = pipeline.run([('command', ('command', 2)), ('broken', ('broken', 0.5)),
+                                ('queued', ('queued', 0))])
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(results, {'broken': 'Setup failed for broken',
+                                   'command': scheduler.CANCELLED,
+                                   'queued': scheduler.CANCELLED})
+        # The command started by the cancelled job was stopped too.
+        time.sleep(2)
+        self.assertFalse(os.path.exists(setup_time_file))
+
+    def test_controller(self):
+        controller = OneAtATime()
+        pipeline = scheduler.Pipeline(setup_stage, run_stage, 2, 2, controller=controller)
+        start = time.time()
+        results = pipeline.run([('first', ('first', 0.5)), ('second', ('second', 0.5))])
+        # The second setup waited for the first one.
+        self.assertLess(results['first'] - start, 0.9)
+        self.assertGreater(results['second'] - start, 0.9)
+        self.assertIn(('setup', 0), controller.calls)
+        self.assertIn(('test', 0), controller.calls)
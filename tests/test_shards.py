@@ -0,0 +1,114 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from spiny import shards
+
+TEST_MODULE = '''
+import time
+import unittest
+
+class TestSlow(unittest.TestCase):
+
+    def test_%(name)s_one(self):
+        time.sleep(0.1)
+
+    def test_%(name)s_two(self):
+        pass
+'''
+
+
+# Runs unittest ids like pytest --junitxml does, with the time of each test.
+RUNNER = '''
+import sys
+import time
+import unittest
+report = sys.argv[1].split('=', 1)[1]
+cases = []
+failed = False
+for test_id in sys.argv[2:]:
+    start = time.time()
+    result = unittest.TextTestRunner().run(unittest.defaultTestLoader.loadTestsFromName(test_id))
+    failed = failed or not result.wasSuccessful()
+    classname, name = test_id.rsplit('.', 1)
+    cases.append('<testcase classname="%s" name="%s" time="%s"/>' %
+                 (classname, name, time.time() - start))
+with open(report, 'w') as outfile:
+    outfile.write('<testsuites><testsuite>%s</testsuite></testsuites>' % ''.join(cases))
+sys.exit(failed)
+'''
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_even(self):
+        self.assertEqual(shards.split(['a', 'b', 'c', 'd'], 2, {}),
+                         [['a', 'c'], ['b', 'd']])
+        # Never more shards than tests.
+        self.assertEqual(shards.split(['a'], 4, {}), [['a']])
+
+    def test_balanced_by_durations(self):
+        durations = {'a': 10.0, 'b': 1.0, 'c': 1.0, 'd': 8.0}
+        self.assertEqual(shards.split(['a', 'b', 'c', 'd', 'e'], 2, durations),
+                         [['a', 'b', 'c'], ['d', 'e']])
+
+
+class TestSharder(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.abspath(os.curdir)
+        for name in ('first', 'second', 'third'):
+            with open(os.path.join(self.test_dir, 'test_%s.py' % name), 'wt') as outfile:
+                outfile.write(TEST_MODULE % {'name': name})
+        os.chdir(self.test_dir)
+
+    def tearDown(self):
+        os.chdir(self.run_dir)
+        shutil.rmtree(self.test_dir)
+
+    def test_list_tests(self):
+        sharder = shards.Sharder(sys.executable, self.test_dir, 2)
+        tests = sharder.list_tests()
+        self.assertEqual(len(tests), 6)
+        self.assertIn('test_first.TestSlow.test_first_one', tests)
+
+        sharder = shards.Sharder(sys.executable, self.test_dir, 2, 'false')
+        self.assertEqual(sharder.list_tests(), [])
+
+    def test_run(self):
+        sharder = shards.Sharder(sys.executable, self.test_dir, 3)
+        command = '%s -m unittest {tests}' % sys.executable
+        self.assertTrue(sharder.run(command, 'python'))
+
+        # Without a JUnit report, the time of each test isn't known.
+        durations = shards.read_durations(os.path.join(self.test_dir, shards.DURATIONS_FILE))
+        self.assertEqual(durations, {})
+
+        with open(os.path.join(self.test_dir, 'test_first.py'), 'at') as outfile:
+            outfile.write('\n    def test_fails(self):\n        self.fail()\n')
+        sharder = shards.Sharder(sys.executable, self.test_dir, 3)
+        self.assertFalse(sharder.run(command, 'python'))
+
+    def test_junit_durations(self):
+        with open(os.path.join(self.test_dir, 'runner.py'), 'wt') as outfile:
+            outfile.write(RUNNER)
+        sharder = shards.Sharder(sys.executable, self.test_dir, 2)
+        junitxml = os.path.join(self.test_dir, shards.JUNIT_FILE)
+        command = '%s runner.py --junitxml=%s {tests}' % (sys.executable, junitxml)
+        self.assertTrue(sharder.run(command, 'python'))
+
+        durations = shards.read_durations(os.path.join(self.test_dir, shards.DURATIONS_FILE))
+        self.assertEqual(sorted(durations), sorted(sharder.list_tests()))
+        # Each test has its own time.
+        self.assertGreater(durations['test_first.TestSlow.test_first_one'], 0.09)
+        self.assertLess(durations['test_first.TestSlow.test_first_two'], 0.09)
+        # The reports of the shards are removed.
+        self.assertEqual([name for name in os.listdir(self.test_dir) if 'junit' in name], [])
+
+    def test_normal_id(self):
+        self.assertEqual(shards.normal_id('tests/test_a.py::TestA::test_b[1]'),
+                         'tests.test_a.TestA.test_b[1]')
+        self.assertEqual(shards.normal_id('tests.test_a.TestA.test_b'), 'tests.test_a.TestA.test_b')
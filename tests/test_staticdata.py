@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from spiny import environment, staticdata
+
+from .utils import make_conf
+
+SETUP_PY = """
+from setuptools import setup, find_packages
+
+setup(
+    name='dinsdale',
+    packages=find_packages(),
+    classifiers=['Programming Language :: Python :: 3.6'],
+    install_requires=['six', 'mock; python_version < "3"'],
+    extras_require={'tests': ['nose'], 'tests:python_version >= "3"': ['pytest']},
+)
+"""
+
+SETUP_CFG = """
+[metadata]
+name = piranha
+classifiers =
+    Programming Language :: Python :: 2.7
+    Programming Language :: Python :: 3.5
+
+[options]
+install_requires =
+    zope.interface>=4,<6
+    enum34; python_version < "3.4"
+
+[options.extras_require]
+tests = coverage
+"""
+
+PYPROJECT = """
+[project]
+name = "piranha"
+dependencies = ["requests"]
+classifiers = ["Programming Language :: Python :: 3.11"]
+
+[project.optional-dependencies]
+tests = ["pytest"]
+"""
+
+PYTHON2 = {'python': 'Python', 'version': '2.7.18', 'implementation': 'CPython',
+           'version_info': [2, 7, 18, 'final', 0]}
+PYTHON3 = {'python': 'Python', 'version': '3.11.7', 'implementation': 'CPython',
+           'version_info': [3, 11, 7, 'final', 0]}
+
+
+class TestStaticData(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, text):
+        with open(os.path.join(self.test_dir, name), 'wt') as outfile:
+            outfile.write(text)
+
+    def test_setup_py(self):
+        self.write('setup.py', SETUP_PY)
+        data = staticdata.get_static_data(self.test_dir)
+        self.assertEqual(data['name'], 'dinsdale')
+        self.assertEqual(data['install_requires'], ['six', 'mock; python_version < "3"'])
+        self.assertNotIn('packages', data)
+
+    def test_setup_py_not_literal(self):
+        self.write('setup.py', SETUP_PY.replace("['six',", "requires + ['six',"))
+        self.assertIsNone(staticdata.get_static_data(self.test_dir))
+        self.write('setup.py', 'from setuptools import setup\nsetup(**kw)\n')
+        self.assertIsNone(staticdata.get_static_data(self.test_dir))
+
+    def test_setup_cfg(self):
+        self.write('setup.cfg', SETUP_CFG)
+        data = staticdata.get_static_data(self.test_dir)
+        self.assertEqual(data['name'], 'piranha')
+        self.assertEqual(data['classifiers'], ['Programming Language :: Python :: 2.7',
+                                               'Programming Language :: Python :: 3.5'])
+        self.assertEqual(data['install_requires'], ['zope.interface>=4,<6',
+                                                    'enum34; python_version < "3.4"'])
+        self.assertEqual(data['extras_require'], {'tests': ['coverage']})
+
+        # setup.py overrides setup.cfg
+        self.write('setup.py', SETUP_PY)
+        self.assertEqual(staticdata.get_static_data(self.test_dir)['name'], 'dinsdale')
+
+        self.write('setup.cfg', SETUP_CFG.replace('tests = coverage', 'tests = file: req.txt'))
+        self.assertIsNone(staticdata.get_static_data(self.test_dir))
+
+    @unittest.skipIf(staticdata.load_tomllib() is None, 'No TOML parser')
+    def test_pyproject(self):
+        self.write('pyproject.toml', PYPROJECT)
+        data = staticdata.get_static_data(self.test_dir)
+        self.assertEqual(data['install_requires'], ['requests'])
+        self.assertEqual(data['extras_require'], {'tests': ['pytest']})
+
+    def test_environments_from_classifiers(self):
+        self.write('setup.cfg', SETUP_CFG)
+        run_dir = os.path.abspath(os.curdir)
+        os.chdir(self.test_dir)
+        try:
+            self.assertEqual(environment.get_environments(make_conf()),
+                             ['python2.7', 'python3.5'])
+        finally:
+            os.chdir(run_dir)
+
+    def test_nothing(self):
+        self.assertIsNone(staticdata.get_static_data(self.test_dir))
+
+    @unittest.skipIf(staticdata.load_markers() is None, 'No packaging library')
+    def test_evaluate_markers(self):
+        self.write('setup.py', SETUP_PY)
+        data = staticdata.get_static_data(self.test_dir)
+
+        python2 = staticdata.evaluate_markers(data, PYTHON2)
+        self.assertEqual(python2['install_requires'], ['six', 'mock'])
+        self.assertEqual(python2['extras_require'], {'tests': ['nose']})
+
+        python3 = staticdata.evaluate_markers(data, PYTHON3)
+        self.assertEqual(python3['install_requires'], ['six'])
+        self.assertEqual(python3['extras_require'], {'tests': ['nose', 'pytest']})
@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from spiny import environment, output, timing
+
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        timing.collect()
+
+    def tearDown(self):
+        timing.collect()
+
+    def test_phase_records_commands(self):
+        # Allocate about 50 MB, so the peak RSS is clearly from the command.
+        script = 'import sys; data = b"x" * 50000000; sys.exit(3)'
+        with timing.phase('install', 'py3'):
+            returncode, tail = output.run([sys.executable, '-c', script], 'py3', True)
+        self.assertEqual(returncode, 3)
+
+        command, phase = timing.collect()
+        self.assertEqual(command['env'], 'py3')
+        self.assertEqual(command['phase'], 'install')
+        self.assertTrue(command['command'].endswith(script))
+        self.assertEqual((phase['env'], phase['phase'], phase['command']),
+                         ('py3', 'install', None))
+        self.assertTrue(phase['wall'] >= command['wall'] > 0)
+        if hasattr(os, 'wait4'):
+            self.assertTrue(command['cpu'] > 0)
+            self.assertTrue(command['maxrss'] > 40000)
+            self.assertTrue(phase['maxrss'] >= command['maxrss'])
+
+    def test_threads(self):
+        # Each thread has its own phases.
+        def install(env):
+            with timing.phase('install', env):
+                time.sleep(0.1)
+                timing.command('pip install ' + env, 0.1)
+
+        threads = [threading.Thread(target=install, args=(env,)) for env in ('py27', 'py36')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        commands = [(r['env'], r['phase'], r['command']) for r in timing.collect()
+                    if r['command'] is not None]
+        self.assertEqual(sorted(commands), [('py27', 'install', 'pip install py27'),
+                                            ('py36', 'install', 'pip install py36')])
+
+        # Threads started for the phase inherit it.
+        with timing.phase('test', 'py36'):
+            environment.map_concurrently(lambda i: timing.command('test %s' % i, 0.1),
+                                         range(3), 3)
+        timing.command('outside', 0.1)
+        commands = [(r['env'], r['phase'], r['command']) for r in timing.collect()
+                    if r['command'] is not None]
+        self.assertEqual(commands[-1], (None, None, 'outside'))
+        self.assertEqual(sorted(commands[:-1]), [('py36', 'test', 'test 0'),
+                                                 ('py36', 'test', 'test 1'),
+                                                 ('py36', 'test', 'test 2')])
+
+    def test_summary(self):
+        records = [
+            {'env': None, 'phase': 'discovery', 'command': None, 'wall': 0.5,
+             'cpu': 0.25, 'maxrss': None},
+            {'env': 'py27', 'phase': 'venv', 'command': None, 'wall': 2.0,
+             'cpu': 1.0, 'maxrss': 20480},
+            {'env': 'py27', 'phase': 'test', 'command': None, 'wall': 1.0,
+             'cpu': 0.5, 'maxrss': 40960},
+            {'env': 'py27', 'phase': 'test', 'command': 'python -m unittest', 'wall': 1.0,
+             'cpu': 0.5, 'maxrss': 40960},
+            {'env': 'py27', 'phase': 'test', 'command': None, 'wall': 3.0,
+             'cpu': None, 'maxrss': None},
+        ]
+        summary = timing.summarize(records)
+        self.assertEqual(summary['phases'],
+                         {'discovery': {'wall': 0.5, 'cpu': 0.25, 'maxrss': None}})
+        self.assertEqual(summary['environments'],
+                         {'py27': {'venv': {'wall': 2.0, 'cpu': 1.0, 'maxrss': 20480},
+                                   'test': {'wall': 4.0, 'cpu': 0.5, 'maxrss': 40960}}})
+
+        self.assertEqual(timing.format_table(records).splitlines(), [
+            'Environment  Venv  Install  Tests   CPU  Peak RSS',
+            'py27         2.0s        -   4.0s  1.5s     40 MB',
+            'Before the environments: discovery 0.5s',
+        ])
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'report.json')
+            timing.write_report(path, records)
+            with open(path, 'rt') as infile:
+                report = json.load(infile)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(report['version'], timing.REPORT_VERSION)
+        self.assertEqual(report['records'], records)
+        self.assertEqual(report['environments'], summary['environments'])
@@ -0,0 +1,154 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from spiny import environment
+from spiny import venvs
+
+
+class TestBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.pip_version = venvs._pip_version
+        venvs._pip_version = (23, 2, 1)
+
+    def tearDown(self):
+        venvs._pip_version = self.pip_version
+
+    def test_setup_command(self):
+        envdict = {'path': '/usr/bin/python3', 'backend': 'venv'}
+        self.assertEqual(venvs.setup_command(envdict),
+                         ['/usr/bin/python3', '-m', 'venv'])
+        self.assertEqual(venvs.setup_command(envdict, shared_pip=True),
+                         ['/usr/bin/python3', '-m', 'venv', '--without-pip'])
+        self.assertEqual(venvs.pip_command(envdict, '/env', '/env/bin/python', True),
+                         [sys.executable, '-m', 'pip', '--python', '/env/bin/python'])
+
+        envdict['backend'] = 'external'
+        self.assertEqual(venvs.setup_command(envdict),
+                         [sys.executable, '-m', 'virtualenv', '-v', '-p', '/usr/bin/python3'])
+        self.assertEqual(venvs.pip_command(envdict, '/env', '/env/bin/python', True),
+                         ['/env/bin/pip'])
+
+        envdict['backend'] = 'unsupported'
+        self.assertIsNone(venvs.setup_command(envdict))
+
+    def test_old_shared_pip(self):
+        # pip before 22.3 has no --python, so each virtualenv gets its own pip.
+        venvs._pip_version = (21, 0)
+        envdict = {'path': '/usr/bin/python3', 'backend': 'venv'}
+        self.assertEqual(venvs.setup_command(envdict, shared_pip=True),
+                         ['/usr/bin/python3', '-m', 'venv'])
+        self.assertEqual(venvs.pip_command(envdict, '/env', '/env/bin/python', True),
+                         ['/env/bin/pip'])
+
+
+class TestProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.envdict = {'path': sys.executable, 'backend': 'venv'}
+
+    def test_diff_requirements(self):
+        to_install, to_uninstall = venvs.diff_requirements(
+            ['six', 'zope.interface>=4', 'mock'],
+            ['six', 'zope.interface>=5', 'nose'])
+        self.assertEqual(to_install, ['zope.interface>=5', 'nose'])
+        self.assertEqual(to_uninstall, ['mock'])
+
+        # Names that only differ in case and punctuation are the same project.
+        to_install, to_uninstall = venvs.diff_requirements(
+            ['Foo_Bar', 'zope.interface'], ['foo-bar>=1', 'Zope-Interface'])
+        self.assertEqual(to_install, ['foo-bar>=1', 'Zope-Interface'])
+        self.assertEqual(to_uninstall, [])
+
+    def test_required_by_others(self):
+        # pytest, which is running this, requires pluggy.
+        self.assertEqual(venvs.required_by_others(sys.executable, ['pluggy', 'dinsdale']),
+                         set(['pluggy']))
+        # But not when pytest is removed too.
+        self.assertEqual(venvs.required_by_others(sys.executable, ['pluggy', 'pytest']),
+                         set())
+
+    def test_needs_rebuild(self):
+        profile = venvs.make_profile('python3', self.envdict, None, ['six'])
+        self.assertTrue(venvs.needs_rebuild(None, profile))
+        self.assertFalse(venvs.needs_rebuild(profile, profile))
+
+        # Changing requirements only means updating them
+        changed = venvs.make_profile('python3', self.envdict, None, ['six', 'mock'])
+        self.assertFalse(venvs.needs_rebuild(profile, changed))
+
+        # But a different Python or setup means a new virtualenv
+        changed = venvs.make_profile('python3', dict(self.envdict, backend='virtualenv'),
+                                     None, ['six'])
+        self.assertTrue(venvs.needs_rebuild(profile, changed))
+        changed = venvs.make_profile('python3', self.envdict, ['{basepython} -m venv'],
+                                     ['six'])
+        self.assertTrue(venvs.needs_rebuild(profile, changed))
+
+    def test_read_profile(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, '.spiny-profile')
+            self.assertIsNone(venvs.read_profile(path))
+
+            # Profiles from older versions of spiny are ignored
+            with open(path, 'wt') as outfile:
+                outfile.write('python3\n/usr/bin/python3\nsix')
+            self.assertIsNone(venvs.read_profile(path))
+
+            profile = venvs.make_profile('python3', self.envdict, None, ['six'])
+            venvs.write_profile(path, profile)
+            self.assertEqual(venvs.read_profile(path), profile)
+        finally:
+            shutil.rmtree(test_dir)
+
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.template_dir = os.path.join(self.test_dir, 'templates')
+        payload = environment.probe_python(sys.executable)
+        self.envdict = environment.make_info(sys.executable, payload)
+        self.envdict['backend'] = 'venv'
+        self.command = [sys.executable, '-m', 'venv', '--without-pip']
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _check_env(self, envdir):
+        python = os.path.join(envdir, 'bin', 'python')
+        prefix = subprocess.check_output([python, '-c', 'import sys; print(sys.prefix)'])
+        self.assertEqual(prefix.decode().strip(), envdir)
+        with open(os.path.join(envdir, 'bin', 'activate'), 'rt') as activate:
+            self.assertIn(envdir, activate.read())
+
+    def test_template_is_reused(self):
+        template = venvs.get_template(self.template_dir, self.envdict, self.command, True)
+        self.assertTrue(os.path.isfile(os.path.join(template, venvs.TEMPLATE_MARKER)))
+
+        # Building it again just returns the existing template
+        os.remove(os.path.join(template, 'bin', 'activate'))
+        self.assertEqual(venvs.get_template(self.template_dir, self.envdict,
+                                            self.command, True), template)
+        self.assertFalse(os.path.exists(os.path.join(template, 'bin', 'activate')))
+
+    def test_clone(self):
+        template = venvs.get_template(self.template_dir, self.envdict, self.command, True)
+        for mode in ('copy', 'hardlink'):
+            envdir = os.path.join(self.test_dir, mode)
+            venvs.clone(template, envdir, mode)
+            self._check_env(envdir)
+            self.assertFalse(os.path.exists(os.path.join(envdir, venvs.TEMPLATE_MARKER)))
+
+        # The template is left untouched
+        with open(os.path.join(template, 'bin', 'activate'), 'rt') as activate:
+            self.assertNotIn(envdir, activate.read())
+
+    def test_failed_template(self):
+        command = [sys.executable, '-c', 'import sys; sys.exit(1)']
+        self.assertIsNone(venvs.get_template(self.template_dir, self.envdict, command, True))
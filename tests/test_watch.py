@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from spiny import watch
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.test_dir, 'dinsdale'))
+        os.mkdir(os.path.join(self.test_dir, '.venv'))
+        self.write('dinsdale/__init__.py', '')
+        self.write('setup.py', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, text):
+        with open(os.path.join(self.test_dir, name), 'wt') as outfile:
+            outfile.write(text)
+
+    def test_snapshot(self):
+        venv_dir = os.path.join(self.test_dir, '.venv')
+        os.mkdir(os.path.join(self.test_dir, 'venv'))
+        self.write('.venv/ignored.py', '')
+        self.write('venv/ignored.py', '')
+        ignore = [os.path.join(self.test_dir, 'venv')]
+        files, directories = watch.snapshot(self.test_dir, ignore)
+        self.assertEqual(sorted(os.path.relpath(f, self.test_dir) for f in files),
+                         ['dinsdale/__init__.py', 'setup.py'])
+        self.assertNotIn(venv_dir, directories)
+
+        self.write('dinsdale/__init__.py', 'changed')
+        new_files, directories = watch.snapshot(self.test_dir, ignore)
+        changed = watch.changed_files(files, new_files)
+        self.assertEqual(changed, [os.path.join(self.test_dir, 'dinsdale', '__init__.py')])
+        self.assertFalse(watch.needs_setup(changed))
+        self.assertTrue(watch.needs_setup([os.path.join(self.test_dir, 'setup.cfg')]))
+
+    def check_wait(self, watcher):
+        def change():
+            time.sleep(0.3)
+            self.write('dinsdale/__init__.py', 'changed')
+        thread = threading.Thread(target=change)
+        thread.start()
+        try:
+            start = time.time()
+            changed = watcher.wait()
+            self.assertEqual(changed, [os.path.join(self.test_dir, 'dinsdale', '__init__.py')])
+            self.assertLess(time.time() - start, 2)
+        finally:
+            thread.join()
+            watcher.close()
+
+    def test_polling(self):
+        self.check_wait(watch.Watcher(self.test_dir, interval=0.1, use_inotify=False))
+
+    def test_inotify(self):
+        watcher = watch.Watcher(self.test_dir)
+        if watcher._inotify is None:
+            self.skipTest('No inotify')
+        self.check_wait(watcher)
+
+    def test_inotify_recreated_directory(self):
+        watcher = watch.Watcher(self.test_dir)
+        if watcher._inotify is None:
+            self.skipTest('No inotify')
+        try:
+            # Deleted and made again between two checks, like by git checkout.
+            shutil.rmtree(os.path.join(self.test_dir, 'dinsdale'))
+            os.mkdir(os.path.join(self.test_dir, 'dinsdale'))
+            self.assertEqual(watcher.wait(), [os.path.join(self.test_dir, 'dinsdale',
+                                                           '__init__.py')])
+            # Changes in the new directory are seen.
+            self.write('dinsdale/__init__.py', 'changed')
+            self.assertTrue(watcher._inotify.wait(1))
+        finally:
+            watcher.close()
+
+    def test_edits_while_running(self):
+        watcher = watch.Watcher(self.test_dir, interval=0.1, use_inotify=False)
+        try:
+            # While the tests run, the user edits a module and the tests write a report.
+            self.write('dinsdale/__init__.py', 'changed')
+            self.write('report.xml', '<testsuites/>')
+            watcher.reset()
+            self.assertEqual(watcher.wait(), [os.path.join(self.test_dir, 'dinsdale',
+                                                           '__init__.py')])
+
+            # Tests that write a Python module rerun once, not forever.
+            generated = os.path.join(self.test_dir, 'generated.py')
+            self.write('generated.py', 'x = 1')
+            watcher.reset()
+            self.assertEqual(watcher.wait(), [generated])
+            self.write('generated.py', 'x = 1')
+            os.utime(generated, (0, 0))
+            watcher.reset()
+            self.assertEqual(watcher._pending, [])
+        finally:
+            watcher.close()
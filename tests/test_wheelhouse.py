@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from spiny import wheelhouse
+
+
+class TestWheelhouse(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.envdict = {'path': sys.executable, 'python': 'Python', 'version': '3.6.1',
+                        'implementation': 'CPython', 'version_info': [3, 6, 1],
+                        'has_pip': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_usable(self):
+        self.assertTrue(wheelhouse.usable(['six\n', '# A comment\n', '\n', 'zope.interface>=4']))
+        self.assertFalse(wheelhouse.usable(['six', '-e .']))
+        self.assertFalse(wheelhouse.usable(['git+https://github.com/regebro/spiny']))
+        self.assertFalse(wheelhouse.usable(['./dinsdale']))
+
+    def test_abi_dir(self):
+        self.assertEqual(wheelhouse.abi_dir(self.test_dir, self.envdict),
+                         os.path.join(self.test_dir, 'cpython-3.6'))
+        # PyPy versions are not the language versions.
+        pypy39 = {'python': 'PyPy3', 'implementation': 'PyPy', 'version': '7.3.16',
+                  'version_info': [3, 9, 19]}
+        pypy310 = dict(pypy39, version_info=[3, 10, 14])
+        self.assertEqual(wheelhouse.abi_dir(self.test_dir, pypy39),
+                         os.path.join(self.test_dir, 'pypy-3.9-7.3'))
+        self.assertEqual(wheelhouse.abi_dir(self.test_dir, pypy310),
+                         os.path.join(self.test_dir, 'pypy-3.10-7.3'))
+
+    def test_built_requirements_are_not_rebuilt(self):
+        directory = wheelhouse.abi_dir(self.test_dir, self.envdict)
+        os.makedirs(directory)
+        with open(os.path.join(directory, wheelhouse.MANIFEST), 'wt') as manifest:
+            json.dump({'six': time.time()}, manifest)
+
+        # The Python can't build anything, but nothing needs building.
+        self.envdict['path'] = os.path.join(self.test_dir, 'nopython')
+        self.assertEqual(wheelhouse.build(self.test_dir, self.envdict, ['six\n'], [], True),
+                         directory)
+
+    def test_pinned(self):
+        self.assertTrue(wheelhouse.pinned('six==1.16.0'))
+        self.assertTrue(wheelhouse.pinned('zope.interface[test] == 5.0; python_version > "3"'))
+        self.assertFalse(wheelhouse.pinned('six'))
+        self.assertFalse(wheelhouse.pinned('six>=1'))
+        self.assertFalse(wheelhouse.pinned('six==1.*'))
+        self.assertFalse(wheelhouse.pinned('six==1.16.0,!=1.16.1'))
+
+    def test_unpinned_requirements_are_rebuilt(self):
+        directory = wheelhouse.abi_dir(self.test_dir, self.envdict)
+        os.makedirs(directory)
+        built = time.time() - wheelhouse.UNPINNED_MAX_AGE - 10
+        with open(os.path.join(directory, wheelhouse.MANIFEST), 'wt') as manifest:
+            json.dump({'six==1.16.0': built, 'mock': built}, manifest)
+
+        # A Python that fails, so building the old unpinned mock fails.
+        self.envdict['path'] = os.path.join(self.test_dir, 'failing')
+        with open(self.envdict['path'], 'wt') as script:
+            script.write('#!/bin/sh\nexit 1\n')
+        os.chmod(self.envdict['path'], 0o755)
+        self.assertEqual(wheelhouse.build(self.test_dir, self.envdict, ['six==1.16.0'], [], True),
+                         directory)
+        self.assertIsNone(wheelhouse.build(self.test_dir, self.envdict, ['mock'], [], True))
+        self.assertEqual(wheelhouse.read_manifest(os.path.join(self.test_dir, 'missing')), {})
+
+    def test_find_links(self):
+        self.assertEqual(wheelhouse.find_links(['http://a/', 'http://b/']),
+                         ['-f', 'http://a/', '-f', 'http://b/'])
+
+    def test_prepare_skips_unusable(self):
+        jobs = [('python3.6', self.envdict, ['-e .'], []),
+                ('python2.7', dict(self.envdict, has_pip=False), ['six'], []),
+                ('python3.5', self.envdict, [], [])]
+        self.assertEqual(wheelhouse.prepare(self.test_dir, jobs, 2, True),
+                         {'python3.6': None, 'python2.7': None, 'python3.5': None})
@@ -1,6 +1,6 @@
 import os
 import shutil
-import spiny
+import spiny.environment
 import tempfile
 
 try: